@@ -0,0 +1,388 @@
+import os
+import io
+import sys
+import json
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import pandas as pd
+import numpy as np
+
+from data_downloader import (FILLER_COLS, ISO_CODES_FILE, PipelineProfiler, load_sources,
+                             read_sources, select_filtered_rows, lowercase_column_names, reformat_dates, convert_dates,
+                             intersect_dates, intersect_countries, remove_regional_data, merge_datasets,
+                             merge_datasets_cube, add_iso_codes, compact_dtypes, update_filler_rows,
+                             recode_oxford_vars, recode_GT, add_derived_columns, drop_unnecessary_columns,
+                             rename_columns, format_dates, export_outputs, summarize_dataset)
+
+
+# file names of the sources, as published upstream
+SOURCE_FILES = {
+    'owid': 'owid-covid-data.csv',
+    'oxford': 'OxCGRT_latest_combined.csv',
+    'oxford_nice': 'OxCGRT_latest.csv',
+}
+
+# daily (non-static) OWID columns, in the order they appear in the upstream file
+OWID_DAILY_COLS = ["total_cases", "new_cases", "new_cases_smoothed", "total_deaths", "new_deaths",
+                   "new_deaths_smoothed", "total_cases_per_million", "new_cases_per_million",
+                   "new_cases_smoothed_per_million", "total_deaths_per_million", "new_deaths_per_million",
+                   "new_deaths_smoothed_per_million", "reproduction_rate", "icu_patients", "icu_patients_per_million",
+                   "hosp_patients", "hosp_patients_per_million", "weekly_icu_admissions",
+                   "weekly_icu_admissions_per_million", "weekly_hosp_admissions", "weekly_hosp_admissions_per_million",
+                   "new_tests", "total_tests", "total_tests_per_thousand", "new_tests_per_thousand",
+                   "new_tests_smoothed", "new_tests_smoothed_per_thousand", "positive_rate", "tests_per_case",
+                   "tests_units", "total_vaccinations", "people_vaccinated", "people_fully_vaccinated",
+                   "new_vaccinations", "new_vaccinations_smoothed", "total_vaccinations_per_hundred",
+                   "people_vaccinated_per_hundred", "people_fully_vaccinated_per_hundred",
+                   "new_vaccinations_smoothed_per_million", "stringency_index"]
+
+# OWID's aggregate rows (continents, income groups, etc.), which aren't countries in OxCGRT
+OWID_AGGREGATES = {"OWID_WRL": "World", "OWID_EUR": "Europe", "OWID_ASI": "Asia", "OWID_AFR": "Africa",
+                   "OWID_EUN": "European Union", "OWID_INT": "International"}
+
+CONTINENTS = ["Africa", "Asia", "Europe", "North America", "Oceania", "South America"]
+
+TESTS_UNITS = ["tests performed", "people tested", "samples tested", "units unclear"]
+
+# OxCGRT indicators: (name in OxCGRT_latest.csv, maximum level, how the level is flagged in the *_combined column).
+# Flags are "G" (general) or "T" (targeted), except E1 ("A"/"F") and H7 ("I"/"T"); None means the indicator
+# has no flag, and its *_combined column holds the bare level.
+OXFORD_INDICATORS = {
+    'C1': ("C1_School closing", 3, "GT"),
+    'C2': ("C2_Workplace closing", 3, "GT"),
+    'C3': ("C3_Cancel public events", 2, "GT"),
+    'C4': ("C4_Restrictions on gatherings", 4, "GT"),
+    'C5': ("C5_Close public transport", 2, "GT"),
+    'C6': ("C6_Stay at home requirements", 3, "GT"),
+    'C7': ("C7_Restrictions on internal movement", 2, "GT"),
+    'C8': ("C8_International travel controls", 4, None),
+    'E1': ("E1_Income support", 2, "AF"),
+    'E2': ("E2_Debt/contract relief", 2, None),
+    'H1': ("H1_Public information campaigns", 2, "GT"),
+    'H2': ("H2_Testing policy", 3, None),
+    'H3': ("H3_Contact tracing", 2, None),
+    'H6': ("H6_Facial Coverings", 4, "GT"),
+    'H7': ("H7_Vaccination policy", 5, "IT"),
+    'H8': ("H8_Protection of elderly people", 3, "GT"),
+    'V1': ("V1_Vaccine Prioritisation (summary)", 2, "GT"),
+    'V2': ("V2_Vaccine Availability (summary)", 3, "GT"),
+    'V3': ("V3_Vaccine Financial Support (summary)", 5, "GT"),
+}
+
+# monetary OxCGRT indicators, which are only in OxCGRT_latest.csv
+OXFORD_MONETARY = ["E3_Fiscal measures", "E4_International support", "H4_Emergency investment in healthcare",
+                   "H5_Investment in vaccines"]
+
+OXFORD_INDEXES = ["StringencyIndex", "StringencyIndexForDisplay", "StringencyLegacyIndex",
+                  "StringencyLegacyIndexForDisplay", "GovernmentResponseIndex", "GovernmentResponseIndexForDisplay",
+                  "ContainmentHealthIndex", "ContainmentHealthIndexForDisplay", "EconomicSupportIndex",
+                  "EconomicSupportIndexForDisplay"]
+
+# default size of the synthetic data at scale 1, roughly matching the real files in early 2021
+BASE_COUNTRIES = 175
+BASE_DAYS = 450
+BASE_REGIONS = 10
+
+# every this-many-th country has regional rows in OxCGRT (as only a few countries, like the US, UK, and Brazil do)
+REGIONAL_EVERY = 10
+
+START_DATE = "2020-01-01"
+
+
+def country_names(n_countries, iso_filename=ISO_CODES_FILE):
+    # real country names (with their ISO codes) first, then made-up ones if more are needed
+    iso_codes = pd.read_csv(iso_filename, encoding="utf-8-sig")
+    extra = max(0, n_countries - len(iso_codes))
+    extra = pd.DataFrame({"country": [f"Country {i + 1}" for i in range(extra)],
+                          "iso_code": [f"X{i + 1:02d}" for i in range(extra)]})
+    return pd.concat([iso_codes, extra], ignore_index=True).iloc[:n_countries]
+
+
+def ordinal_levels(rng, n_rows, max_level, n_days):
+    # policy levels that change every few weeks, rather than independently from one day to the next
+    changes = rng.random(n_rows) < 1 / 21
+    changes[::n_days] = True
+    levels = rng.integers(0, max_level + 1, size=n_rows)
+    return levels[np.maximum.accumulate(np.where(changes, np.arange(n_rows), 0))]
+
+
+def generate_oxford(rng, countries, dates, regions_per_country):
+    """Builds synthetic OxCGRT_latest_combined.csv and OxCGRT_latest.csv tables
+
+    Args:
+        rng (numpy Generator): random number generator
+        countries (pandas DataFrame): country names and ISO codes
+        dates (pandas DatetimeIndex): dates to cover
+        regions_per_country (int): number of regions for the countries that have regional rows
+
+    Returns:
+        tuple: the combined and the "nice" tables, as pandas DataFrames
+    """
+    # one national row for every country, plus regional rows for some of them
+    units = []
+    for i, (country, code) in enumerate(zip(countries["country"], countries["iso_code"])):
+        units.append((country, code, None, None, "NAT_TOTAL"))
+        if i % REGIONAL_EVERY == 0:
+            units.extend((country, code, f"{country} Region {j + 1}", f"{code}_{j + 1:02d}", "STATE_TOTAL")
+                         for j in range(regions_per_country))
+    units = pd.DataFrame(units, columns=["CountryName", "CountryCode", "RegionName", "RegionCode", "Jurisdiction"])
+
+    n_days = len(dates)
+    n_rows = len(units) * n_days
+    keys = units.loc[units.index.repeat(n_days)].reset_index(drop=True)
+    keys["Date"] = np.tile(dates.strftime("%Y%m%d").astype(int), len(units))
+
+    combined = {}
+    nice = {}
+    for indicator, (nice_name, max_level, flags) in OXFORD_INDICATORS.items():
+        levels = ordinal_levels(rng, n_rows, max_level, n_days).astype(np.float64)
+        # recent days aren't coded yet
+        levels[rng.random(n_rows) < 0.02] = np.nan
+        if flags is None:
+            combined[indicator + "_combined"] = levels
+            combined[indicator + "_combined_numeric"] = levels
+            nice[nice_name] = levels
+            continue
+        general = rng.random(n_rows) < 0.7
+        codes = np.where(np.isnan(levels), "", np.nan_to_num(levels).astype(int).astype(str))
+        codes = np.where((np.nan_to_num(levels) > 0) & general, np.char.add(codes, flags[0]), codes)
+        codes = np.where((np.nan_to_num(levels) > 0) & ~general, np.char.add(codes, flags[1]), codes)
+        combined[indicator + "_combined"] = np.where(codes == "", None, codes)
+        combined[indicator + "_combined_numeric"] = np.where((levels > 0) & ~general, levels - 0.5, levels)
+        nice[nice_name] = levels
+        nice[indicator + "_Flag"] = np.where(levels > 0, general.astype(np.float64), np.nan)
+
+    for name in OXFORD_MONETARY:
+        values = np.round(rng.exponential(1e6, n_rows), 0)
+        nice[name] = np.where(rng.random(n_rows) < 0.9, 0.0, np.where(rng.random(n_rows) < 0.5, values, np.nan))
+
+    cases = np.cumsum(rng.poisson(50, n_rows).reshape(len(units), n_days), axis=1).ravel().astype(np.float64)
+    indexes = {"ConfirmedCases": cases, "ConfirmedDeaths": np.floor(cases * 0.02)}
+    for name in OXFORD_INDEXES:
+        indexes[name] = np.round(rng.random(n_rows) * 100, 2)
+
+    combined = pd.concat([keys, pd.DataFrame(combined), pd.DataFrame(indexes)], axis=1)
+    nice = pd.concat([keys, pd.DataFrame(nice), pd.DataFrame(indexes)], axis=1)
+    return combined, nice
+
+
+def generate_owid(rng, countries, dates):
+    """Builds a synthetic owid-covid-data.csv table
+
+    Each country starts reporting on a different date, and each daily variable is missing on some
+    days; OWID's aggregate rows (World, Europe, etc.) are included too.
+
+    Args:
+        rng (numpy Generator): random number generator
+        countries (pandas DataFrame): country names and ISO codes
+        dates (pandas DatetimeIndex): dates to cover
+
+    Returns:
+        pandas DataFrame: the synthetic OWID table
+    """
+    locations = pd.DataFrame({"iso_code": [*countries["iso_code"], *OWID_AGGREGATES],
+                              "location": [*countries["country"], *OWID_AGGREGATES.values()]})
+    n_locations = len(locations)
+    # OWID is usually a day or two ahead of OxCGRT
+    dates = dates.append(pd.date_range(dates[-1] + pd.Timedelta(days=1), periods=2))
+    n_days = len(dates)
+
+    first_day = rng.integers(0, max(1, n_days // 4), size=n_locations)
+    location_idx = np.repeat(np.arange(n_locations), n_days)
+    day_idx = np.tile(np.arange(n_days), n_locations)
+    keep = day_idx >= first_day[location_idx]
+    location_idx, day_idx = location_idx[keep], day_idx[keep]
+    n_rows = len(location_idx)
+
+    df = {
+        "iso_code": locations["iso_code"].to_numpy()[location_idx],
+        "continent": np.where(location_idx < len(countries),
+                              np.array(CONTINENTS, dtype=object)[location_idx % len(CONTINENTS)], None),
+        "location": locations["location"].to_numpy()[location_idx],
+        "date": dates.strftime("%Y-%m-%d").to_numpy()[day_idx],
+    }
+    for col in OWID_DAILY_COLS:
+        if col == "tests_units":
+            values = np.array(TESTS_UNITS, dtype=object)[location_idx % len(TESTS_UNITS)]
+        elif col.startswith("total_") or col.startswith("people_"):
+            values = np.round(np.cumsum(rng.exponential(100, n_rows)), 3)
+        else:
+            values = np.round(rng.exponential(100, n_rows), 3)
+        # later variables (vaccinations, hospitalizations) are missing more often
+        missing = rng.random(n_rows) < rng.uniform(0.05, 0.8)
+        df[col] = np.where(missing, None if values.dtype == object else np.nan, values)
+    df = pd.DataFrame(df)
+
+    # static attributes, the same on every row for a country (and sometimes missing entirely)
+    for col in FILLER_COLS[1:]:
+        values = np.round(rng.uniform(1, 1000, n_locations), 3)
+        values[rng.random(n_locations) < 0.1] = np.nan
+        df[col] = values[location_idx]
+    return df
+
+
+def generate_sources(directory, n_countries=BASE_COUNTRIES, n_days=BASE_DAYS, regions_per_country=BASE_REGIONS,
+                     seed=0, iso_filename=ISO_CODES_FILE):
+    """Writes synthetic versions of the three source files, and a matching ISO codes file, to a directory
+
+    The files have the same columns, code values (e.g., "2G", "1T", "1F", "1A", "3I"), date formats, and
+    regional rows as the real ones, so the whole pipeline can be run on them offline.
+
+    Args:
+        directory (str): where to write the files
+        n_countries (int): number of countries. Real country names are used first, then made-up ones.
+        n_days (int): number of days covered by OxCGRT (OWID covers a couple more)
+        regions_per_country (int): number of regions for the countries that have regional rows in OxCGRT
+        seed (int): random seed
+        iso_filename (str): the real ISO codes file
+
+    Returns:
+        dict: paths of the source files, keyed like SOURCE_FILES, plus 'iso_codes'
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    countries = country_names(n_countries, iso_filename)
+    dates = pd.date_range(START_DATE, periods=n_days)
+
+    paths = {name: os.path.join(directory, filename) for name, filename in SOURCE_FILES.items()}
+    generate_owid(rng, countries, dates).to_csv(paths['owid'], index=False)
+    combined, nice = generate_oxford(rng, countries, dates, regions_per_country)
+    combined.to_csv(paths['oxford'], index=False)
+    nice.to_csv(paths['oxford_nice'], index=False)
+    paths['iso_codes'] = os.path.join(directory, ISO_CODES_FILE)
+    countries.to_csv(paths['iso_codes'], index=False)
+    return paths
+
+
+def run_stages(paths, merge_engine="join", full_read=False):
+    # runs the pipeline's stages on the given source files, the same way `data_downloader.py` does by default
+    profiler = PipelineProfiler()
+    run = profiler.run
+    sources = {name: paths[name] for name in SOURCE_FILES}
+
+    if full_read:
+        datasets_dict = run("load_sources", load_sources, sources)
+    else:
+        datasets_dict, rows = run("read_sources", read_sources, sources)
+    datasets = [datasets_dict['owid'], datasets_dict['oxford'], datasets_dict['oxford_nice']]
+    run("lowercase_column_names", lowercase_column_names, datasets)
+    run("reformat_dates", reformat_dates, datasets[1:])
+    run("convert_dates", convert_dates, datasets)
+    run("intersect_dates", intersect_dates, datasets_dict)
+    run("intersect_countries", intersect_countries, datasets_dict)
+    run("remove_regional_data", remove_regional_data, datasets_dict)
+    if not full_read:
+        datasets_dict = run("select_filtered_rows", select_filtered_rows, rows, datasets_dict)
+        del rows
+    if merge_engine == "cube":
+        df = run("merge_datasets_cube", merge_datasets_cube, datasets_dict, paths['iso_codes'])
+        del datasets, datasets_dict
+        run("compact_dtypes", compact_dtypes, df)
+    else:
+        df = run("merge_datasets", merge_datasets, datasets_dict)
+        del datasets, datasets_dict
+        df = run("add_iso_codes", add_iso_codes, df, paths['iso_codes'])
+        run("compact_dtypes", compact_dtypes, df)
+        df = run("update_filler_rows", update_filler_rows, df)
+    run("recode_oxford_vars", recode_oxford_vars, df)
+    run("recode_GT", recode_GT, df)
+    run("add_derived_columns", add_derived_columns, df)
+    run("drop_unnecessary_columns", drop_unnecessary_columns, df)
+    run("rename_columns", rename_columns, df)
+    run("format_dates", format_dates, df)
+    run("export_outputs", export_outputs, df, "benchmark")
+    run("summarize_dataset", summarize_dataset, df)
+    profiler.stop()
+    return profiler.stages
+
+
+def benchmark_scale(directory, n_countries, n_days, regions_per_country, merge_engine="join", full_read=False,
+                    verbose=False):
+    """Generates synthetic sources of one size, and times each pipeline stage on them
+
+    Run in a fresh process (see main), so that memory used at one scale doesn't inflate the next.
+
+    Returns:
+        dict: the size of the synthetic data, and the timings and memory use of each stage
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    iso_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), ISO_CODES_FILE)
+    output = sys.stdout if verbose else io.StringIO()
+    with contextlib.redirect_stdout(output):
+        paths = generate_sources(directory, n_countries, n_days, regions_per_country, iso_filename=iso_filename)
+        stages = run_stages(paths, merge_engine, full_read)
+
+    for stage in stages:
+        rows = (stage["input"] or stage["output"] or {}).get("rows")
+        stage["rows_per_second"] = round(rows / stage["wall_seconds"]) if rows and stage["wall_seconds"] > 0 else None
+    return {
+        "countries": n_countries,
+        "days": n_days,
+        "regions_per_country": regions_per_country,
+        "source_bytes": {name: os.path.getsize(paths[name]) for name in SOURCE_FILES},
+        "output_rows": stages[-1]["input"]["rows"],
+        "total_wall_seconds": round(sum(x["wall_seconds"] for x in stages), 4),
+        "peak_rss": max(x["peak_rss"] for x in stages),
+        "stages": stages,
+    }
+
+
+def print_results(result, budget_seconds=None):
+    print(f'Scale: {result["countries"]} countries x {result["days"]} days, {result["regions_per_country"]} regions '
+          f'per regional country ({sum(result["source_bytes"].values()) / 1e6:,.1f} MB of source files, '
+          f'{result["output_rows"]:,} output rows)', flush=True)
+    print(f'    {"stage":<26} {"wall (s)":>9} {"cpu (s)":>9} {"peak MB":>9} {"rows/s":>12}', flush=True)
+    for stage in result["stages"]:
+        rate = f'{stage["rows_per_second"]:,}' if stage["rows_per_second"] else ""
+        print(f'    {stage["stage"]:<26} {stage["wall_seconds"]:>9.2f} {stage["cpu_seconds"]:>9.2f} '
+              f'{stage["peak_rss"] / 1e6:>9.1f} {rate:>12}', flush=True)
+    print(f'    Total: {result["total_wall_seconds"]:.2f} s, peak {result["peak_rss"] / 1e6:.1f} MB', flush=True)
+    if budget_seconds is not None:
+        fits = "fits within" if result["total_wall_seconds"] <= budget_seconds else "EXCEEDS"
+        print(f'    This {fits} the {budget_seconds:,.0f} s budget', flush=True)
+    print("", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline on synthetic OWID/OxCGRT data "
+                                                 "of increasing size, without downloading anything")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 2, 5],
+                        help="multiples of the base number of days to run at (default: 1 2 5)")
+    parser.add_argument("--countries", type=int, default=BASE_COUNTRIES,
+                        help=f"number of countries (default: {BASE_COUNTRIES})")
+    parser.add_argument("--days", type=int, default=BASE_DAYS,
+                        help=f"number of days at scale 1 (default: {BASE_DAYS})")
+    parser.add_argument("--regions", type=int, default=BASE_REGIONS,
+                        help=f"regions in each country that has regional rows (default: {BASE_REGIONS})")
+    parser.add_argument("--merge-engine", choices=["join", "cube"], default="join",
+                        help="merge engine to benchmark (see data_downloader.py)")
+    parser.add_argument("--full-read", action="store_true",
+                        help="load all of each source file before filtering (see data_downloader.py)")
+    parser.add_argument("--workdir", default="benchmark_data",
+                        help="directory for the synthetic files (default: benchmark_data)")
+    parser.add_argument("--budget-seconds", type=float, default=None,
+                        help="report whether each scale's total run time fits within this many seconds")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        n_days = max(1, round(args.days * scale))
+        directory = os.path.abspath(os.path.join(args.workdir, f"scale_{scale:g}"))
+        print(f"Running at scale {scale:g}...", flush=True)
+        # each scale runs in its own process, so peak memory is measured from a clean start
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(benchmark_scale, directory, args.countries, n_days, args.regions,
+                                     args.merge_engine, args.full_read, args.verbose).result()
+        result["scale"] = scale
+        print_results(result, args.budget_seconds)
+        results.append(result)
+
+    filename = f'benchmark_{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    with open(filename, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print(f"Wrote {filename}", flush=True)
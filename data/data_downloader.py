@@ -1,6 +1,35 @@
 import os
+import argparse
+import time
+import io
+import sys
+import json
+import hashlib
+import gzip
+import tempfile
+import glob
+import contextlib
+import shutil
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import csv
+import cProfile
+import pstats
+import pickle
+import inspect
+import types
+import weakref
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    import brotli
+except ImportError:  # optional; without it, publish_outputs writes gzip files only
+    brotli = None
 import pandas as pd
 import numpy as np
 
@@ -15,16 +44,265 @@ OXFORD_LINK = 'https://raw.githubusercontent.com/OxCGRT/covid-policy-tracker/mas
 OXFORD_NICE_LINK = 'https://raw.githubusercontent.com/OxCGRT/covid-policy-tracker/master/data/OxCGRT_latest.csv'
 
 
-def download_data():
-    print("Downloading data...", flush=True)
-    print("    Downloading OWID....", end="", flush=True)
-    owid = pd.read_csv(OWID_LINK)
+# downloaded files are kept here between runs, so unchanged files don't need to be downloaded again
+CACHE_DIR = 'download_cache'
+
+# static (per-country) attributes from OWID; these are the same on every row for a given country
+FILLER_COLS = ["continent", "population", "population_density", "median_age", "aged_65_older", "aged_70_older",
+               "gdp_per_capita", "extreme_poverty", "cardiovasc_death_rate", "diabetes_prevalence",
+               "female_smokers", "male_smokers", "handwashing_facilities", "hospital_beds_per_thousand",
+               "life_expectancy", "human_development_index"]
+
+# country names and their ISO codes (alpha-3)
+ISO_CODES_FILE = 'countries_iso.csv'
+
+# outputs of the pipeline's stages are kept here between runs (see StageCache), up to this many megabytes
+STAGE_CACHE_DIR = 'stage_cache'
+STAGE_CACHE_MAX_MB = 2048
+
+# names, types, and categories of the variables shown on the site
+DATA_DICTIONARY_FILE = 'data_dictionary.csv'
+
+# quantile breakpoints computed for each variable by compute_aggregates
+AGGREGATE_QUANTILES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+# in incremental mode, dates within this many days of the end of the previous output are reprocessed, 
+# since upstream data for recent dates are often revised
+INCREMENTAL_WINDOW_DAYS = 28
+
+# columns needed to decide which rows of each source to keep
+KEY_COLS = {
+    'owid': ['location', 'date'],
+    'oxford': ['countryname', 'regionname', 'date'],
+    'oxford_nice': ['countryname', 'regionname', 'date'],
+}
+
+# the only columns we use from oxford_nice, other than the keys
+OXFORD_NICE_COLS = ['e3_fiscal measures', 'e4_international support',
+                    'h4_emergency investment in healthcare', 'h5_investment in vaccines']
+
+# columns removed by drop_unnecessary_columns anyway, so there's no need to read them
+UNUSED_COLS = {
+    'owid': ['iso_code', 'stringency_index'],
+    'oxford': ['countrycode', 'regioncode', 'jurisdiction', 'confirmedcases', 'confirmeddeaths',
+               'stringencyindexfordisplay', 'stringencylegacyindex', 'stringencylegacyindexfordisplay',
+               'governmentresponseindexfordisplay', 'containmenthealthindexfordisplay',
+               'economicsupportindexfordisplay'],
+}
+
+# string columns stored as categoricals after merging (as are all of the *_combined columns)
+CATEGORICAL_COLS = ['countryname', 'continent', 'iso_code', 'location', 'tests_units']
+
+# rows per chunk when reading the filtered source files
+READ_CHUNK_SIZE = 100_000
+
+# with --geometry, the country polygons are written as TopoJSON at these levels of detail, each with a 
+# Douglas-Peucker tolerance (in degrees) and a quantization (grid steps across the map)
+GEOMETRY_LEVELS = {
+    'low': (0.1, 10_000),  # the whole world
+    'medium': (0.02, 50_000),  # a continent
+    'high': (0.004, 200_000),  # a country
+}
+
+# coordinates are snapped to a grid of this many steps across the map before finding shared borders
+TOPOLOGY_QUANTIZATION = 1_000_000
+
+# precompressed variants written by publish_outputs: gzip at its highest level, and brotli at a level 
+# that's nearly as small as its highest (11) but many times faster on a file of this size
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+# files that are compressed already (Parquet compresses each column), which publish_outputs doesn't 
+# precompress again
+COMPRESSED_EXTENSIONS = ('.parquet',)
+
+# with --partitioned, the filtered source files are split into one file per country here (see spill_partitions)
+PARTITION_DIR = 'partitions'
+
+# the streaming summary (see StreamingSummary) reads this many rows at a time. Its quartiles are exact for 
+# datasets of up to QUANTILE_EXACT_ROWS rows (the sketch is sized to hold every value), and otherwise come 
+# from a sketch of at least QUANTILE_SKETCH_SIZE values per level, off by up to about 0.02% of the rows in rank. 
+# Its distinct counts are exact up to DISTINCT_EXACT_LIMIT distinct values, and its most frequent values as 
+# long as a column has no more than TOP_VALUES_LIMIT distinct values.
+SUMMARY_CHUNK_SIZE = 100_000
+QUANTILE_EXACT_ROWS = 1_000_000
+QUANTILE_SKETCH_SIZE = 8192
+DISTINCT_EXACT_LIMIT = 65_536
+TOP_VALUES_LIMIT = 10_000
+
+SOURCE_LINKS = {
+    'owid': OWID_LINK,
+    'oxford': OXFORD_LINK,
+    'oxford_nice': OXFORD_NICE_LINK,
+}
+
+
+def read_cache_metadata(path):
+    # each cached file has a small JSON file next to it with the headers we need for conditional requests
+    try:
+        with open(path + ".meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache_metadata(path, metadata):
+    with open(path + ".meta.json", "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def fetch_to_cache(url, path, chunk_size=1024 * 1024, timeout=60):
+    """Download a file into the local cache, streaming the body to disk
+
+    If the file is already cached, the request is made conditional on its ETag/Last-Modified, so an 
+    unchanged file is not downloaded again. If a previous download was interrupted, the transfer is 
+    resumed from the end of the partial file (as long as the file hasn't changed on the server since).
+
+    Args:
+        url (str): URL to download
+        path (str): where to save the file
+        chunk_size (int, optional): number of bytes to read from the response at a time. Defaults to 1 MB.
+        timeout (int, optional): socket timeout, in seconds. Defaults to 60.
+
+    Returns:
+        dict: "status" ("downloaded", "resumed", or "not modified"), "bytes" transferred, "seconds" taken,
+              "reused_bytes" (bytes we didn't have to download), and "bytes_per_second" of the transfer
+    """
+    part_path = path + ".part"
+    metadata = read_cache_metadata(path)
+    part_metadata = read_cache_metadata(part_path)
+    if metadata.get("url") != url:
+        metadata = {}
+    if part_metadata.get("url") != url:
+        part_metadata = {}
+
+    headers = {}
+    resume_from = 0
+    if os.path.exists(part_path) and (part_metadata.get("etag") or part_metadata.get("last_modified")):
+        # only resume if we can tell the server which version of the file the partial download came from
+        resume_from = os.path.getsize(part_path)
+        headers["Range"] = f"bytes={resume_from}-"
+        headers["If-Range"] = part_metadata.get("etag") or part_metadata["last_modified"]
+    elif os.path.exists(path) and metadata:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    start = time.perf_counter()
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return {"status": "not modified", "bytes": 0, "seconds": time.perf_counter() - start,
+                    "reused_bytes": os.path.getsize(path),
+                    "bytes_per_second": metadata.get("bytes_per_second")}
+        if e.code == 416 and resume_from > 0:
+            # the partial file is no good (e.g., it's already as big as the file on the server); start over
+            os.remove(part_path)
+            return fetch_to_cache(url, path, chunk_size=chunk_size, timeout=timeout)
+        raise
+
+    with response:
+        if response.status == 206:
+            status = "resumed"
+            mode = "ab"
+        else:
+            # the server sent the whole file, either because this isn't a resume or because the file changed
+            status = "downloaded"
+            mode = "wb"
+            resume_from = 0
+
+        new_metadata = {"url": url,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified")}
+        write_cache_metadata(part_path, new_metadata)
+
+        transferred = 0
+        with open(part_path, mode) as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                transferred += len(chunk)
+
+    seconds = time.perf_counter() - start
+    new_metadata["bytes_per_second"] = transferred / seconds if seconds > 0 else None
+
+    os.replace(part_path, path)
+    os.remove(part_path + ".meta.json")
+    write_cache_metadata(path, new_metadata)
+
+    return {"status": status, "bytes": transferred, "seconds": seconds, "reused_bytes": resume_from,
+            "bytes_per_second": new_metadata["bytes_per_second"]}
+
+
+def download_sources(cache_dir=CACHE_DIR, links=None):
+    """Download all of the source files into the local cache at the same time
+
+    Args:
+        cache_dir (str, optional): directory for the cached files. Defaults to CACHE_DIR.
+        links (dict, optional): maps dataset name to URL. Defaults to SOURCE_LINKS.
+
+    Returns:
+        dict: maps dataset name to the path of its cached file
+    """
+    if links is None:
+        links = SOURCE_LINKS
+
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = {name: os.path.join(cache_dir, url.rsplit("/", 1)[-1]) for name, url in links.items()}
+
+    with ThreadPoolExecutor(max_workers=len(links)) as executor:
+        futures = {name: executor.submit(fetch_to_cache, url, paths[name]) for name, url in links.items()}
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except (OSError, urllib.error.URLError) as e:
+            if not os.path.exists(paths[name]):
+                raise
+            print(f"    Could not download {name} ({e}); using the cached copy", flush=True)
+            results[name] = {"status": "cached copy", "bytes": 0, "seconds": 0,
+                             "reused_bytes": os.path.getsize(paths[name]), "bytes_per_second": None}
+
+    # estimate the time saved by not downloading bytes we already had, using this run's transfer rate 
+    # (or the rate recorded the last time the file was downloaded, if nothing was downloaded this run)
+    total_bytes = sum(x["bytes"] for x in results.values())
+    total_seconds = sum(x["seconds"] for x in results.values() if x["bytes"] > 0)
+    run_rate = total_bytes / total_seconds if total_seconds > 0 else None
+
+    seconds_saved = 0
+    for name, result in results.items():
+        rate = run_rate or result["bytes_per_second"]
+        saved = result["reused_bytes"] / rate if rate else 0
+        seconds_saved += saved
+        print(f'    {name}: {result["status"]}, {result["bytes"]:,} bytes transferred '
+              f'in {result["seconds"]:.1f}s (~{saved:.1f}s saved)', flush=True)
+
+    print(f"    Total: {total_bytes:,} bytes transferred, ~{seconds_saved:.1f}s saved by the cache", flush=True)
+
+    return paths
+
+
+def load_sources(paths, compact=True):
+    # with `compact`, each file's column types are compacted as soon as it's read (see compact_columns)
+    def read(path):
+        df = pd.read_csv(path)
+        if compact:
+            compact_columns(df)
+        return df
+
+    print("Loading data...", flush=True)
+    print("    Loading OWID....", end="", flush=True)
+    owid = read(paths['owid'])
     print("Done.", flush=True)
-    print("    Downloading Oxford....", end="", flush=True)
-    oxford = pd.read_csv(OXFORD_LINK)
+    print("    Loading Oxford....", end="", flush=True)
+    oxford = read(paths['oxford'])
     print("Done.", flush=True)
-    print("    Downloading Oxford (nice)....", end="", flush=True)
-    oxford_nice = pd.read_csv(OXFORD_NICE_LINK)
+    print("    Loading Oxford (nice)....", end="", flush=True)
+    oxford_nice = read(paths['oxford_nice'])
     print("Done.", flush=True)
     print("Initial download shapes:", flush=True)
     print(f'    OWID: {owid.shape}', flush=True)
@@ -33,7 +311,297 @@ def download_data():
     
     print("\nDone\n", flush=True)
 
-    return [owid, oxford, oxford_nice]
+    return {'owid': owid, 'oxford': oxford, 'oxford_nice': oxford_nice}
+
+
+def source_columns(name, keep_regional=False):
+    # filter for the (original case) column names we need to read from a source file. Regional rows 
+    # also need their region codes.
+    if name == 'oxford_nice':
+        return lambda x: x.lower() in KEY_COLS[name] or x.lower() in OXFORD_NICE_COLS
+    return lambda x: x.lower() not in UNUSED_COLS[name] or (keep_regional and x.lower() == 'regioncode')
+
+
+def scan_source_keys(paths):
+    """Read only the country, region, and date columns of each source file
+
+    These are all we need to work out which rows will be kept (see intersect_dates, intersect_countries, 
+    and remove_regional_data), and are much quicker to read than the whole files.
+
+    Args:
+        paths (dict): maps dataset name to the path of its source file
+
+    Returns:
+        dict: maps dataset name to a DataFrame of its key columns, indexed by row number in the file
+    """
+    print("Scanning key columns...", flush=True)
+    keys = {}
+    for name, path in paths.items():
+        keys[name] = pd.read_csv(path, usecols=lambda x: x.lower() in KEY_COLS[name])
+        print(f'    {name}: {keys[name].shape[0]} rows', flush=True)
+
+    print("\nDone\n", flush=True)
+    return keys
+
+
+def concat_compact(chunks):
+    # concatenates chunks compacted with compact_columns. Categoricals are given the union of their categories 
+    # first, since pd.concat turns categoricals with different categories back into strings; where a column 
+    # wasn't categorical in every chunk, it's concatenated as plain values, the same as without compacting.
+    chunks = list(chunks)
+    for col in chunks[0].columns if chunks else []:
+        categorical = [isinstance(x[col].dtype, pd.CategoricalDtype) for x in chunks]
+        if all(categorical):
+            categories = pd.api.types.union_categoricals([x[col].array for x in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+        elif any(categorical):
+            for chunk in chunks:
+                chunk[col] = chunk[col].astype(object)
+    return pd.concat(chunks)
+
+
+def code_column_type(values):
+    # the type read_csv gives a column of text: "text" if any value isn't a number, and otherwise int64, or 
+    # float64 if any are missing or fractional
+    uniques = pd.unique(values.dropna().to_numpy())
+    numbers = pd.to_numeric(uniques, errors="coerce")
+    if np.isnan(numbers.astype(np.float64)).any():
+        return "text"
+    return np.dtype(np.float64) if values.isna().any() else numbers.dtype
+
+
+def combine_code_types(a, b):
+    # type of a column made of two parts typed by code_column_type
+    if "text" in [a, b]:
+        return "text"
+    return np.result_type(a, b)
+
+
+def restore_code_types(df, code_types):
+    # converts *_combined columns read as text back to numbers, where the whole source file was numeric
+    for col, dtype in code_types.items():
+        if col in df.columns and dtype != "text":
+            df[col] = pd.to_numeric(df[col].astype(object)).astype(dtype)
+
+
+def source_chunks(name, path, chunksize=READ_CHUNK_SIZE, keep_regional=False, code_types=None, dates=True):
+    # yields the columns we use from a source file (see source_columns), under their original names, a chunk 
+    # at a time; without `dates`, leaves out the date column.
+    # read_csv types each chunk separately, so a chunk in which a *_combined column happens to hold only 
+    # numeric codes (e.g. "0") would get numbers where reading the whole file gives text. These columns are 
+    # read as text, and `code_types` (a dict), if given, is updated with the type reading the whole file 
+    # would give each of them (by lowercase name), once the chunks are exhausted; see restore_code_types.
+    usecols = source_columns(name, keep_regional)
+    header = [x for x in pd.read_csv(path, nrows=0).columns if usecols(x) and (dates or x.lower() != 'date')]
+    code_cols = [x for x in header if x.lower()[-9:] == "_combined"]
+    types = {}
+
+    for chunk in pd.read_csv(path, usecols=header, chunksize=chunksize, dtype=dict.fromkeys(code_cols, str)):
+        # typed by every row in the file, including the ones that are dropped
+        for col in code_cols:
+            dtype = code_column_type(chunk[col])
+            types[col.lower()] = combine_code_types(types[col.lower()], dtype) if col.lower() in types else dtype
+        yield chunk
+    if code_types is not None:
+        code_types.update(types)
+
+
+def read_filtered_chunks(name, path, keys, chunksize=READ_CHUNK_SIZE, keep_regional=False, compact=False, 
+                         code_types=None):
+    # yields the rows of a source file that survived filtering, a chunk at a time, with lowercase column 
+    # names and the (already converted) dates from the key columns. With `compact`, each chunk's column 
+    # types are compacted (see compact_columns). See source_chunks for `code_types`.
+    kept_rows = keys.index.to_numpy()
+    # lookup table of which row numbers to keep
+    keep = np.zeros(kept_rows.max() + 1 if len(kept_rows) > 0 else 0, dtype=bool)
+    keep[kept_rows] = True
+
+    usecols = source_columns(name, keep_regional)
+    columns = [x.lower() for x in pd.read_csv(path, nrows=0).columns if usecols(x)]
+
+    for chunk in source_chunks(name, path, chunksize, keep_regional, code_types, dates=False):
+        row_numbers = chunk.index.to_numpy()
+        in_range = row_numbers < len(keep)
+        in_range[in_range] = keep[row_numbers[in_range]]
+        # taken rather than sliced: source_chunks still holds the whole chunk, so setting the dates on a slice 
+        # of it would warn
+        chunk = chunk.take(np.flatnonzero(in_range))
+        chunk.columns = [x.lower() for x in chunk.columns]
+        # reindexed, since assigning a Series to an empty chunk would add all of its rows
+        chunk['date'] = keys['date'].reindex(chunk.index)
+        if compact:
+            compact_columns(chunk)
+        yield chunk[columns]
+
+
+def read_sources(paths, chunksize=READ_CHUNK_SIZE, keep_regional=False, compact=True):
+    """Read each source file once, a chunk at a time, keeping the key columns of every row, and the rest 
+    only of the rows that could survive filtering
+
+    The key columns are filtered afterwards, exactly as if the whole files had been read (see intersect_dates, 
+    intersect_countries, and remove_regional_data), and select_filtered_rows then takes the rows that 
+    survived. Oxford is read first: a row of the other files can only survive if its country is in Oxford, 
+    and (unless `keep_regional`) no regional row survives. So only the rows for the few countries and dates 
+    that the filters drop are held on to needlessly, and no file is parsed twice.
+
+    Args:
+        paths (dict): maps dataset name to the path of its source file
+        chunksize (int, optional): number of rows to read at a time. Defaults to READ_CHUNK_SIZE.
+        keep_regional (bool, optional): whether Oxford's regional rows will be kept. Defaults to False.
+        compact (bool, optional): whether to compact the column types as the files are read (see 
+                                  compact_columns). Defaults to True.
+
+    Returns:
+        tuple: the key columns of each dataset (as from scan_source_keys, with lowercase names), and for 
+               select_filtered_rows, "rows" (each dataset's rows that could survive, without their dates), 
+               "date_position" (where the dates go back in), and "code_types" (see source_chunks)
+    """
+    print("Reading datasets...", flush=True)
+    keys = {}
+    rows = {}
+    code_types = {}
+    date_position = {}
+    countries = None
+    for name in sorted(paths, key=lambda x: x != 'oxford'):
+        country_col = 'location' if name == 'owid' else 'countryname'
+        key_chunks = []
+        kept_chunks = []
+        code_types[name] = {}
+        for chunk in source_chunks(name, paths[name], chunksize, keep_regional, code_types[name]):
+            chunk.columns = [x.lower() for x in chunk.columns]
+            date_position[name] = chunk.columns.get_loc('date')
+            key_chunks.append(chunk[[x for x in chunk.columns if x in KEY_COLS[name]]])
+            keep = np.ones(len(chunk), dtype=bool)
+            if countries is not None:
+                keep &= chunk[country_col].isin(countries).to_numpy()
+            if not keep_regional and 'regionname' in chunk.columns:
+                keep &= chunk['regionname'].isna().to_numpy()
+            chunk = chunk[keep].drop(columns='date')
+            if compact:
+                compact_columns(chunk)
+            kept_chunks.append(chunk)
+        keys[name] = pd.concat(key_chunks)
+        rows[name] = concat_compact(kept_chunks)
+        if name == 'oxford':
+            # regional rows count too, as they do in intersect_countries
+            countries = pd.unique(keys[name][country_col].dropna())
+        print(f'    {name}: {len(keys[name])} rows, {len(rows[name])} held for filtering', flush=True)
+
+    print("\nDone\n", flush=True)
+    return {name: keys[name] for name in paths}, {"rows": {name: rows[name] for name in paths}, 
+                                                  "code_types": code_types, "date_position": date_position}
+
+
+def select_filtered_rows(sources, keys):
+    """Take the rows that survived filtering from the rows held by read_sources
+
+    Args:
+        sources (dict): the rows, date positions, and code types from read_sources
+        keys (dict): the key columns from read_sources, after filtering. Their row numbers are used to select 
+                     rows, and their (already converted) dates are added to them.
+
+    Returns:
+        dict: maps dataset name to its filtered DataFrame
+    """
+    print("Selecting filtered rows...", flush=True)
+    datasets_dict = {}
+    for name, df in sources["rows"].items():
+        df = df.loc[keys[name].index]
+        df.insert(sources["date_position"][name], 'date', keys[name]['date'])
+        # as if only these rows had been read
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].cat.remove_unused_categories()
+        restore_code_types(df, sources["code_types"][name])
+        datasets_dict[name] = df
+        print(f'    {name}: {df.shape}', flush=True)
+
+    print("\nDone\n", flush=True)
+    return datasets_dict
+
+
+def dtype_sample(chunk):
+    # one row per column, taken from a non-missing value where there is one, so that concatenating the 
+    # samples of every chunk gives each column the same type as concatenating the chunks themselves
+    positions = np.argmax(chunk.notna().to_numpy(), axis=0)
+    return pd.concat({col: chunk[col].iloc[[pos]].reset_index(drop=True) for col, pos in zip(chunk.columns, positions)}, 
+                     axis=1)
+
+
+def spill_partitions(paths, keys, directory=PARTITION_DIR, chunksize=READ_CHUNK_SIZE, keep_regional=False):
+    """Split the rows that survived filtering into one partition per country, on disk
+
+    The source files are read a chunk at a time (see read_filtered_chunks), and each chunk's rows are 
+    appended to their country's partition file, so only one chunk is in memory at a time. With 
+    `keep_regional`, Oxford's regional rows go to separate "*_regional" partitions.
+
+    Args:
+        paths (dict): maps dataset name to the path of its source file
+        keys (dict): the key columns from scan_source_keys, after filtering
+        directory (str, optional): where to write the partitions. Emptied first. Defaults to PARTITION_DIR.
+        chunksize (int, optional): number of rows to read at a time. Defaults to READ_CHUNK_SIZE.
+        keep_regional (bool, optional): whether the keys still include regional rows, to be kept
+
+    Returns:
+        dict: "partitions" maps each country (in Oxford's order) to a dict of dataset name -> partition file, 
+              "schemas" maps each kind of partition (e.g. "oxford" or "oxford_regional") to an empty 
+              DataFrame with the column types of all of its rows together
+    """
+    print("Splitting datasets into partitions by country...", flush=True)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    countries = pd.unique(keys['oxford']['countryname'])
+    numbers = {country: i for i, country in enumerate(countries)}
+    partitions = {country: {} for country in countries}
+    schemas = {}
+    for name, path in paths.items():
+        country_col = 'location' if name == 'owid' else 'countryname'
+        samples = {}
+        code_types = {}
+        for chunk in read_filtered_chunks(name, path, keys[name], chunksize, keep_regional, code_types=code_types):
+            if 'regionname' in chunk.columns:
+                regional = chunk['regionname'].notna().to_numpy()
+            else:
+                regional = np.zeros(len(chunk), dtype=bool)
+            for part_name, part in [(name, chunk[~regional]), (name + '_regional', chunk[regional])]:
+                if len(part) == 0:
+                    continue
+                samples.setdefault(part_name, []).append(dtype_sample(part))
+                for country, rows in part.groupby(country_col, sort=False):
+                    filename = partitions[country].setdefault(
+                        part_name, os.path.join(directory, f"{numbers[country]:04d}_{part_name}.pkl"))
+                    with open(filename, "ab") as f:
+                        pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for part_name, part_samples in samples.items():
+            schemas[part_name] = pd.concat(part_samples).iloc[:0]
+            restore_code_types(schemas[part_name], code_types)
+            print(f'    {part_name}: {sum(part_name in x for x in partitions.values())} partitions', flush=True)
+
+    size = sum(os.path.getsize(x) for files in partitions.values() for x in files.values())
+    print(f"    {len(partitions)} countries, {size / 1e6:.1f} MB on disk", flush=True)
+    print("\nDone\n", flush=True)
+    return {"partitions": partitions, "schemas": schemas}
+
+
+def load_partition(filename, schema):
+    # reads back the pieces appended by spill_partitions, with the column types of the whole dataset
+    if filename is None:
+        return schema.copy()
+    pieces = []
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                pieces.append(pickle.load(f))
+            except EOFError:
+                break
+    df = pd.concat(pieces)
+    for col, dtype in schema.dtypes.items():
+        if df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
 
 
 def lowercase_column_names(datasets):
@@ -45,13 +613,10 @@ def lowercase_column_names(datasets):
 
 def reformat_dates(datasets):
     print("Reformatting dates...", end="", flush=True)
-    # Get dates into same format
-    def parse_date(r):
-        datestr = str(r['date'])
-        return datestr[:4] + '-' + datestr[4:6] + '-' + datestr[-2:]
-
+    # Get dates into same format (e.g., 20200131 -> "2020-01-31"), slicing the whole column at once
     for dataset in datasets:
-        dataset['date'] = dataset.apply(parse_date, axis=1)
+        datestr = dataset['date'].astype(str)
+        dataset['date'] = datestr.str[:4] + '-' + datestr.str[4:6] + '-' + datestr.str[-2:]
     print("done\n", flush=True)
 
 
@@ -82,9 +647,13 @@ def intersect_dates(datasets_dict):
 
     print(f'intersection window of dates: {min_date} to {max_date}', flush=True)
 
-    rows_dropped_owid = owid.query('(date < @min_date) or (date > @max_date)').shape[0]
-    rows_dropped_oxford = oxford.query('(date < @min_date) or (date > @max_date)').shape[0]
-    rows_dropped_oxford_nice = oxford_nice.query('(date < @min_date) or (date > @max_date)').shape[0]
+    # compare each date column against the window once, and reuse the masks for counting and filtering
+    outside = {name: (x['date'] < min_date) | (x['date'] > max_date) for name, x in datasets_dict.items()}
+    inside = {name: (x['date'] >= min_date) & (x['date'] <= max_date) for name, x in datasets_dict.items()}
+
+    rows_dropped_owid = outside['owid'].sum()
+    rows_dropped_oxford = outside['oxford'].sum()
+    rows_dropped_oxford_nice = outside['oxford_nice'].sum()
 
     if rows_dropped_owid > 0 or rows_dropped_oxford > 0 or rows_dropped_oxford_nice > 0:
         print('\nDropping rows to align date windows----------------', flush=True)
@@ -99,9 +668,9 @@ def intersect_dates(datasets_dict):
         print(f'    Oxford: {rows_dropped_oxford} rows', flush=True)
         print(f'    Oxford_nice: {rows_dropped_oxford_nice} rows', flush=True)
 
-        datasets_dict['owid'] = owid.query('(date >= @min_date) and (date <= @max_date)')
-        datasets_dict['oxford'] = oxford.query('(date >= @min_date) and (date <= @max_date)')
-        datasets_dict['oxford_nice'] = oxford_nice.query('(date >= @min_date) and (date <= @max_date)')
+        datasets_dict['owid'] = owid[inside['owid']]
+        datasets_dict['oxford'] = oxford[inside['oxford']]
+        datasets_dict['oxford_nice'] = oxford_nice[inside['oxford_nice']]
 
         print('Done. After drop:', flush=True)
         print(f'    OWID: {datasets_dict["owid"].shape[0]} rows', flush=True)
@@ -120,17 +689,25 @@ def intersect_countries(datasets_dict):
 
     owid_countries = owid['location'].unique()
     oxford_countries = oxford['countryname'].unique()
-    intersect_countries = [x for x in owid_countries if x in oxford_countries]
+
+    # use sets for the membership tests, rather than searching the arrays of country names each time
+    owid_set = set(owid_countries)
+    oxford_set = set(oxford_countries)
+    intersect_countries = pd.Index([x for x in owid_countries if x in oxford_set])
 
     print("Countries in oxford, but not in OWID:", flush=True)
-    print([x for x in oxford_countries if x not in owid_countries], flush=True)
+    print([x for x in oxford_countries if x not in owid_set], flush=True)
 
     print("countries in OWID, but not in oxford", flush=True)
-    print([x for x in owid_countries if x not in oxford_countries], flush=True)
+    print([x for x in owid_countries if x not in oxford_set], flush=True)
+
+    keep_owid = owid['location'].isin(intersect_countries)
+    keep_oxford = oxford['countryname'].isin(intersect_countries)
+    keep_oxford_nice = oxford_nice['countryname'].isin(intersect_countries)
 
-    rows_dropped_owid = owid[~owid['location'].isin(intersect_countries)].shape[0]
-    rows_dropped_oxford = oxford[~oxford['countryname'].isin(intersect_countries)].shape[0]
-    rows_dropped_oxford_nice = oxford_nice[~oxford_nice['countryname'].isin(intersect_countries)].shape[0]
+    rows_dropped_owid = (~keep_owid).sum()
+    rows_dropped_oxford = (~keep_oxford).sum()
+    rows_dropped_oxford_nice = (~keep_oxford_nice).sum()
 
     if rows_dropped_owid > 0 or rows_dropped_oxford > 0 or rows_dropped_oxford_nice > 0:
         print("\nDropping rows for countries that don't exist in both datasets----------------", flush=True)
@@ -145,9 +722,9 @@ def intersect_countries(datasets_dict):
         print(f'    Oxford: {rows_dropped_oxford} rows', flush=True)
         print(f'    Oxford_nice: {rows_dropped_oxford_nice} rows', flush=True)
 
-        datasets_dict['owid'] = owid[owid['location'].isin(intersect_countries)]
-        datasets_dict['oxford'] = oxford[oxford['countryname'].isin(intersect_countries)]
-        datasets_dict['oxford_nice'] = oxford_nice[oxford_nice['countryname'].isin(intersect_countries)]
+        datasets_dict['owid'] = owid[keep_owid]
+        datasets_dict['oxford'] = oxford[keep_oxford]
+        datasets_dict['oxford_nice'] = oxford_nice[keep_oxford_nice]
 
         print('Done. After drop:', flush=True)
         print(f'    OWID: {datasets_dict["owid"].shape[0]} rows', flush=True)
@@ -164,9 +741,12 @@ def remove_regional_data(datasets_dict):
     oxford = datasets_dict['oxford']
     oxford_nice = datasets_dict['oxford_nice']
 
+    national_oxford = oxford['regionname'].isna()
+    national_oxford_nice = oxford_nice['regionname'].isna()
+
     rows_dropped_owid = 0
-    rows_dropped_oxford = oxford[~oxford['regionname'].isna()].shape[0]
-    rows_dropped_oxford_nice = oxford_nice[~oxford_nice['regionname'].isna()].shape[0]
+    rows_dropped_oxford = (~national_oxford).sum()
+    rows_dropped_oxford_nice = (~national_oxford_nice).sum()
 
     if rows_dropped_owid > 0 or rows_dropped_oxford > 0 or rows_dropped_oxford_nice > 0:
         print("\nDropping rows to remove regional data----------------", flush=True)
@@ -181,8 +761,8 @@ def remove_regional_data(datasets_dict):
         print(f'    Oxford: {rows_dropped_oxford} rows', flush=True)
         print(f'    Oxford_nice: {rows_dropped_oxford_nice} rows', flush=True)
 
-        datasets_dict['oxford'] = oxford[oxford['regionname'].isna()]
-        datasets_dict['oxford_nice'] = oxford_nice[oxford_nice['regionname'].isna()]
+        datasets_dict['oxford'] = oxford[national_oxford]
+        datasets_dict['oxford_nice'] = oxford_nice[national_oxford_nice]
 
         print('Done.', flush=True)
         print(f'OWID: {datasets_dict["owid"].shape[0]} rows', flush=True)
@@ -200,8 +780,7 @@ def merge_datasets(datasets_dict):
     oxford_nice = datasets_dict['oxford_nice']
 
     df = oxford.merge(owid, how="left", left_on=['countryname', 'date'], right_on=['location', 'date']) \
-            .merge(oxford_nice[['countryname', 'date', 'e3_fiscal measures', 'e4_international support', 
-                                'h4_emergency investment in healthcare', 'h5_investment in vaccines']],
+            .merge(oxford_nice[['countryname', 'date', *OXFORD_NICE_COLS]],
                     on=['countryname', 'date'])
 
     print(f"\nShape after merging: {df.shape}", flush=True)
@@ -221,27 +800,805 @@ def update_filler_rows(df):
     # For the new "filler rows" in OWID, for the static attributes that don't change (e.g., median_age), 
     # update all NAs to be equal to the country's max/min/first value
     print("Updating filler rows...", end="", flush=True)
-    filler_cols = ["continent", "population", "population_density", "median_age", "aged_65_older", "aged_70_older",
-                   "gdp_per_capita", "extreme_poverty", "cardiovasc_death_rate", "diabetes_prevalence",
-                   "female_smokers", "male_smokers", "handwashing_facilities", "hospital_beds_per_thousand",
-                   "life_expectancy", "human_development_index"]
-
-    # replace missing values with "" before aggregating; otherwise string columns like "continent" will 
-    # cause an error when comparing strings with NaN, saying you can't compare a float and a string
-    str_cols = [x for x in df.columns if df[x].dtype == "object"]
-    tmp = df.fillna({x: "" for x in str_cols})
+    filler_cols = FILLER_COLS
 
-    filler_values = tmp.groupby('countryname').agg({x: 'max' for x in filler_cols}).reset_index()
+    # missing values are replaced with "" before aggregating; otherwise string columns like "continent" will 
+    # cause an error when comparing strings with NaN, saying you can't compare a float and a string.
+    # Only the columns we aggregate are copied.
+    filler_values = static_values_by_country(df, 'countryname', filler_cols).reset_index()
 
     # merge in the filler data
     sort_order = df.columns
     data_cols = [x for x in df.columns if x not in filler_cols]
+    categorical_cols = [x for x in filler_cols if isinstance(df[x].dtype, pd.CategoricalDtype)]
     df = df[data_cols].merge(filler_values, how="left", on="countryname")[sort_order]
+    for col in categorical_cols:
+        df[col] = df[col].astype("category")
+    print("Done\n", flush=True)
+
+    return df
+
+
+def is_string_column(col):
+    return col.dtype == "object" or isinstance(col.dtype, pd.CategoricalDtype)
+
+
+def as_object_columns(df):
+    # copy of df with any categorical columns converted back to plain object columns
+    categorical_cols = [x for x in df.columns if isinstance(df[x].dtype, pd.CategoricalDtype)]
+    if not categorical_cols:
+        return df
+    return df.astype({x: object for x in categorical_cols})
+
+
+def fits_float32(values):
+    # whether every value in a float64 array is exactly representable in float32
+    return np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True)
+
+
+def compact_columns(df, integers=False):
+    # the conversions described in compact_dtypes, without the report. The source files are read with 
+    # integers=False, since some of their integer columns (e.g. Oxford's dates) are reformatted later. 
+    # Modified in place.
+    for col in df.columns:
+        if col.lower() in CATEGORICAL_COLS or col.lower()[-9:] == "_combined":
+            if df[col].dtype == "object":
+                df[col] = df[col].astype("category")
+        elif df[col].dtype == np.float64:
+            if fits_float32(df[col].to_numpy()):
+                df[col] = df[col].astype(np.float32)
+        elif integers and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+
+
+def compact_dtypes(df):
+    """Convert the merged dataset to a more compact schema
+
+    Columns in CATEGORICAL_COLS, and the *_combined columns, repeat a handful of strings on every row, 
+    so they are stored as categoricals. Float columns are downcast to float32 wherever every value is 
+    exactly representable in float32 (no precision is lost), and integer columns to the smallest integer 
+    type that holds them. restore_output_dtypes undoes the float downcasting before export. By default the 
+    source files are already read with these types (see read_sources), so this mostly catches 
+    columns the merge turned back into plain values.
+
+    Args:
+        df (pandas DataFrame): merged dataset. Modified in place.
+    """
+    print("Compacting column types...", flush=True)
+    size_before = df.memory_usage(deep=True).sum()
+    compact_columns(df, integers=True)
+    size_after = df.memory_usage(deep=True).sum()
+    print(f"    {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB", flush=True)
+    print("\nDone\n", flush=True)
+
+
+def restore_output_dtypes(df):
+    # float32 values print differently from the same values as float64, so upcast before export
+    for col in df.columns:
+        if df[col].dtype == np.float32:
+            df[col] = df[col].astype(np.float64)
+
+
+def add_derived_columns(df, countries=None):
+    # computed in float64, whatever the input columns were downcast to. With --normalized the static 
+    # attributes aren't filled in on every row, so population comes from the countries table instead.
+    if countries is None:
+        population = df['population'].astype(np.float64)
+    else:
+        population = countries.set_index('countryname')['population'].reindex(df['countryname']).to_numpy(np.float64)
+    df['new_vaccinations_per_hundred'] = df['new_vaccinations'].astype(np.float64) / population * 100
+
+
+def current_rss():
+    # resident memory of this process, in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        # no /proc (e.g., on macOS), so fall back to the peak so far
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryMonitor:
+    """Tracks the peak resident memory of the process
+
+    A background thread samples the resident memory every `interval` seconds. Call `reset()` before 
+    a stage and `peak()` after it to get the peak seen while the stage ran.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            with self._lock:
+                self._peak = max(self._peak, rss)
+
+    def start(self):
+        self._peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def reset(self):
+        with self._lock:
+            self._peak = current_rss()
+
+    def peak(self):
+        rss = current_rss()
+        with self._lock:
+            self._peak = max(self._peak, rss)
+            return self._peak
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def frame_shape(obj):
+    # total rows and columns of a DataFrame, or of a list/dict of DataFrames; None for anything else
+    if isinstance(obj, pd.DataFrame):
+        return {"rows": obj.shape[0], "columns": obj.shape[1]}
+    frames = obj.values() if isinstance(obj, dict) else obj if isinstance(obj, (list, tuple)) else []
+    frames = [x for x in frames if isinstance(x, pd.DataFrame)]
+    if not frames:
+        return None
+    return {"rows": sum(x.shape[0] for x in frames), "columns": sum(x.shape[1] for x in frames)}
+
+
+def argument_signature(value):
+    # identity and layout of a stage's arguments: which objects they are, and for DataFrames their shape, 
+    # columns, types, and column arrays. Changes if a stage adds, drops, or replaces columns or rows, or 
+    # swaps the items of a dict or list, which is how the stages here modify their arguments.
+    if isinstance(value, pd.DataFrame):
+        arrays = tuple(value[col].to_numpy().__array_interface__['data'][0]
+                       if isinstance(value[col].dtype, np.dtype) else id(value[col].array) for col in value.columns)
+        return (id(value), value.shape, tuple(value.columns), tuple(map(str, value.dtypes)), arrays)
+    if isinstance(value, dict):
+        return (id(value), tuple((k, argument_signature(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (id(value), tuple(argument_signature(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (id(value), len(value))
+    return id(value)
+
+
+class StageCache:
+    """Content-addressed cache of the outputs of the pipeline's stages
+
+    A stage's key is a hash of its code (its source, plus the source of the functions and the values of 
+    the constants in this module that it uses, directly or indirectly), and of its arguments (including 
+    defaults). Files named by arguments, and DataFrames, are hashed by their contents. A DataFrame output 
+    by a stage is identified by that stage's key from then on, so a chain of stages is only hashed in full 
+    where it starts.
+
+    Outputs are pickled to `directory`, and the least recently used ones are deleted once the cache is 
+    larger than `max_mb` megabytes, both when it's opened and as outputs are added.
+
+    Args:
+        directory (str): where to keep the cached outputs
+        max_mb (float): maximum total size of the cache, in megabytes
+    """
+    def __init__(self, directory=STAGE_CACHE_DIR, max_mb=STAGE_CACHE_MAX_MB):
+        self.directory = directory
+        self.max_bytes = max_mb * 1e6
+        self._known = {}  # id of a DataFrame -> (weak reference to it, its identifier)
+        self._code = {}
+        self._files = {}  # (path, size, modification time) -> hash of the file's contents
+        os.makedirs(directory, exist_ok=True)
+        # in case the limit is smaller than it was on the last run
+        self.evict()
+
+    def code_fingerprint(self, func):
+        # source of the function and of whatever it uses from this module, walking through nested functions
+        if func in self._code:
+            return self._code[func]
+        parts = [f"{sys.version_info[:2]} pandas {pd.__version__} numpy {np.__version__}"]
+        seen = set()
+        pending = [func]
+        while pending:
+            f = pending.pop()
+            if f in seen:
+                continue
+            seen.add(f)
+            try:
+                parts.append(inspect.getsource(f))
+            except (OSError, TypeError):
+                parts.append(repr(f))
+            codes = [f.__code__]
+            while codes:
+                code = codes.pop()
+                codes.extend(x for x in code.co_consts if isinstance(x, types.CodeType))
+                for name in sorted(code.co_names):
+                    value = f.__globals__.get(name)
+                    if isinstance(value, (types.FunctionType, type)) and value.__module__ == func.__module__:
+                        pending.extend(x for x in ([value] if isinstance(value, types.FunctionType) else 
+                                                   vars(value).values()) if isinstance(x, types.FunctionType))
+                    elif isinstance(value, (str, int, float, list, tuple, dict, set)):
+                        parts.append(f"{name} = {value!r}")
+        self._code[func] = hashlib.sha256("\n".join(parts).encode()).hexdigest()
+        return self._code[func]
+
+    def _hash_value(self, value, h):
+        if isinstance(value, pd.DataFrame):
+            known = self._known.get(id(value))
+            if known is not None and known[0]() is value:
+                h.update(known[1].encode())
+                return
+            h.update(repr([(x, str(t)) for x, t in value.dtypes.items()]).encode())
+            h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        elif isinstance(value, dict):
+            h.update(b"{")
+            for k, v in value.items():
+                h.update(repr(k).encode())
+                self._hash_value(v, h)
+            h.update(b"}")
+        elif isinstance(value, (list, tuple)):
+            h.update(b"[")
+            for v in value:
+                self._hash_value(v, h)
+            h.update(b"]")
+        elif isinstance(value, (set, frozenset)):
+            h.update(repr(sorted(value, key=repr)).encode())
+        elif isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            signature = (os.path.abspath(value), stat.st_size, stat.st_mtime_ns)
+            if signature not in self._files:
+                self._files[signature] = file_sha256(value)
+            h.update(f"file {self._files[signature]}".encode())
+        else:
+            h.update(repr(value).encode())
+
+    def key(self, name, func, args, kwargs):
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        h = hashlib.sha256(f"{name} {self.code_fingerprint(func)}".encode())
+        self._hash_value(dict(bound.arguments), h)
+        return h.hexdigest()
+
+    def remember(self, value, key, path="out"):
+        # from now on, identify the DataFrames in a stage's output by the key of that stage
+        if isinstance(value, pd.DataFrame):
+            self._known[id(value)] = (weakref.ref(value), f"{key}:{path}")
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                self.remember(v, key, f"{path}.{k}")
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                self.remember(v, key, f"{path}.{i}")
+
+    def get(self, key):
+        # returns (True, output) on a hit, or (False, None)
+        filename = os.path.join(self.directory, key + ".pkl")
+        try:
+            with open(filename, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            os.remove(filename)
+            return False, None
+        os.utime(filename)  # mark it as recently used
+        return True, value
+
+    def put(self, key, value):
+        filename = os.path.join(self.directory, key + ".pkl")
+        with open(filename + ".part", "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + ".part", filename)
+        self.evict()
+
+    def evict(self):
+        # delete the least recently used outputs until the cache fits within its size limit
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, "*.pkl")):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(x[1] for x in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(filename)
+            total -= size
+
+
+class PipelineProfiler:
+    """Runs the pipeline's stages and records how long each took and how much data went through it
+
+    For each stage, `run` records the wall-clock and CPU time, the peak resident memory while it ran, and 
+    the rows and columns of its first argument (going in) and of its output (coming out). A stage's output 
+    is what it returns or, for stages that modify their first argument in place and return None, that 
+    argument; `run` returns it, so callers should always use the returned value.
+
+    With a `cache`, a stage whose code and inputs haven't changed since an earlier run isn't run again; 
+    its output is loaded from the cache instead. A stage that modifies any of its arguments other than the 
+    one it returns is never cached, since loading its output from the cache would skip that change.
+
+    Args:
+        profile (bool): also run each stage under cProfile, so the slowest stage's statistics can be saved
+        cache (StageCache, optional): cache of stage outputs. Defaults to None (no caching).
+    """
+    def __init__(self, profile=False, cache=None):
+        self.profile = profile
+        self.cache = cache
+        self.stages = []
+        self.started = datetime.now()
+        self._profiles = {}
+        self._memory = MemoryMonitor()
+        self._memory.start()
+
+    def run(self, name, func, *args, cacheable=True, **kwargs):
+        # stages with side effects (downloading, writing files) should be run with cacheable=False
+        shape_in = frame_shape(args[0]) if args else None
+        self._memory.reset()
+        wall, cpu = time.perf_counter(), time.process_time()
+        key = self.cache.key(name, func, args, kwargs) if self.cache is not None and cacheable else None
+        cached, output = self.cache.get(key) if key is not None else (False, None)
+        if not cached:
+            signatures = [argument_signature(x) for x in [*args, *kwargs.values()]] if key is not None else None
+            if self.profile:
+                profiler = cProfile.Profile()
+                output = profiler.runcall(func, *args, **kwargs)
+                self._profiles[len(self.stages)] = profiler
+            else:
+                output = func(*args, **kwargs)
+            if output is None and args:
+                output = args[0]
+            # A stage that modified any argument other than the one it returns would lose that side effect 
+            # on a cache hit, so its output is never cached
+            if key is not None:
+                if any(argument_signature(x) != signatures[i] and not (i == 0 and output is x) 
+                       for i, x in enumerate([*args, *kwargs.values()])):
+                    print(f"Warning: {name} modified its arguments, so its output wasn't cached", flush=True)
+                    key = None
+            if key is not None:
+                self.cache.put(key, output)
+        if key is not None:
+            self.cache.remember(output, key)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        shape_out = frame_shape(output)
+        if shape_out is None and args:
+            shape_out = frame_shape(args[0])
+        self.stages.append({"stage": name, "wall_seconds": round(wall, 4), "cpu_seconds": round(cpu, 4),
+                            "peak_rss": self._memory.peak(), "input": shape_in, "output": shape_out, 
+                            "cached": cached})
+        if cached:
+            print(f"{name}: loaded from the stage cache\n", flush=True)
+        return output
+
+    def stop(self):
+        self._memory.stop()
+
+    def slowest_stage(self):
+        return max(range(len(self.stages)), key=lambda i: self.stages[i]["wall_seconds"], default=None)
+
+    def write_report(self, filename, config=None):
+        report = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "config": config or {},
+            "total_wall_seconds": round(sum(x["wall_seconds"] for x in self.stages), 4),
+            "total_cpu_seconds": round(sum(x["cpu_seconds"] for x in self.stages), 4),
+            "peak_rss": max((x["peak_rss"] for x in self.stages), default=None),
+            "stages": self.stages,
+        }
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote run report to {filename}", flush=True)
+
+    def dump_slowest_profile(self, filename, top=20):
+        # saves the cProfile statistics for the slowest stage, and prints its most expensive calls
+        i = self.slowest_stage()
+        if i not in self._profiles:
+            return
+        stats = pstats.Stats(self._profiles[i])
+        stats.dump_stats(filename)
+        print(f'Slowest stage was {self.stages[i]["stage"]}; wrote its profile to {filename}', flush=True)
+        stats.sort_stats("cumulative").print_stats(top)
+
+    def print_report(self):
+        print("Stage timings:", flush=True)
+        print(f'    {"stage":<34} {"wall (s)":>9} {"cpu (s)":>9} {"peak MB":>9} {"rows in":>10} {"rows out":>10} '
+              f'{"cols in":>8} {"cols out":>8}', flush=True)
+        for stage in self.stages:
+            shape_in, shape_out = stage["input"] or {}, stage["output"] or {}
+            name = stage["stage"] + (" (cached)" if stage["cached"] else "")
+            print(f'    {name:<34} {stage["wall_seconds"]:>9.2f} {stage["cpu_seconds"]:>9.2f} '
+                  f'{stage["peak_rss"] / 1e6:>9.1f} {shape_in.get("rows", ""):>10} {shape_out.get("rows", ""):>10} '
+                  f'{shape_in.get("columns", ""):>8} {shape_out.get("columns", ""):>8}', flush=True)
+        if self.stages:
+            print(f'    Total: {sum(x["wall_seconds"] for x in self.stages):.2f} s, peak '
+                  f'{max(x["peak_rss"] for x in self.stages) / 1e6:.1f} MB\n', flush=True)
+
+
+def country_date_indices(countries, start_date, n_days, country_col, date_col):
+    # position of each row on the country x day grid, and whether it falls on the grid at all
+    country_idx = countries.get_indexer(country_col)
+    day_idx = (date_col - start_date).dt.days.to_numpy(dtype=np.float64)
+    on_grid = (country_idx >= 0) & (day_idx >= 0) & (day_idx < n_days)
+    day_idx = np.where(on_grid, day_idx, 0).astype(np.int64)
+    return country_idx, day_idx, on_grid
+
+
+def fill_cube(values, country_idx, day_idx, on_grid, n_countries, n_days, name):
+    """Place each row's values at its (country, day) position on a dense grid
+
+    Args:
+        values (numpy array): one row per input row, one column per variable
+        country_idx, day_idx, on_grid (numpy arrays): from country_date_indices
+        n_countries, n_days (int): grid dimensions
+        name (str): name of the dataset, for error messages
+
+    Returns:
+        (numpy array, numpy array): the (countries, days, variables) grid, with NaN where there's no row, 
+                                    and a (countries, days) mask of which grid cells have a row
+    """
+    counts = np.bincount(country_idx[on_grid] * n_days + day_idx[on_grid], minlength=n_countries * n_days)
+    if counts.max(initial=0) > 1:
+        raise RuntimeError(f"{name} has more than one row for the same country and date; "
+                           "use --merge-engine join")
+
+    cube = np.full((n_countries, n_days, values.shape[1]), np.nan, dtype=values.dtype)
+    cube[country_idx[on_grid], day_idx[on_grid]] = values[on_grid]
+    return cube, counts.reshape(n_countries, n_days) > 0
+
+
+def gather_from_cube(frame, columns, country_idx, day_idx, on_grid, n_countries, n_days, out_country, out_day, name):
+    # look up `columns` of `frame` for each output row, via a numeric grid and an object grid
+    numeric_cols = [x for x in columns if pd.api.types.is_numeric_dtype(frame[x])]
+    other_cols = [x for x in columns if x not in numeric_cols]
+
+    gathered = {}
+    present = None
+    for cols, dtype in [(numeric_cols, np.float64), (other_cols, object)]:
+        if not cols:
+            continue
+        cube, present = fill_cube(frame[cols].to_numpy(dtype=dtype), country_idx, day_idx, on_grid,
+                                  n_countries, n_days, name)
+        values = cube[out_country, out_day]
+        for i, col in enumerate(cols):
+            gathered[col] = values[:, i]
+            # integer columns stay integers if every row found a value, as they would in a join
+            if pd.api.types.is_integer_dtype(frame[col]) and not np.isnan(gathered[col]).any():
+                gathered[col] = gathered[col].astype(frame[col].dtype)
+
+    return gathered, present
+
+
+def merge_datasets_cube(datasets_dict, iso_filename=ISO_CODES_FILE):
+    """Merge the datasets, add ISO codes, and fill in static attributes, on a dense country x date grid
+
+    This produces the same result as merge_datasets, add_iso_codes, and update_filler_rows. Instead of 
+    joining on country names and dates, countries and dates are encoded as integer positions once, each 
+    dataset's values are placed on a (countries, days, variables) grid by direct index assignment, and 
+    the grids are read back at the positions of the Oxford rows.
+
+    Args:
+        datasets_dict (dict): the filtered owid, oxford, and oxford_nice datasets
+        iso_filename (str, optional): CSV of country names and ISO codes. Defaults to ISO_CODES_FILE.
+
+    Returns:
+        pandas DataFrame: the merged dataset
+    """
+    print("Merging the OWID and oxford datasets on a country x date grid...", flush=True)
+
+    owid = datasets_dict['owid']
+    oxford = datasets_dict['oxford']
+    oxford_nice = datasets_dict['oxford_nice']
+    iso_codes = pd.read_csv(iso_filename)
+
+    countries = pd.Index(pd.unique(oxford['countryname']))
+    start_date = oxford['date'].min()
+    n_days = (oxford['date'].max() - start_date).days + 1
+    n_countries = len(countries)
+    print(f"    Grid: {n_countries} countries x {n_days} days", flush=True)
+
+    ox_country, ox_day, ox_on_grid = country_date_indices(countries, start_date, n_days,
+                                                          oxford['countryname'], oxford['date'])
+
+    # an Oxford row is kept if it has a matching oxford_nice row and its country has an ISO code
+    nice_country, nice_day, nice_on_grid = country_date_indices(countries, start_date, n_days,
+                                                                oxford_nice['countryname'], oxford_nice['date'])
+    nice_values, nice_present = gather_from_cube(oxford_nice, OXFORD_NICE_COLS, nice_country, nice_day, nice_on_grid,
+                                                 n_countries, n_days, ox_country, ox_day, "oxford_nice")
+    if iso_codes['country'].duplicated().any():
+        raise RuntimeError(f"{iso_filename} has more than one row for the same country; use --merge-engine join")
+    has_iso = countries.isin(iso_codes['country'])
+
+    keep = ox_on_grid & nice_present[ox_country, ox_day] & has_iso[ox_country]
+    out_country = ox_country[keep]
+    out_day = ox_day[keep]
+    nice_values = {col: values[keep] for col, values in nice_values.items()}
+
+    owid_cols = [x for x in owid.columns if x != 'date']
+    owid_country, owid_day, owid_on_grid = country_date_indices(countries, start_date, n_days,
+                                                                owid['location'], owid['date'])
+    owid_values, _ = gather_from_cube(owid, owid_cols, owid_country, owid_day, owid_on_grid,
+                                      n_countries, n_days, out_country, out_day, "OWID")
+
+    #### static attributes: each country's max over its output rows (as in update_filler_rows)
+    in_output = np.zeros((n_countries, n_days), dtype=bool)
+    in_output[out_country, out_day] = True
+    for col in [x for x in FILLER_COLS if x in owid_values]:
+        grid = np.full((n_countries, n_days), np.nan, dtype=owid_values[col].dtype)
+        grid[out_country, out_day] = owid_values[col]
+        if grid.dtype == object:
+            # missing strings count as "", as in update_filler_rows
+            static = np.array([max(["" if pd.isna(x) else x for x in grid[i, in_output[i]]], default="")
+                               for i in range(n_countries)], dtype=object)
+        else:
+            static = np.fmax.reduce(np.where(in_output, grid, np.nan), axis=1)
+        owid_values[col] = static[out_country]
+
+    #### assemble the columns in the same order (and with the same suffixes) as the joins would
+    df = oxford[keep].reset_index(drop=True)
+    overlap = [x for x in owid_cols if x in df.columns]
+    df = df.rename(columns={x: x + "_x" for x in overlap})
+
+    # OWID's own iso_code (if it was read) becomes iso_code_x once the codes from iso_filename are added
+    columns = {}
+    for col in owid_cols:
+        if col == 'iso_code':
+            columns['iso_code_x'] = owid_values[col]
+        else:
+            columns[col + "_y" if col in overlap else col] = owid_values[col]
+    columns.update(nice_values)
+
+    country_iso = iso_codes.set_index('country')['iso_code'].reindex(countries).to_numpy()
+    columns['iso_code_y' if 'iso_code' in owid_cols else 'iso_code'] = country_iso[out_country]
+
+    df = pd.concat([df, pd.DataFrame(columns)], axis=1)
+
+    print(f"\nShape after merging: {df.shape}", flush=True)
+    print("\nDone\n", flush=True)
+    return df
+
+
+def find_previous_output(directory="."):
+    # output files are timestamped (covid_data_YYYYMMDD-HHMMSS.csv), so the latest one sorts last
+    files = sorted(glob.glob(os.path.join(directory, "covid_data_*.csv")))
+    return files[-1] if files else None
+
+
+def load_previous_output(filename):
+    print(f"Loading previous output {filename}...", end="", flush=True)
+    # round_trip so that values we keep are written back out exactly as they were read
+    previous = pd.read_csv(filename, float_precision="round_trip")
+    print("Done\n", flush=True)
+    return previous
+
+
+def read_output_chunks(filename, chunksize=SUMMARY_CHUNK_SIZE):
+    # an output file a chunk at a time, with its missing values as they were before it was written. to_csv 
+    # writes NaN as an empty field, but the static string attributes (e.g. continent) have "" for missing 
+    # (see update_filler_rows), which the summary counts as a value, so their empty fields are read as "".
+    columns = pd.read_csv(filename, nrows=0).columns
+    # round_trip so that the values are exactly those that were written (see load_previous_output)
+    static = pd.read_csv(filename, usecols=[x for x in FILLER_COLS if x in columns], 
+                         keep_default_na=False, na_values=[""], float_precision="round_trip")
+    strings = {x for x in static.columns if is_string_column(static[x])}
+    return pd.read_csv(filename, chunksize=chunksize, keep_default_na=False, 
+                       na_values={x: [""] for x in columns if x not in strings}, float_precision="round_trip")
+
+
+def static_values_by_country(df, country_col, cols=FILLER_COLS):
+    # one row per country with its static attributes, with missing strings as "" (as in update_filler_rows)
+    static = df[[country_col, *cols]].copy()
+    for col in cols:
+        if is_string_column(static[col]):
+            static[col] = static[col].astype(object).fillna("")
+    return static.groupby(country_col, observed=True).agg({x: 'max' for x in cols})
+
+
+def country_attributes(df):
+    """Dimension table for --normalized output: one row per country, with its ISO code and static attributes
+
+    Args:
+        df (pandas DataFrame): merged dataset, with ISO codes
+
+    Returns:
+        pandas DataFrame: countryname, iso_code, and the FILLER_COLS, with countries in the order they first appear in df
+    """
+    print("Collecting static country attributes...", end="", flush=True)
+    iso_col = 'iso_code_y' if 'iso_code_y' in df.columns else 'iso_code'
+    countries = static_values_by_country(df, 'countryname', [iso_col, *FILLER_COLS])
+    countries = countries.reindex(pd.unique(df['countryname'])).rename(columns={iso_col: 'iso_code'})
+    countries = countries.rename_axis('countryname').reset_index()
     print("Done\n", flush=True)
+    return countries
 
+
+def drop_static_columns(df):
+    # with --normalized, the static attributes and ISO codes are kept in the countries table instead
+    df.drop(columns=[x for x in df.columns if x in ['iso_code', 'iso_code_y', *FILLER_COLS]], inplace=True)
+
+
+def plan_incremental_refresh(datasets_dict, previous, window_days=INCREMENTAL_WINDOW_DAYS):
+    """Restrict the datasets to the rows that need to be reprocessed for an incremental refresh
+
+    Dates on or after the cutoff (`window_days` before the last date in the previous output) are 
+    reprocessed for every country. All dates are reprocessed for countries that are new, or whose 
+    static attributes (population, median_age, etc.) changed since the previous output.
+
+    Args:
+        datasets_dict (dict): the filtered owid, oxford, and oxford_nice datasets
+        previous (pandas DataFrame): the previous output
+        window_days (int, optional): number of trailing days to reprocess. Defaults to INCREMENTAL_WINDOW_DAYS.
+
+    Returns:
+        (dict, pandas Timestamp, set): the datasets, restricted to the rows being reprocessed; the cutoff date; 
+                                       and the countries being reprocessed in full
+    """
+    print("Planning incremental refresh...", flush=True)
+
+    owid = datasets_dict['owid']
+    oxford = datasets_dict['oxford']
+    oxford_nice = datasets_dict['oxford_nice']
+
+    cutoff = pd.to_datetime(previous['date']).max() - pd.to_timedelta(window_days, unit='d')
+    print(f'reprocessing dates from {cutoff} onward', flush=True)
+
+    new_static = static_values_by_country(owid, 'location')
+    old_static = static_values_by_country(previous, 'countryname')
+
+    changed_countries = set()
+    for country in oxford['countryname'].unique():
+        if country not in old_static.index:
+            changed_countries.add(country)
+        elif country in new_static.index and \
+                not new_static.loc[country].equals(old_static.loc[country]):
+            changed_countries.add(country)
+
+    print("Countries reprocessed in full (new, or static attributes changed):", flush=True)
+    print(sorted(changed_countries), flush=True)
+
+    keep_owid = (owid['date'] >= cutoff) | owid['location'].isin(changed_countries)
+    keep_oxford = (oxford['date'] >= cutoff) | oxford['countryname'].isin(changed_countries)
+    keep_oxford_nice = (oxford_nice['date'] >= cutoff) | oxford_nice['countryname'].isin(changed_countries)
+
+    print('Before drop:', flush=True)
+    print(f'    OWID: {owid.shape[0]} rows', flush=True)
+    print(f'    Oxford: {oxford.shape[0]} rows', flush=True)
+    print(f'    Oxford_nice: {oxford_nice.shape[0]} rows', flush=True)
+
+    print('Plan to drop:', flush=True)
+    print(f'    OWID: {(~keep_owid).sum()} rows', flush=True)
+    print(f'    Oxford: {(~keep_oxford).sum()} rows', flush=True)
+    print(f'    Oxford_nice: {(~keep_oxford_nice).sum()} rows', flush=True)
+
+    # a new dict rather than updating datasets_dict, so that the stage's whole effect is in what it returns
+    datasets_dict = {**datasets_dict, 'owid': owid[keep_owid], 'oxford': oxford[keep_oxford], 
+                     'oxford_nice': oxford_nice[keep_oxford_nice]}
+
+    print("\nDone\n", flush=True)
+    return datasets_dict, cutoff, changed_countries
+
+
+def restore_static_values(df, previous, changed_countries):
+    # In the trailing window some countries have no OWID rows at all, so update_filler_rows can't find 
+    # their static attributes. For countries whose attributes didn't change, use the previous output's.
+    print("Restoring static attributes from previous output...", end="", flush=True)
+    old_static = previous.groupby('countryname')[FILLER_COLS].first()
+    countries = df['countryname'].astype(object)
+    unchanged = ~countries.isin(changed_countries) & countries.isin(old_static.index)
+
+    for col in FILLER_COLS:
+        restored = countries.map(old_static[col])
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object).where(~unchanged, restored).astype("category")
+        else:
+            df[col] = df[col].where(~unchanged, restored)
+    print("Done\n", flush=True)
+
+
+def splice_incremental(previous, df, cutoff, changed_countries):
+    """Combine the reprocessed rows with the rows from the previous output that were not reprocessed
+
+    Args:
+        previous (pandas DataFrame): the previous output
+        df (pandas DataFrame): the reprocessed rows, ready for output
+        cutoff (pandas Timestamp): first date that was reprocessed for every country
+        changed_countries (set): countries that were reprocessed in full
+
+    Returns:
+        pandas DataFrame: the full output
+    """
+    print("Splicing reprocessed rows into previous output...", flush=True)
+
+    if list(previous.columns) != list(df.columns):
+        raise RuntimeError("The output columns have changed since the previous output; "
+                           "run a full refresh (without --incremental)")
+
+    # countries no longer in the data are dropped, along with everything that was reprocessed
+    countries = df['countryname'].unique()
+    keep = (pd.to_datetime(previous['date']) < cutoff) & previous['countryname'].isin(countries) & \
+        ~previous['countryname'].isin(changed_countries)
+
+    print(f'    Rows kept from previous output: {keep.sum()}', flush=True)
+    print(f'    Rows reprocessed: {df.shape[0]}', flush=True)
+
+    df = pd.concat([previous[keep], df], ignore_index=True)
+
+    # keep the same ordering as a full refresh: countries in their original order, then by date
+    order = pd.Categorical(df['countryname'], categories=countries)
+    df = df.iloc[np.lexsort((df['date'].to_numpy(), order.codes))].reset_index(drop=True)
+
+    print("\nDone\n", flush=True)
     return df
 
 
+def recode_column(col, recode_value):
+    """Recode a column through a lookup table built from its distinct values
+
+    The columns we recode only ever hold a handful of distinct codes (e.g., "0", "1G", "2T"), so rather
+    than calling `recode_value` on every row we call it once per distinct value and then map every row
+    through the resulting table using integer codes. Missing values are left untouched.
+
+    Args:
+        col (pandas Series): column to recode
+        recode_value (function): maps a single (non-missing) value to its recoded value
+
+    Returns:
+        pandas Series: recoded column, with the same index and name as `col`
+    """
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes = col.cat.codes.to_numpy()
+        uniques = col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col, use_na_sentinel=True)
+    table = np.empty(len(uniques), dtype=object)
+    table[:] = [recode_value(x) for x in uniques.tolist()]
+    has_value = codes >= 0
+
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # recode the categories, merging any that end up with the same value (e.g., 0.0 and "0")
+        table_codes, categories = pd.factorize(table, use_na_sentinel=True)
+        new_codes = np.full(len(codes), -1, dtype=table_codes.dtype)
+        new_codes[has_value] = table_codes[codes[has_value]]
+        return pd.Series(pd.Categorical.from_codes(new_codes, categories=categories), index=col.index, name=col.name)
+
+    values = col.to_numpy(dtype=object, copy=True)
+    values[has_value] = table[codes[has_value]]
+
+    return pd.Series(values, index=col.index, name=col.name)
+
+
+def add_g(x):
+    # these variables don't have a flag, so are applied to the whole country
+    if np.isnan(x):
+        return x
+    if x == 0:
+        return "0"
+    else:
+        return str(int(x)) + "G"
+
+
+def recode_h7(x):
+    # h7_combined uses "I" where the other variables use "G"
+    if not isinstance(x, str):
+        return np.nan
+    return x.replace("I", "G")
+
+
+def recode_e1(x):
+    # e1_combined uses "A" for "G" and "F" for "T"
+    if not isinstance(x, str):
+        return x
+    if x[1:] == "F":
+        return x[:1] + "T"
+    if x[1:] == "A":
+        return x[:1] + "G"
+    return x
+
+
 def recode_oxford_vars(df):
     print("Recoding Oxford variables...", end="", flush=True)
     ## re-code 4 oxford variables without flags, and 2 that have special variables
@@ -258,62 +1615,53 @@ def recode_oxford_vars(df):
     for col in cols:
         df[col + "_numeric"] = df[col]
 
-    def add_g(x):
-        if np.isnan(x):
-            return x
-        if x == 0:
-            return "0"
-        else:
-            return str(int(x)) + "G"
-
-    df[cols] = df[cols].applymap(add_g)
+    for col in cols:
+        df[col] = recode_column(df[col], add_g)
 
     #### now update e1_combined and h7_combined, which have special values
     # update h7_combined to set "I" = "G"; we will recode in a bit
-    df["h7_combined"] = df["h7_combined"].str.replace("I", "G")
+    df["h7_combined"] = recode_column(df["h7_combined"], recode_h7)
 
     # update e1_combined to set "1A" = "1G", "2A" = "2G", "1F" = "1T", "2F" = "2T"; we will recode in a bit
-    df.loc[df["e1_combined"].str.slice(1)=="F", "e1_combined"] = \
-        df.loc[df["e1_combined"].str.slice(1)=="F", "e1_combined"].str.slice(0, 1) + "T"
-
-    df.loc[df["e1_combined"].str.slice(1)=="A", "e1_combined"] = \
-        df.loc[df["e1_combined"].str.slice(1)=="A", "e1_combined"].str.slice(0, 1) + "G"
+    df["e1_combined"] = recode_column(df["e1_combined"], recode_e1)
 
     print("Done\n", flush=True)
 
 
-def recode_GT(df):
-    print("Recoding G/T variables...", flush=True)
-
+def recode_GT_value(x):
     ## Re-code from "G"/"T" to "National"/"Local" so alphabetic ordering matches numeric ordering
     # e.g., 2.5 is "3-Local" (was "3T") and 3.0 is "3-National" (was "3G")
+    if pd.isna(x) or x in ["0", "", "(missing)"]:
+        return x
+    if type(x) in [int, float]:  # h8_combined has 0.0
+        return str(round(x))
+    if x[-1:] == "G":
+        return x[:-1] + "-National"
+    elif x[-1:] == "T":
+        return x[:-1] + "-Local"
+    else:
+        raise RuntimeError(f"Issue with recoding variable: unexpected value {x!r} ({type(x).__name__})")
 
-    def recode(x):
-        try:
-            if pd.isna(x) or x in ["0", "", "(missing)"]:
-                return x
-            if type(x) in [int, float]:  # h8_combined has 0.0
-                return str(round(x))
-            if x[-1:] == "G":
-                return x[:-1] + "-National"
-            elif x[-1:] == "T":
-                return x[:-1] + "-Local"
-            else:
-                print([type(x), str(x)])
-                raise RuntimeError("Issue with recoding variable")
-        except:
-            print(x)
-            df.to_csv("failed_" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".csv", index=False)
-            raise
+
+def recode_GT(df):
+    print("Recoding G/T variables...", flush=True)
 
     cols = [x for x in df.columns if x[-9:]=="_combined"]
-    df[cols] = df[cols].applymap(recode)
+    for col in cols:
+        try:
+            df[col] = recode_column(df[col], recode_GT_value)
+        except RuntimeError as e:
+            # keep the data that failed, to find the rows with the unexpected value
+            filename = "failed_" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".csv"
+            df.to_csv(filename, index=False)
+            raise RuntimeError(f"{e} in {col} (data written to {filename})") from e
 
     for col in cols:
         print(df[col].value_counts(), flush=True)
 
     print("\nDone\n", flush=True)
 
+
 def drop_unnecessary_columns(df):
     print("Dropping unnecessary columns...", end="", flush=True)
 
@@ -336,7 +1684,8 @@ def drop_unnecessary_columns(df):
         'stringency_index',
     ]
 
-    df.drop(columns=cols_to_drop, inplace=True)
+    # some of these are never read in the first place (see UNUSED_COLS)
+    df.drop(columns=cols_to_drop, inplace=True, errors="ignore")
     print("Done\n", flush=True)
 
 
@@ -405,13 +1754,13 @@ def rename_columns(df):
     print("Done\n", flush=True)
 
 
-def add_iso_codes(df):
+def add_iso_codes(df, filename=ISO_CODES_FILE):
     #### Add ISO Codes (alpha-3)
     # This is for joining to mapbox vector data. ISO codes were taken from https://gist.github.com/tadast/8827699, 
     # and I merged them with our country names. There were some differences in country names, and a couple missing 
     # ISO codes in the github file (e.g., for Kosovo) which I filled in using google.
     print("Adding ISO codes...", flush=True)
-    iso_codes = pd.read_csv("countries_iso.csv")
+    iso_codes = pd.read_csv(filename)
     
     print(f"\nShape before adding ISO codes: {df.shape}", flush=True)
     df = df.merge(iso_codes, how="inner", left_on="countryname", right_on="country").drop(columns=["country"])
@@ -421,24 +1770,1045 @@ def add_iso_codes(df):
     return df
 
 
-def summarize_dataset(df, return_df=True, output_summary=True, filename=None):
+def segment_distances(points, a, b):
+    # distance from each of `points` to the line segment from a to b
+    ab = b - a
+    length2 = ab @ ab
+    if length2 == 0:
+        return np.sqrt(((points - a) ** 2).sum(axis=1))
+    t = np.clip(((points - a) @ ab) / length2, 0, 1)
+    return np.sqrt(((points - a - t[:, None] * ab) ** 2).sum(axis=1))
+
+
+def douglas_peucker_weights(points, min_tolerance=0.0):
+    """Douglas-Peucker simplification of a line, as a weight for each point
+
+    Simplifying with tolerance t keeps exactly the points whose weight is at least t, and the weights 
+    are nested (a point never outweighs the point that split its segment), so simplifications at several 
+    tolerances can all be cut from one set of weights. The end points are always kept. For a closed ring, 
+    the point farthest from the start and the point farthest from that chord are always kept as well, 
+    so that it stays a triangle at least.
+
+    Args:
+        points (numpy array): n x 2 coordinates
+        min_tolerance (float, optional): points that would only be kept below this tolerance all get 
+                                         weight 0, which saves working out their exact weights. Defaults to 0.
+
+    Returns:
+        numpy array: weight of each point
+    """
+    n = len(points)
+    weights = np.zeros(n)
+    weights[[0, -1]] = np.inf
+    kept = [0, n - 1]
+    if n > 3 and np.array_equal(points[0], points[-1]):
+        far = np.argmax(((points - points[0]) ** 2).sum(axis=1))
+        third = np.argmax(segment_distances(points, points[0], points[far]))
+        kept = sorted({0, far, third, n - 1})
+        weights[kept] = np.inf
+
+    stack = list(zip(kept[:-1], kept[1:]))
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        distances = segment_distances(points[a + 1:b], points[a], points[b])
+        i = np.argmax(distances)
+        if distances[i] < min_tolerance:
+            continue
+        i += a + 1
+        # the point that split this segment (the newer of its ends) has the smaller weight
+        weights[i] = min(distances[i - a - 1], weights[a], weights[b])
+        stack += [(a, i), (i, b)]
+    return weights
+
+
+def build_topology(geometry_file, dataset_iso_codes, iso_filename=ISO_CODES_FILE, levels=GEOMETRY_LEVELS, 
+                   quantization=TOPOLOGY_QUANTIZATION):
+    """Convert the country polygons to a topology of shared arcs, for write_topojson
+
+    Only countries in both countries_iso.csv and the final dataset (matched on the ISO_A3 property) are 
+    kept. Coordinates are snapped to a grid of `quantization` steps across the map, and each ring is cut 
+    at every point where it meets another ring (or itself) along a different path. A border between two 
+    countries is then stored once, as one arc, and simplified the same way for both, so no gaps or overlaps 
+    open up between them. Each arc's points are weighted for simplification (see douglas_peucker_weights).
+
+    Args:
+        geometry_file (str): GeoJSON file of country polygons, with an ISO_A3 property
+        dataset_iso_codes (set): ISO codes in the final dataset
+        iso_filename (str, optional): ISO codes file. Defaults to ISO_CODES_FILE.
+        levels (dict, optional): levels of detail that will be written. Defaults to GEOMETRY_LEVELS.
+        quantization (int, optional): grid steps across the map. Defaults to TOPOLOGY_QUANTIZATION.
+
+    Returns:
+        dict: "bbox" of the kept countries, "scale" (degrees per grid step in x and y), "arcs" (arrays of grid 
+              coordinates), "weights" (of each arc's points), and "countries" (ISO code and polygons, each a 
+              list of rings, each a list of arc numbers as in TopoJSON)
+    """
+    print("Building topology of country polygons...", flush=True)
+    with open(geometry_file) as f:
+        features = json.load(f)['features']
+    iso_codes = set(pd.read_csv(iso_filename)['iso_code']) & set(dataset_iso_codes)
+    kept = [x for x in features if x['geometry'] is not None and x['properties'].get('ISO_A3') in iso_codes]
+    print(f"    Keeping {len(kept)} of {len(features)} countries", flush=True)
+
+    # each feature as a list of polygons, each a list of rings
+    polygons = [[x['geometry']['coordinates']] if x['geometry']['type'] == 'Polygon' else x['geometry']['coordinates'] 
+                for x in kept]
+    rings = [np.asarray(ring, dtype=np.float64)[:, :2] for feature in polygons for polygon in feature for ring in polygon]
+    all_points = np.concatenate(rings)
+    x0, y0 = all_points.min(axis=0)
+    x1, y1 = all_points.max(axis=0)
+    scale = np.array([(x1 - x0) / (quantization - 1) or 1.0, (y1 - y0) / (quantization - 1) or 1.0])
+
+    # snap to the grid, and give each point a single integer key. Repeated points, including the 
+    # point that closes each ring, are dropped.
+    ring_keys = []
+    for ring in rings:
+        grid = np.round((ring - [x0, y0]) / scale).astype(np.int64)
+        keys = grid[:, 0] * quantization + grid[:, 1]
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+        if len(keys) > 1 and keys[-1] == keys[0]:
+            keys = keys[:-1]
+        ring_keys.append(keys if len(keys) >= 3 else None)
+
+    # junctions: points reached from different neighbours by different rings (or the same ring twice)
+    valid = [x for x in ring_keys if x is not None]
+    keys = np.concatenate(valid)
+    previous = np.concatenate([np.roll(x, 1) for x in valid])
+    following = np.concatenate([np.roll(x, -1) for x in valid])
+    neighbours = np.unique(np.stack([keys, np.minimum(previous, following), np.maximum(previous, following)], axis=1), 
+                           axis=0)
+    junction_keys, counts = np.unique(neighbours[:, 0], return_counts=True)
+    junction_keys = junction_keys[counts > 1]
+
+    arcs = []
+    arc_numbers = {}
+
+    def add_arc(arc):
+        # an arc already seen, in either direction, is reused; ~i refers to arc i reversed
+        forward = arc.tobytes()
+        if forward in arc_numbers:
+            return arc_numbers[forward]
+        backward = arc[::-1].tobytes()
+        if backward in arc_numbers:
+            return ~arc_numbers[backward]
+        arc_numbers[forward] = len(arcs)
+        arcs.append(arc)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring in ring_keys:
+        if ring is None:
+            ring_arcs.append(None)
+            continue
+        cuts = np.flatnonzero(np.isin(ring, junction_keys))
+        if len(cuts) == 0:
+            # one closed arc, starting from its smallest key, so that the same ring in another country 
+            # (e.g. an enclave, going the other way) is recognised
+            ring = np.roll(ring, -np.argmin(ring))
+            ring_arcs.append([add_arc(np.r_[ring, ring[:1]])])
+        else:
+            ring = np.roll(ring, -cuts[0])
+            cuts = cuts - cuts[0]
+            closed = np.r_[ring, ring[:1]]
+            ring_arcs.append([add_arc(closed[a:b + 1]) for a, b in zip(cuts, np.r_[cuts[1:], len(ring)])])
+
+    # each country's polygons, as lists of rings, each a list of arc numbers
+    countries = []
+    ring_arcs = iter(ring_arcs)
+    for feature, feature_polygons in zip(kept, polygons):
+        arc_polygons = [[next(ring_arcs) for _ in polygon] for polygon in feature_polygons]
+        # a polygon whose outer ring was too small for the grid is dropped, along with its holes
+        arc_polygons = [[x for x in polygon if x is not None] for polygon in arc_polygons if polygon[0] is not None]
+        countries.append((feature['properties']['ISO_A3'], arc_polygons))
+
+    arcs = [np.stack([x // quantization, x % quantization], axis=1) for x in arcs]
+    min_tolerance = min(tolerance for tolerance, _ in levels.values())
+    weights = [douglas_peucker_weights(x * scale, min_tolerance) for x in arcs]
+    print(f"    {len(all_points)} points -> {len(arcs)} arcs, {sum(len(x) for x in arcs)} points", flush=True)
+
+    print("\nDone\n", flush=True)
+    return {"bbox": [x0, y0, x1, y1], "scale": scale, "arcs": arcs, "weights": weights, "countries": countries}
+
+
+def write_topojson(topology, the_date, levels=GEOMETRY_LEVELS):
+    """Write the country polygons as quantized TopoJSON, at each level of detail
+
+    For each level, the arcs are simplified with the level's tolerance (in degrees), snapped to a grid of 
+    the level's number of steps across the map, and delta-encoded, as in the TopoJSON specification. Islands 
+    smaller than the level's grid are left out. The page can convert them back to GeoJSON with topojson-client 
+    (topojson.feature(topology, topology.objects.countries)). Each level is also written as 
+    country_polygons_<level>.topojson, which the page loads when there's no published manifest.
+
+    Args:
+        topology (dict): from build_topology
+        the_date (str): timestamp for the output filenames
+        levels (dict, optional): maps level name to (tolerance, quantization). Defaults to GEOMETRY_LEVELS.
+
+    Returns:
+        list: the timestamped files written, country_polygons_<level>_<date>.topojson
+    """
+    print("Writing TopoJSON...", flush=True)
+    x0, y0, x1, y1 = topology["bbox"]
+    filenames = []
+    for level, (tolerance, quantization) in levels.items():
+        scale = [(x1 - x0) / (quantization - 1) or 1.0, (y1 - y0) / (quantization - 1) or 1.0]
+        arcs = []
+        for arc, weights in zip(topology["arcs"], topology["weights"]):
+            grid = np.round(arc[weights >= tolerance] * topology["scale"] / scale).astype(np.int64)
+            grid = grid[np.r_[True, np.any(grid[1:] != grid[:-1], axis=1)]]
+            if len(grid) == 1:
+                grid = np.r_[grid, grid]
+            arcs.append(np.r_[grid[:1], np.diff(grid, axis=0)].tolist())
+
+        def ring_points(ring):
+            return sum(len(arcs[x if x >= 0 else ~x]) - 1 for x in ring)
+
+        # rings that have shrunk to a line or a point at this level are dropped (and with an outer ring, 
+        # its holes), and so are countries with nothing left
+        geometries = []
+        for iso_code, polygons in topology["countries"]:
+            polygons = [[x for x in polygon if ring_points(x) >= 3] for polygon in polygons 
+                        if ring_points(polygon[0]) >= 3]
+            if polygons:
+                geometries.append({"type": "Polygon" if len(polygons) == 1 else "MultiPolygon", 
+                                   "arcs": polygons[0] if len(polygons) == 1 else polygons, 
+                                   "properties": {"ISO_A3": iso_code}})
+
+        output = {"type": "Topology", "bbox": topology["bbox"], 
+                  "transform": {"scale": scale, "translate": [x0, y0]}, 
+                  "objects": {"countries": {"type": "GeometryCollection", "geometries": geometries}}, 
+                  "arcs": arcs}
+        filename = f"country_polygons_{level}_{the_date}.topojson"
+        text = json.dumps(output, separators=(",", ":"))
+        # the page loads the copy without the timestamp when nothing has been published
+        for name in [filename, f"country_polygons_{level}.topojson"]:
+            with open(name, "w") as f:
+                f.write(text)
+        filenames.append(filename)
+        print(f"    {level}: {len(geometries)} countries, {sum(len(x) for x in arcs)} points, "
+              f"{os.path.getsize(filename):,} bytes", flush=True)
+
+    print("\nDone\n", flush=True)
+    return filenames
+
+
+def compute_aggregates(df, countries=None, dictionary_file=DATA_DICTIONARY_FILE):
+    """Scale bounds for every numeric variable, so the site doesn't have to rescan the dataset for them
+
+    For each numeric variable in the data dictionary (and the numeric column of each ordinal variable), 
+    computes the overall min and max, the max on each date (for "Scale max to selected date"), the max 
+    for each country, and quantile breakpoints over all values (for the quantile color scale; linear 
+    interpolation, as in d3.quantile). Negative values are included; the site truncates them at zero.
+
+    Args:
+        df (pandas DataFrame): the final dataset, with dates formatted as strings
+        countries (pandas DataFrame, optional): country attributes table, if the static attributes 
+                                                aren't on every row of df (--normalized)
+        dictionary_file (str, optional): data dictionary. Defaults to DATA_DICTIONARY_FILE.
+
+    Returns:
+        dict: aggregates, ready to be written as JSON
+    """
+    print("Computing aggregates...", end="", flush=True)
+    dictionary = pd.read_csv(dictionary_file, keep_default_na=False)
+    variables = [*dictionary.loc[dictionary['data_type'] == "numeric", 'variable_name'],
+                 *[x for x in dictionary['numeric_column'] if x]]
+
+    values = {}
+    for col in variables:
+        if col in df.columns:
+            values[col] = df[col].astype(np.float64).to_numpy()
+        elif countries is not None and col in countries.columns:
+            values[col] = countries.set_index('countryname')[col].reindex(df['countryname']).to_numpy(np.float64)
+    values = pd.DataFrame(values, index=df.index)
+
+    by_date = values.groupby(df['date']).max()
+    by_country = values.groupby(df['countryname'].astype(object), sort=False).max()
+    quantiles = values.quantile(AGGREGATE_QUANTILES)
+
+    def to_list(x):
+        return [None if pd.isna(v) else float(v) for v in x]
+
+    aggregates = {
+        "dates": list(by_date.index),
+        "countries": list(by_country.index),
+        "quantiles": AGGREGATE_QUANTILES,
+        "variables": {col: {"min": to_list([values[col].min()])[0],
+                            "max": to_list([values[col].max()])[0],
+                            "max_by_date": to_list(by_date[col]),
+                            "max_by_country": to_list(by_country[col]),
+                            "quantiles": to_list(quantiles[col])}
+                      for col in values.columns},
+    }
+
+    print("Done\n", flush=True)
+    return aggregates
+
+
+def format_dates(df):
+    print("Formatting dates for output...", end="", flush=True)
+    #### Re-encode dates as string for output to CSV
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+    print("Done\n", flush=True)
+
+
+def write_parquet(df, filename):
+    # for downstream analytics; needs pyarrow (or fastparquet), which the rest of the pipeline doesn't
+    print(f"Writing {filename}...", end="", flush=True)
+    try:
+        as_object_columns(df).to_parquet(filename, index=False)
+    except ImportError:
+        print("skipped (install pyarrow to write Parquet files)\n", flush=True)
+        return
+    print(f"Done ({os.path.getsize(filename):,} bytes)\n", flush=True)
+
+
+def write_web_bundle(df, basename, countries=None, dictionary_file=DATA_DICTIONARY_FILE):
+    """Write the dataset as a binary bundle of typed arrays for the web page, plus a JSON manifest
+
+    Each variable in the data dictionary is stored as one little-endian array. Daily variables are laid 
+    out date-major (value for date d and country c is at index d * n_countries + c), with NaN for missing 
+    values; static (per-country) variables have one value per country. Numeric variables are float32 
+    where that loses no precision and float64 otherwise. Ordinal variables are stored as codes into the 
+    sorted list of categories given in the manifest, with the largest value of the type (its 
+    "missing_code") for missing: uint8 for up to 255 categories, and uint16 beyond that (up to 65,535). 
+    Their numeric columns are stored as floats. In the browser, each array is a view on the downloaded buffer, e.g. 
+    `new Float32Array(buffer, offset, length)`, so no parsing is needed.
+
+    Args:
+        df (pandas DataFrame): the final dataset
+        basename (str): output path without extension; writes basename.bin and basename.json
+        countries (pandas DataFrame, optional): country attributes table, if the static attributes 
+                                                aren't on every row of df (--normalized)
+        dictionary_file (str, optional): data dictionary. Defaults to DATA_DICTIONARY_FILE.
+    """
+    print("Writing web bundle...", end="", flush=True)
+    dictionary = pd.read_csv(dictionary_file, keep_default_na=False)
+
+    dates = np.sort(df['date'].unique())
+    country_names = pd.Index(pd.unique(df['countryname']))
+    if countries is None:
+        countries = df.drop_duplicates('countryname')
+    countries = countries.set_index('countryname').reindex(country_names)
+
+    country_idx = country_names.get_indexer(df['countryname'])
+    date_idx = pd.Index(dates).get_indexer(df['date'])
+    n_countries, n_dates = len(country_names), len(dates)
+
+    buffer = io.BytesIO()
+    variables = []
+    missing = []
+
+    def add_array(values):
+        # align each array to 8 bytes, so the browser can make a typed array view on it
+        buffer.write(b"\0" * (-buffer.tell() % 8))
+        offset = buffer.tell()
+        buffer.write(values.tobytes())
+        return {"dtype": values.dtype.name, "offset": offset, "length": len(values)}
+
+    def float_array(values):
+        values = np.asarray(values, dtype=np.float64)
+        return values.astype("<f4") if fits_float32(values) else values.astype("<f8")
+
+    def daily_grid(col):
+        grid = np.full(n_dates * n_countries, np.nan)
+        grid[date_idx * n_countries + country_idx] = df[col].to_numpy(dtype=np.float64)
+        return grid
+
+    for _, row in dictionary.iterrows():
+        col = row['variable_name']
+        if row['data_type'] not in ["numeric", "ordinal"]:
+            continue
+        if col not in df.columns and col not in countries.columns:
+            missing.append(col)
+            continue
+
+        entry = {x: row[x] for x in ['variable_name', 'display_name', 'category', 'data_type', 'larger_is']}
+        entry['sort_order'] = int(row['sort_order'])
+
+        if col in FILLER_COLS:
+            entry['layout'] = "country"
+            entry.update(add_array(float_array(countries[col])))
+        elif row['data_type'] == "numeric":
+            entry['layout'] = "date-major"
+            entry.update(add_array(float_array(daily_grid(col))))
+        else:
+            entry['layout'] = "date-major"
+            categories = sorted(str(x) for x in pd.unique(df[col].dropna()))
+            # the type's largest value is left for missing
+            dtype = np.uint8 if len(categories) < 255 else np.uint16
+            if len(categories) >= np.iinfo(np.uint16).max:
+                raise RuntimeError(f"{col} has {len(categories):,} categories, too many to store as codes")
+            missing_code = np.iinfo(dtype).max
+            codes = np.full(n_dates * n_countries, missing_code, dtype=dtype)
+            row_codes = pd.Index(categories).get_indexer(df[col].astype(str))
+            codes[date_idx * n_countries + country_idx] = np.where((row_codes >= 0) & df[col].notna(), row_codes, 
+                                                                   missing_code)
+            entry['categories'] = categories
+            entry['missing_code'] = int(missing_code)
+            entry.update(add_array(codes))
+            if row['numeric_column']:
+                entry['numeric_column'] = {"variable_name": row['numeric_column'],
+                                           **add_array(float_array(daily_grid(row['numeric_column'])))}
+        variables.append(entry)
+
+    manifest = {
+        "data_file": os.path.basename(basename) + ".bin",
+        "dates": [str(x) for x in dates],
+        "countries": [{"countryname": name,
+                       "iso_code": None if pd.isna(countries.loc[name, 'iso_code']) else countries.loc[name, 'iso_code'],
+                       "continent": None if pd.isna(countries.loc[name, 'continent']) else countries.loc[name, 'continent']}
+                      for name in country_names],
+        "variables": variables,
+    }
+
+    with open(basename + ".bin", "wb") as f:
+        f.write(buffer.getbuffer())
+    with open(basename + ".json", "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+    print(f"Done ({os.path.getsize(basename + '.bin'):,} + {os.path.getsize(basename + '.json'):,} bytes)", flush=True)
+    if missing:
+        print(f"    Variables in the data dictionary but not in the dataset: {missing}", flush=True)
+    print("", flush=True)
+
+
+def file_sha256(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_shards(df, directory, countries=None, dictionary_file=DATA_DICTIONARY_FILE):
+    """Write the dataset as one small CSV per variable, so the site can load only the variable on display
+
+    `_identity.csv` has the countryname, iso_code, and date of every row, and each variable's shard has 
+    that variable's values in the same row order (ordinal variables also include their numeric column). 
+    `manifest.json` lists every shard with its columns, size in bytes, and SHA-256 hash.
+
+    Args:
+        df (pandas DataFrame): the final dataset
+        directory (str): directory to write the shards to
+        countries (pandas DataFrame, optional): country attributes table, if the static attributes 
+                                                aren't on every row of df (--normalized)
+        dictionary_file (str, optional): data dictionary. Defaults to DATA_DICTIONARY_FILE.
+    """
+    print(f"Writing shards to {directory}...", end="", flush=True)
+    os.makedirs(directory, exist_ok=True)
+    dictionary = pd.read_csv(dictionary_file, keep_default_na=False)
+
+    def column(col):
+        if col in df.columns:
+            return df[col].reset_index(drop=True)
+        # static attribute from the countries table, repeated for each of the country's rows
+        return pd.Series(countries.set_index('countryname')[col].reindex(df['countryname']).to_numpy(), name=col)
+
+    def write_shard(name, cols):
+        filename = name + ".csv"
+        pd.concat([column(x) for x in cols], axis=1).to_csv(os.path.join(directory, filename), index=False)
+        return {"file": filename, "columns": cols, "bytes": os.path.getsize(os.path.join(directory, filename)),
+                "sha256": file_sha256(os.path.join(directory, filename))}
+
+    manifest = {"rows": len(df),
+                "identity": write_shard("_identity", ['countryname', 'iso_code', 'date']),
+                "shards": {}}
+
+    missing = []
+    for _, row in dictionary.iterrows():
+        col = row['variable_name']
+        if col in ['countryname', 'iso_code', 'date']:
+            continue
+        if col not in df.columns and (countries is None or col not in countries.columns):
+            missing.append(col)
+            continue
+        cols = [col, row['numeric_column']] if row['numeric_column'] else [col]
+        manifest["shards"][col] = write_shard(col, cols)
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    total = manifest["identity"]["bytes"] + sum(x["bytes"] for x in manifest["shards"].values())
+    print(f"Done ({len(manifest['shards'])} shards, {total:,} bytes)", flush=True)
+    if missing:
+        print(f"    Variables in the data dictionary but not in the dataset: {missing}", flush=True)
+    print("", flush=True)
+
+
+def export_outputs(df, the_date, countries=None, aggregates=None, binary=False, shards=False):
+    # writes the final dataset (and any of the optional outputs that were asked for); returns the main output file
+    restore_output_dtypes(df)
+    if countries is not None:
+        restore_output_dtypes(countries)
+        countries.to_csv(f'covid_countries_{the_date}.csv', index=False)
+        df.to_csv(f'covid_daily_{the_date}.csv', index=False)
+        print(f"Wrote covid_countries_{the_date}.csv ({os.path.getsize(f'covid_countries_{the_date}.csv'):,} bytes) "
+              f"and covid_daily_{the_date}.csv ({os.path.getsize(f'covid_daily_{the_date}.csv'):,} bytes)\n", flush=True)
+        output_file = f'covid_daily_{the_date}.csv'
+    else:
+        df.to_csv(f'covid_data_{the_date}.csv', index=False)
+        output_file = f'covid_data_{the_date}.csv'
+    if binary:
+        write_parquet(df, f'covid_{"daily" if countries is not None else "data"}_{the_date}.parquet')
+        if countries is not None:
+            write_parquet(countries, f'covid_countries_{the_date}.parquet')
+        write_web_bundle(df, f'covid_web_{the_date}', countries)
+    if shards:
+        write_shards(df, f'covid_shards_{the_date}', countries)
+    if aggregates is not None:
+        with open(f'covid_aggregates_{the_date}.json', "w") as f:
+            json.dump(aggregates, f, separators=(",", ":"))
+    return output_file
+
+
+def process_partition(datasets_dict, compact=True):
+    # one country's rows, through the same stages as a full run (see __main__); returns the rows to output
+    df = merge_datasets(datasets_dict)
+    df = add_iso_codes(df)
+    if len(df) == 0:  # no ISO code for this country
+        return df
+    if compact:
+        compact_dtypes(df)
+    df = update_filler_rows(df)
+    recode_oxford_vars(df)
+    recode_GT(df)
+    add_derived_columns(df)
+    drop_unnecessary_columns(df)
+    rename_columns(df)
+    format_dates(df)
+    restore_output_dtypes(df)
+    return df
+
+
+def process_regional_partition(datasets_dict, compact=True):
+    # one country's regional rows. OWID's variables are national, so only the policy variables are kept, 
+    # with the region's name and code after the country's name.
+    oxford_nice = datasets_dict['oxford_nice'][['countryname', 'regionname', 'date', *OXFORD_NICE_COLS]]
+    df = datasets_dict['oxford'].merge(oxford_nice, on=['countryname', 'regionname', 'date'])
+    df = add_iso_codes(df)
+    if len(df) == 0:
+        return df
+    if compact:
+        compact_dtypes(df)
+    regions = df[['regionname', 'regioncode']]
+    recode_oxford_vars(df)
+    recode_GT(df)
+    drop_unnecessary_columns(df)
+    rename_columns(df)
+    df.insert(1, 'regionname', regions['regionname'])
+    df.insert(2, 'regioncode', regions['regioncode'])
+    format_dates(df)
+    restore_output_dtypes(df)
+    return df
+
+
+def write_partitioned_outputs(spilled, the_date, keep_regional=False, compact=True):
+    """Run each country's partition through the pipeline's stages, appending the results to the output
+
+    Only one country's rows are in memory at a time, so peak memory depends on the largest partition rather 
+    than on the whole dataset. The output is the same as a full run's, as long as each country's rows are 
+    together in the Oxford dataset (they are); otherwise its rows come out grouped by country. The stages' 
+    own progress messages are not shown.
+
+    Args:
+        spilled (dict): partition files and column types, from spill_partitions
+        the_date (str): timestamp for the output filenames
+        keep_regional (bool, optional): whether to also write the regional rows, to covid_regional_*.csv. 
+                                        Defaults to False.
+        compact (bool, optional): whether to compact each partition's column types (see compact_dtypes)
+
+    Returns:
+        dict: the number of rows written to each file (covid_data_*.csv, then covid_regional_*.csv)
+    """
+    print("Processing partitions...", flush=True)
+    partitions, schemas = spilled["partitions"], spilled["schemas"]
+
+    def load(files, name):
+        schema = schemas.get(name, schemas.get(name.replace('_regional', '')))
+        return load_partition(files.get(name), schema)
+
+    outputs = {'national': f'covid_data_{the_date}.csv'}
+    if keep_regional:
+        outputs['regional'] = f'covid_regional_{the_date}.csv'
+    columns = {}
+    rows = dict.fromkeys(outputs, 0)
+    largest = 0
+    for i, (country, files) in enumerate(partitions.items()):
+        frames = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            if 'oxford' in files:
+                frames['national'] = process_partition(
+                    {name: load(files, name) for name in ['owid', 'oxford', 'oxford_nice']}, compact)
+            if keep_regional and 'oxford_regional' in files:
+                frames['regional'] = process_regional_partition(
+                    {name: load(files, name + '_regional') for name in ['oxford', 'oxford_nice']}, compact)
+        for kind, df in frames.items():
+            largest = max(largest, len(df))
+            rows[kind] += len(df)
+            if len(df) == 0:
+                continue
+            if kind in columns:
+                df[columns[kind]].to_csv(outputs[kind], mode="a", header=False, index=False)
+            else:
+                columns[kind] = df.columns
+                df.to_csv(outputs[kind], index=False)
+        print(f"    {i + 1}/{len(partitions)} {country}: " + 
+              ", ".join(f"{len(df)} {kind} rows" for kind, df in frames.items()), flush=True)
+
+    for kind, filename in outputs.items():
+        if kind not in columns:  # nothing to write
+            open(filename, "w").close()
+        print(f"Wrote {filename} ({rows[kind]} rows, {os.path.getsize(filename):,} bytes)", flush=True)
+    print(f"Largest partition: {largest} rows", flush=True)
+    print("\nDone\n", flush=True)
+    return {filename: rows[kind] for kind, filename in outputs.items()}
+
+
+def write_atomically(filename, write):
+    # write(f) writes the contents to a temporary file next to `filename`, which then replaces it in one step, 
+    # so readers see either the old file or the whole new one
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".publishing-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, 0o644)
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def copy_to(source, compress=None):
+    # a writer for write_atomically: copies `source`, optionally through gzip or brotli
+    def write(f):
+        with open(source, "rb") as src:
+            if compress == "gzip":
+                # mtime=0, so the same file always compresses to the same bytes
+                with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as out:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+            elif compress == "br":
+                compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+                for block in iter(lambda: src.read(1024 * 1024), b""):
+                    f.write(compressor.process(block))
+                f.write(compressor.finish())
+            else:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+    return write
+
+
+def manifest_paths(manifest):
+    # every file a manifest refers to, including the compressed variants
+    paths = set()
+    for entry in (manifest or {}).get("files", {}).values():
+        paths.add(entry["path"])
+        paths.update(entry[x]["path"] for x in ["gzip", "br"] if x in entry)
+    return paths
+
+
+def publish_outputs(files, directory="."):
+    """Publish outputs for the site under content-hashed names, listed in a manifest that's swapped in atomically
+
+    Each file is published as <name>.<hash>.<ext>, where the hash is the first 16 hex digits of its SHA-256. 
+    Next to it go precompressed <name>.<hash>.<ext>.gz and (if the brotli package is installed) .br 
+    variants, for servers that can send them as they are (e.g. nginx's gzip_static and brotli_static), 
+    except for files that are compressed already (COMPRESSED_EXTENSIONS). A file's name changes whenever 
+    its contents do, so published files can be cached indefinitely (Cache-Control: immutable), and a file 
+    that hasn't changed since the last publish keeps its name and isn't written again. Everything is written under a temporary name and renamed into place, and 
+    manifest.json, which the page fetches first, is replaced last, so the page sees either the old set of 
+    files or the new one. The files of the previous manifest are kept, for pages that fetched it just 
+    before the swap; older ones are deleted. A web bundle's JSON is published with its data_file naming the 
+    published copy of its .bin, which has to be published with it.
+
+    Args:
+        files (dict): maps the published name (e.g. covid_data.csv) to the file to publish
+        directory (str, optional): where to publish. Defaults to the current directory.
+
+    Returns:
+        dict: the new manifest
+    """
+    print(f"Publishing to {os.path.abspath(directory)}...", flush=True)
+    os.makedirs(directory, exist_ok=True)
+    manifest_file = os.path.join(directory, "manifest.json")
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)
+
+    entries = {}
+
+    def publish(name, source):
+        digest = file_sha256(source)
+        stem, extension = os.path.splitext(name)
+        path = f"{stem}.{digest[:16]}{extension}"
+        entry = {"path": path, "bytes": os.path.getsize(source), "sha256": digest}
+        variants = [(None, path)]
+        if extension not in COMPRESSED_EXTENSIONS:
+            variants.append(("gzip", path + ".gz"))
+            if brotli is not None:
+                variants.append(("br", path + ".br"))
+        written = []
+        for compress, variant in variants:
+            target = os.path.join(directory, variant)
+            # the name is the contents' hash, and files are only ever renamed into place whole, so an 
+            # existing file is already right
+            if not os.path.exists(target):
+                write_atomically(target, copy_to(source, compress))
+                written.append(variant)
+            if compress is not None:
+                entry[compress] = {"path": variant, "bytes": os.path.getsize(target)}
+        entries[name] = entry
+        print(f"    {name} -> {path} ({entry['bytes']:,} bytes"
+              f"{', gzip ' + format(entry['gzip']['bytes'], ',') if 'gzip' in entry else ''}"
+              f"{', brotli ' + format(entry['br']['bytes'], ',') if 'br' in entry else ''}): "
+              f"{'written' if written else 'unchanged'}", flush=True)
+
+    # a web bundle's JSON names the .bin written next to it (see write_web_bundle), so it's published after 
+    # the other files, with that name replaced by the .bin's published copy
+    bundles = {}
+    for name, source in files.items():
+        if name.endswith(".json"):
+            with open(source) as f:
+                contents = json.load(f)
+            if isinstance(contents, dict) and "data_file" in contents:
+                bundles[name] = contents
+    for name, source in files.items():
+        if name not in bundles:
+            publish(name, source)
+    published = {os.path.basename(files[name]): entry["path"] for name, entry in entries.items()}
+    for name, contents in bundles.items():
+        if contents["data_file"] not in published:
+            raise RuntimeError(f"{name} refers to {contents['data_file']}, which isn't being published")
+        contents["data_file"] = published[contents["data_file"]]
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=".publishing-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(contents, f, separators=(",", ":"))
+            publish(name, temp)
+        finally:
+            os.remove(temp)
+
+    manifest = {"published": datetime.now().isoformat(timespec="seconds"), 
+                "files": {name: entries[name] for name in files}, 
+                "previous": sorted(manifest_paths(previous))}
+    write_atomically(manifest_file, lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    # files from two publishes ago, which no current page can still be loading
+    keep = manifest_paths(manifest) | manifest_paths(previous)
+    stale = [x for x in (previous or {}).get("previous", []) if x not in keep]
+    for path in stale:
+        if os.path.exists(os.path.join(directory, path)):
+            os.remove(os.path.join(directory, path))
+    if brotli is None:
+        print("    (install brotli to also write .br files)", flush=True)
+    print(f"    Removed {len(stale)} files from earlier publishes", flush=True)
+    print("\nDone\n", flush=True)
+    return manifest
+
+
+class QuantileSketch:
+    """Approximate quantiles of a stream of numbers, in bounded memory (a simplified KLL sketch)
+
+    Values are kept in levels, where each value at level i stands for 2**i of the original values. When 
+    a level holds more than `k` values, they are sorted and every other one (starting at random from the 
+    first or second) is promoted to the next level. Until that first happens, the quantiles are exact 
+    (the same as describe()'s), so a sketch with `k` at least the number of values is exact.
+    """
+    def __init__(self, k=QUANTILE_SKETCH_SIZE, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # an odd value out stays at this level
+                keep, items = items[len(items) - len(items) % 2:], items[:len(items) - len(items) % 2]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self._rng.integers(2)::2]])
+                self.levels[level] = keep
+            level += 1
+
+    def quantiles(self, qs):
+        if len(self.levels) == 1:
+            if len(self.levels[0]) == 0:
+                return [np.nan] * len(qs)
+            return list(np.percentile(self.levels[0], [q * 100 for q in qs]))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(x), 2.0 ** i) for i, x in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        values, cum_weights = values[order], np.cumsum(weights[order])
+        positions = np.searchsorted(cum_weights, [q * (cum_weights[-1] - 1) + 1 for q in qs])
+        return list(values[np.minimum(positions, len(values) - 1)])
+
+
+class DistinctCounter:
+    """Approximate count of the distinct values in a stream
+
+    The hashes of the values are kept exactly until there are more than `exact_limit` of them, and from 
+    then on folded into a HyperLogLog sketch with 2**p registers (about 1% error for p=14).
+    """
+    def __init__(self, p=14, exact_limit=DISTINCT_EXACT_LIMIT):
+        self.p = p
+        self.exact_limit = exact_limit
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.registers = None
+
+    def update(self, values):
+        hashes = pd.util.hash_array(np.asarray(values, dtype=object), categorize=False)
+        if self.registers is None:
+            self.hashes = np.union1d(self.hashes, hashes)
+            if len(self.hashes) <= self.exact_limit:
+                return
+            hashes, self.hashes = self.hashes, None
+            self.registers = np.zeros(2 ** self.p, dtype=np.uint8)
+        # the first p bits pick the register, which keeps the longest run of leading zeros in the rest
+        bits = 64 - self.p
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        rank = (bits + 1 - np.frexp(rest.astype(np.float64))[1]).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)  # small-range correction
+        return int(round(estimate))
+
+
+class ColumnSummary:
+    """One-pass summary of a single column, fed a chunk of rows at a time
+
+    Numeric columns get a count, mean, standard deviation, minimum, maximum, and quartiles (from a 
+    QuantileSketch); anything else gets a count, a count of distinct values (from a DistinctCounter), and 
+    the most frequent value. Counts of the values are kept exactly until there are more than 
+    `TOP_VALUES_LIMIT` distinct values, and after that only for the most frequent ones, so the most 
+    frequent value may then be approximate.
+    """
+    def __init__(self, dtype, sketch_size=QUANTILE_SKETCH_SIZE):
+        self.dtype = dtype
+        self.sketch_size = sketch_size
+        self.is_datetime = pd.api.types.is_datetime64_any_dtype(dtype)
+        self.is_numeric = self.is_datetime or (pd.api.types.is_numeric_dtype(dtype) and 
+                                               not pd.api.types.is_bool_dtype(dtype))
+        self.rows = 0
+        self.count = 0
+        if self.is_numeric:
+            self.total = 0.0
+            self.mean = 0.0
+            self.m2 = 0.0
+            self.min = np.inf
+            self.max = -np.inf
+            self.sketch = QuantileSketch(sketch_size)
+        else:
+            self.distinct = DistinctCounter()
+            self.counts = pd.Series(dtype=np.int64)
+            self.category_counts = None
+
+    def update(self, col):
+        self.rows += len(col)
+        if self.is_numeric:
+            with np.errstate(invalid="ignore", over="ignore"):  # infinite values give a NaN std, as in describe()
+                self._update_numeric(col)
+        elif isinstance(col.dtype, pd.CategoricalDtype) and self.counts.empty and (
+                self.category_counts is None or col.cat.categories.equals(self.categories)):
+            self._update_categories(col)
+        else:
+            if self.category_counts is not None:
+                # a chunk with different categories, so count by value from here on
+                self._categories_to_counts()
+            self._update_values(col)
+
+    def _update_categories(self, col):
+        # count the category codes directly, remembering where each category first appeared for ties
+        codes = col.cat.codes.to_numpy()
+        if self.category_counts is None:
+            self.categories = col.cat.categories
+            self.category_counts = np.zeros(len(self.categories), dtype=np.int64)
+            self.first_seen = np.full(len(self.categories), np.iinfo(np.int64).max)
+        present = codes >= 0
+        self.count += np.count_nonzero(present)
+        self.category_counts += np.bincount(codes[present], minlength=len(self.categories))
+        seen, first = np.unique(codes[present], return_index=True)
+        self.first_seen[seen] = np.minimum(self.first_seen[seen], first + self.rows - len(col))
+
+    def _categories_to_counts(self):
+        order = np.argsort(self.first_seen, kind="stable")
+        order = order[self.category_counts[order] > 0]
+        self.counts = pd.Series(self.category_counts[order], index=self.categories[order].astype(object))
+        self.distinct.update(self.counts.index.to_numpy())
+        self.category_counts = None
+
+    def _update_values(self, col):
+        # in order of first appearance, so that ties for the most frequent value go the same way as describe()
+        codes, uniques = pd.factorize(col.astype(object) if not pd.api.types.is_object_dtype(col.dtype) else col)
+        codes = codes[codes >= 0]
+        self.count += len(codes)
+        if len(codes) == 0:
+            return
+        self.distinct.update(uniques)
+        counts = pd.Series(np.bincount(codes, minlength=len(uniques)), index=uniques)
+        self.counts = pd.concat([self.counts, counts]).groupby(level=0, sort=False).sum()
+        if len(self.counts) > TOP_VALUES_LIMIT:
+            self.counts = self.counts[self.counts.rank(method="first", ascending=False) <= TOP_VALUES_LIMIT]
+
+    def _update_numeric(self, col):
+        if self.is_datetime:
+            values = col.to_numpy(dtype="datetime64[ns]").view(np.int64).astype(np.float64)
+            values[col.isna().to_numpy()] = np.nan
+        else:
+            values = col.to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(values)
+        n = len(values) - np.count_nonzero(missing)
+        if n == 0:
+            return
+        # summed with the missing values as zeros, the same way pandas does
+        filled = np.where(missing, 0.0, values)
+        total = filled.sum()
+        mean = total / n
+        deviations = np.where(missing, 0.0, filled - mean)
+        m2 = (deviations * deviations).sum()
+        # combine with the chunks so far (Chan et al.'s parallel algorithm)
+        count = self.count + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * n / count
+        self.mean += delta * n / count
+        self.total += total
+        self.count = count
+        values = values[~missing]
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sketch.update(values)
+
+    def result(self):
+        if not self.is_numeric:
+            if self.count == 0:
+                return {"count": 0, "unique": 0, "top": np.nan, "freq": np.nan}
+            if self.category_counts is not None:
+                top = np.lexsort((self.first_seen, -self.category_counts))[0]
+                return {"count": self.count, "unique": np.count_nonzero(self.category_counts), 
+                        "top": self.categories[top], "freq": self.category_counts[top]}
+            counts = self.counts.sort_values(ascending=False, kind="stable")
+            return {"count": self.count, "unique": self.distinct.count(), "top": counts.index[0], 
+                    "freq": counts.iloc[0]}
+        stats = {"count": self.count if self.is_datetime else float(self.count)}
+        if self.count == 0:
+            return stats
+        quartiles = self.sketch.quantiles([0.25, 0.5, 0.75])
+        stats.update({"mean": self.total / self.count, "std": np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+                      "min": self.min, "25%": quartiles[0], "50%": quartiles[1], "75%": quartiles[2], "max": self.max})
+        if self.is_datetime:
+            stats = {k: v if k == "count" else pd.Timestamp(int(round(v))) for k, v in stats.items() if k != "std"}
+        return stats
+
+
+class StreamingSummary:
+    """One-pass summary of a dataset, fed a chunk of rows at a time, in the layout of summarize_dataset
+
+    Each chunk's columns are summarized in parallel, on a pool of `workers` threads.
+
+    Args:
+        workers (int, optional): number of threads. Defaults to the number of CPUs.
+        sketch_size (int, optional): values per level of each column's QuantileSketch. Defaults to QUANTILE_SKETCH_SIZE.
+    """
+    def __init__(self, workers=None, sketch_size=QUANTILE_SKETCH_SIZE):
+        self.columns = None
+        self.sketch_size = sketch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+
+    def update(self, chunk):
+        if self.columns is None:
+            self.columns = {col: ColumnSummary(dtype, self.sketch_size) for col, dtype in chunk.dtypes.items()}
+        for col, dtype in chunk.dtypes.items():
+            # a column read back from CSV is typed by each chunk, and one with no values yet (typed as float) 
+            # takes its type from the first chunk that has some
+            summary = self.columns[col]
+            if summary.count == 0 and dtype != summary.dtype and chunk[col].notna().any():
+                self.columns[col] = ColumnSummary(dtype, self.sketch_size)
+                self.columns[col].rows = summary.rows
+        list(self._executor.map(lambda col: self.columns[col].update(chunk[col]), chunk.columns))
+
+    def result(self):
+        self._executor.shutdown()
+        stats = [summary.result() for summary in self.columns.values()]
+
+        # same columns, in the same order, as describe(include="all")
+        columns = []
+        if any(not x.is_numeric for x in self.columns.values()):
+            columns += ["count", "unique", "top", "freq"]
+        if any(x.is_numeric and not x.is_datetime for x in self.columns.values()):
+            columns += ["count", "mean", "std", "min", "25%", "50%", "75%", "max"]
+        elif any(x.is_datetime for x in self.columns.values()):
+            columns += ["count", "mean", "min", "25%", "50%", "75%", "max"]
+        var_summary = pd.DataFrame({col: pd.Series([x.get(col, np.nan) for x in stats], index=list(self.columns), 
+                                                   dtype=object) for col in dict.fromkeys(columns)})
+
+        summaries = list(self.columns.values())
+        var_summary["type"] = ['str' if str(x.dtype) in ["object", "category"] else "date" if "date" in str(x.dtype) 
+                               else str(x.dtype) for x in summaries]
+        var_summary["missing_pct"] = [1 - x.count / x.rows if x.rows else np.nan for x in summaries]
+        var_summary["col_number"] = np.arange(1, len(summaries) + 1)
+        return var_summary
+
+
+def summarize_dataset(df, return_df=True, output_summary=True, filename=None, exact=False, 
+                      chunksize=SUMMARY_CHUNK_SIZE, workers=None, rows=None):
     """Univariate summary of all variables in a dataframe
 
+    By default, each column is summarized in one streaming pass (see StreamingSummary). Its quartiles are 
+    exact for datasets of up to QUANTILE_EXACT_ROWS rows, and approximate for larger ones or when the number 
+    of rows isn't known; its counts of distinct values are approximate for columns with more than 
+    DISTINCT_EXACT_LIMIT distinct values. With `exact`, the summary comes from describe() instead, which 
+    holds everything in memory.
+
     Args:
-        df (pandas DataFrame): data to summarize
+        df (pandas DataFrame, or iterable of DataFrames): data to summarize, or successive chunks of its rows
         return_df (bool, optional): Whether to return the summary as a DataFrame. Defaults to True.
         output_summary (bool, optional): Whether to export the summary to a file. Defaults to True.
         filename (str, optional): Filename to export. Defaults to None.
+        exact (bool, optional): Whether to compute exact statistics with describe(). Defaults to False.
+        chunksize (int, optional): rows summarized at a time, when `df` is a DataFrame
+        workers (int, optional): threads used to summarize columns in parallel. Defaults to the number of CPUs.
+        rows (int, optional): number of rows, when `df` is an iterable of chunks. Defaults to None (unknown).
     
     Returns:
         pandas DataFrame: Summarized data
     """
     print("Summarizing final dataset...", end="", flush=True)
 
-    var_summary = df.describe(include="all").T
-    var_summary["type"] = ['str' if str(x) == "object" else "date" if "date" in str(x) else str(x) for x in df.dtypes]
-    var_summary["missing_pct"] = 1 - var_summary["count"] / len(df)
-    var_summary["col_number"] = np.arange(1, df.shape[1] + 1)
+    if exact:
+        if not isinstance(df, pd.DataFrame):
+            df = pd.concat(df, ignore_index=True)
+        # describe() breaks ties for "top" differently for categoricals, so summarize them as plain strings
+        var_summary = as_object_columns(df).describe(include="all").T
+        var_summary["type"] = ['str' if str(x) in ["object", "category"] else "date" if "date" in str(x) else str(x) for x in df.dtypes]
+        var_summary["missing_pct"] = 1 - var_summary["count"] / len(df)
+        var_summary["col_number"] = np.arange(1, df.shape[1] + 1)
+    else:
+        chunks = df
+        if isinstance(df, pd.DataFrame):
+            rows = len(df)
+            chunks = (df.iloc[i:i + chunksize] for i in range(0, max(len(df), 1), chunksize))
+        # big enough to hold every value, so that the quartiles are exact, unless there are too many
+        sketch_size = QUANTILE_SKETCH_SIZE if rows is None else min(max(rows, QUANTILE_SKETCH_SIZE), QUANTILE_EXACT_ROWS)
+        summary = StreamingSummary(workers, sketch_size)
+        for chunk in chunks:
+            summary.update(chunk)
+        var_summary = summary.result()
 
     # move these columns to the front
     front_cols = ["col_number", "type", "count", "missing_pct", "unique"]
@@ -458,36 +2828,303 @@ def summarize_dataset(df, return_df=True, output_summary=True, filename=None):
         return var_summary
 
 
-if __name__ == "__main__":
-    ## Important note: even after preprocessing and filtering to get OWID and Oxford in alignment,
-    ## they will still be far apart in row counts because OWID data does doesn't include filler rows 
-    ## for every country even when there were no data.
+#### Row-wise reference implementations
+# These are the original per-row versions of the recoding stages above. They are kept so that 
+# `--compare-recoding` can check that the table-driven versions produce identical output, and 
+# report how much faster they are.
 
-    datasets = download_data()
-    datasets_dict = {'owid': datasets[0], 'oxford': datasets[1], 'oxford_nice': datasets[2]}
+def reformat_dates_rowwise(datasets):
+    print("Reformatting dates (row-wise)...", end="", flush=True)
+    def parse_date(r):
+        datestr = str(r['date'])
+        return datestr[:4] + '-' + datestr[4:6] + '-' + datestr[-2:]
 
-    lowercase_column_names(datasets)
-    reformat_dates(datasets[1:])  # not OWID
-    convert_dates(datasets)
-    intersect_dates(datasets_dict)
-    intersect_countries(datasets_dict)
-    remove_regional_data(datasets_dict)
-    df = merge_datasets(datasets_dict)
-    df = add_iso_codes(df)
-    df = update_filler_rows(df)
-    recode_oxford_vars(df)
-    recode_GT(df)
-    df['new_vaccinations_per_hundred'] = df['new_vaccinations'] / df['population'] * 100
+    for dataset in datasets:
+        dataset['date'] = dataset.apply(parse_date, axis=1)
+    print("done\n", flush=True)
 
-    drop_unnecessary_columns(df)
-    rename_columns(df)
 
-    #### Re-encode dates as string for output to CSV
+def recode_oxford_vars_rowwise(df):
+    print("Recoding Oxford variables (row-wise)...", end="", flush=True)
+    df.drop(columns=["v1_combined", "v1_combined_numeric",
+                     "v2_combined", "v2_combined_numeric",
+                     "v3_combined", "v3_combined_numeric",], inplace=True)
+
+    cols = ['e2_combined', 'h2_combined', 'h3_combined', 'c8_combined',]
+    for col in cols:
+        df[col + "_numeric"] = df[col]
+
+    df[cols] = df[cols].applymap(add_g)
+
+    df["h7_combined"] = df["h7_combined"].str.replace("I", "G")
+
+    df.loc[df["e1_combined"].str.slice(1)=="F", "e1_combined"] = \
+        df.loc[df["e1_combined"].str.slice(1)=="F", "e1_combined"].str.slice(0, 1) + "T"
+
+    df.loc[df["e1_combined"].str.slice(1)=="A", "e1_combined"] = \
+        df.loc[df["e1_combined"].str.slice(1)=="A", "e1_combined"].str.slice(0, 1) + "G"
+
+    print("Done\n", flush=True)
+
+
+def recode_GT_rowwise(df):
+    print("Recoding G/T variables (row-wise)...", end="", flush=True)
+    cols = [x for x in df.columns if x[-9:]=="_combined"]
+    df[cols] = df[cols].applymap(recode_GT_value)
+    print("Done\n", flush=True)
+
+
+def format_dates_rowwise(df):
+    print("Formatting dates for output (row-wise)...", end="", flush=True)
     df['date'] = df.apply(lambda x: x['date'].strftime('%Y-%m-%d'), axis=1)
+    print("Done\n", flush=True)
+
+
+def compare_recoding(stage, rowwise_func, func, data):
+    """Run a recoding stage and its row-wise reference implementation on copies of the same input, 
+    check that both produce identical CSV output, and report the speedup.
+
+    Args:
+        stage (str): name of the stage, for reporting
+        rowwise_func (function): row-wise reference implementation
+        func (function): table-driven implementation
+        data (pandas DataFrame or list of DataFrames): input to the stage. This is not modified.
+
+    Returns:
+        float: speedup of `func` over `rowwise_func`
+    """
+    frames = data if isinstance(data, list) else [data]
 
-    #### Export dataset to CSV
-    the_date = datetime.now().strftime('%Y%m%d-%H%M%S')
-    df.to_csv(f'covid_data_{the_date}.csv', index=False)
+    timings = []
+    outputs = []
+    for stage_func in [rowwise_func, func]:
+        copies = [x.copy() for x in frames]
+        if stage_func is rowwise_func:
+            # the row-wise versions were written for plain object columns
+            copies = [as_object_columns(x) for x in copies]
+        start = time.perf_counter()
+        stage_func(copies if isinstance(data, list) else copies[0])
+        timings.append(time.perf_counter() - start)
+        outputs.append([x.to_csv(index=False) for x in copies])
 
-    _ = summarize_dataset(df)
-    print(f"\nFinal output shape: {df.shape}", flush=True)
+    if outputs[0] != outputs[1]:
+        raise RuntimeError(f"Table-driven {stage} does not match the row-wise output")
+
+    speedup = timings[0] / timings[1] if timings[1] > 0 else float("inf")
+    print(f"{stage}: row-wise {timings[0]:.3f}s, table-driven {timings[1]:.3f}s ({speedup:.1f}x faster)\n", flush=True)
+    return speedup
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, merge, and clean the OWID and OxCGRT datasets")
+    parser.add_argument("--compare-recoding", action="store_true",
+                        help="also run the row-wise recoding stages, check their output matches, and report the speedup")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help=f"directory for downloaded source files (default: {CACHE_DIR})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only reprocess recent dates (and countries whose static attributes changed), "
+                             "and splice them into the previous output")
+    parser.add_argument("--previous", default=None,
+                        help="previous output to update in --incremental mode (default: latest covid_data_*.csv)")
+    parser.add_argument("--window-days", type=int, default=INCREMENTAL_WINDOW_DAYS,
+                        help=f"trailing days to reprocess in --incremental mode (default: {INCREMENTAL_WINDOW_DAYS})")
+    parser.add_argument("--full-read", action="store_true",
+                        help="load all of each source file before filtering, instead of reading only the rows that are kept")
+    parser.add_argument("--chunksize", type=int, default=READ_CHUNK_SIZE,
+                        help=f"rows per chunk when reading the source files (default: {READ_CHUNK_SIZE})")
+    parser.add_argument("--no-compact-dtypes", action="store_true",
+                        help="keep the source files' original column types, instead of reading them with compact "
+                             "types and compacting the merged dataset (see read_sources and compact_dtypes)")
+    parser.add_argument("--merge-engine", choices=["join", "cube"], default="join",
+                        help="merge with joins on country names and dates (default), or on a dense "
+                             "country x date grid (see merge_datasets_cube)")
+    parser.add_argument("--normalized", action="store_true",
+                        help="write a per-country table of static attributes (covid_countries_*.csv) and a table of "
+                             "daily values (covid_daily_*.csv), instead of repeating the static attributes on every row")
+    parser.add_argument("--binary", action="store_true",
+                        help="also write Parquet file(s), and a typed-array bundle for the web page (see write_web_bundle)")
+    parser.add_argument("--shards", action="store_true",
+                        help="also write one CSV per variable, plus a manifest, to covid_shards_*/ (see write_shards)")
+    parser.add_argument("--aggregates", action="store_true",
+                        help="also write covid_aggregates_*.json, with scale bounds for each variable (see compute_aggregates)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run every stage, instead of reusing the outputs of unchanged stages from the stage cache")
+    parser.add_argument("--stage-cache-dir", default=STAGE_CACHE_DIR,
+                        help=f"directory for the stage cache (default: {STAGE_CACHE_DIR})")
+    parser.add_argument("--stage-cache-max-mb", type=float, default=STAGE_CACHE_MAX_MB,
+                        help=f"size limit of the stage cache, in megabytes (default: {STAGE_CACHE_MAX_MB})")
+    parser.add_argument("--exact-summary", action="store_true",
+                        help="compute the variable summary with exact quartiles and counts of distinct values, "
+                             "instead of in one streaming pass (see summarize_dataset)")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="split the filtered data into one partition per country on disk, and process and write "
+                             "one country at a time, so memory use depends on the largest country (see write_partitioned_outputs)")
+    parser.add_argument("--keep-regional", action="store_true",
+                        help="with --partitioned, also write Oxford's regional rows (policy variables only) to covid_regional_*.csv")
+    parser.add_argument("--partition-dir", default=PARTITION_DIR,
+                        help=f"directory for the partitions in --partitioned mode (default: {PARTITION_DIR})")
+    parser.add_argument("--geometry", default=None, metavar="GEOJSON",
+                        help="also convert this GeoJSON file of country polygons (e.g. country_polygons.json) to "
+                             "TopoJSON at each level of detail in GEOMETRY_LEVELS, keeping only the countries in the "
+                             "output (see build_topology)")
+    parser.add_argument("--publish", action="store_true",
+                        help="also publish this run's outputs for the site under content-hashed names, with "
+                             "precompressed copies and a manifest.json that's swapped in atomically (see publish_outputs)")
+    parser.add_argument("--publish-dir", default=".",
+                        help="directory to publish to with --publish (default: the current directory)")
+    parser.add_argument("--profile", action="store_true",
+                        help="run each stage under cProfile, and save the slowest stage's statistics to profile_*.prof")
+    args = parser.parse_args()
+    if args.normalized and args.incremental:
+        parser.error("--incremental updates a covid_data_*.csv file, so it can't be used with --normalized")
+    if args.partitioned:
+        conflicts = [flag for flag, value in [("--incremental", args.incremental), ("--full-read", args.full_read), 
+                                              ("--merge-engine cube", args.merge_engine == "cube"), 
+                                              ("--normalized", args.normalized), ("--binary", args.binary), 
+                                              ("--shards", args.shards), ("--aggregates", args.aggregates), 
+                                              ("--compare-recoding", args.compare_recoding)] if value]
+        if conflicts:
+            parser.error(f"--partitioned never holds the whole dataset in memory, so it can't be used with {', '.join(conflicts)}")
+    elif args.keep_regional:
+        parser.error("--keep-regional requires --partitioned")
+
+    # stages whose code and inputs haven't changed since an earlier run are loaded from the stage cache
+    cache = None if args.no_cache else StageCache(args.stage_cache_dir, args.stage_cache_max_mb)
+    profiler = PipelineProfiler(profile=args.profile, cache=cache)
+    run = profiler.run
+
+    previous = None
+    if args.incremental:
+        previous_file = args.previous or find_previous_output()
+        if previous_file is None:
+            print("No previous output found; running a full refresh\n", flush=True)
+        else:
+            previous = run("load_previous_output", load_previous_output, previous_file)
+
+    ## Important note: even after preprocessing and filtering to get OWID and Oxford in alignment,
+    ## they will still be far apart in row counts because OWID data does doesn't include filler rows 
+    ## for every country even when there were no data.
+
+    print("Downloading data...", flush=True)
+    paths = run("download_sources", download_sources, args.cache_dir, cacheable=False)
+
+    # By default, each file is read once, holding on to the key columns of every row and the rest of the 
+    # rows that could survive; the keys are filtered here, and the rows that survived are selected afterwards
+    if args.full_read:
+        datasets_dict = run("load_sources", load_sources, paths, compact=not args.no_compact_dtypes)
+    elif args.partitioned:
+        # the rows are read again a country at a time in spill_partitions, so only the keys are read here
+        datasets_dict = run("scan_source_keys", scan_source_keys, paths)
+    else:
+        datasets_dict, sources = run("read_sources", read_sources, paths, args.chunksize, 
+                                     compact=not args.no_compact_dtypes)
+    datasets = [datasets_dict['owid'], datasets_dict['oxford'], datasets_dict['oxford_nice']]
+
+    datasets = run("lowercase_column_names", lowercase_column_names, datasets)
+    if args.compare_recoding:
+        compare_recoding("reformat_dates", reformat_dates_rowwise, reformat_dates, datasets[1:])
+    datasets[1:] = run("reformat_dates", reformat_dates, datasets[1:])  # not OWID
+    datasets = run("convert_dates", convert_dates, datasets)
+    datasets_dict = dict(zip(datasets_dict, datasets))
+    datasets_dict = run("intersect_dates", intersect_dates, datasets_dict)
+    datasets_dict = run("intersect_countries", intersect_countries, datasets_dict)
+    if not args.keep_regional:
+        datasets_dict = run("remove_regional_data", remove_regional_data, datasets_dict)
+    if args.partitioned:
+        # each country's rows are processed and written separately; see write_partitioned_outputs
+        spilled = run("spill_partitions", spill_partitions, paths, datasets_dict, args.partition_dir, args.chunksize, 
+                      keep_regional=args.keep_regional, cacheable=False)
+        del datasets, datasets_dict
+        the_date = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output_files = run("write_partitioned_outputs", write_partitioned_outputs, spilled, the_date, 
+                           keep_regional=args.keep_regional, compact=not args.no_compact_dtypes, cacheable=False)
+        shutil.rmtree(args.partition_dir)
+        output_file = next(iter(output_files))
+        # summarized from the output file, a chunk at a time
+        _ = run("summarize_dataset", summarize_dataset, read_output_chunks(output_file), exact=args.exact_summary, 
+                rows=output_files[output_file], cacheable=False)
+        if args.geometry:
+            dataset_iso_codes = set(pd.read_csv(output_file, usecols=['iso_code'])['iso_code'].dropna())
+    else:
+        if not args.full_read:
+            datasets_dict = run("select_filtered_rows", select_filtered_rows, sources, datasets_dict)
+            del sources
+        if previous is not None:
+            datasets_dict, cutoff, changed_countries = run("plan_incremental_refresh", plan_incremental_refresh, 
+                                                           datasets_dict, previous, args.window_days)
+        if args.merge_engine == "cube":
+            # merges, adds ISO codes, and fills in static attributes in one go
+            df = run("merge_datasets_cube", merge_datasets_cube, datasets_dict)
+            del datasets, datasets_dict
+            if not args.no_compact_dtypes:
+                df = run("compact_dtypes", compact_dtypes, df)
+        else:
+            df = run("merge_datasets", merge_datasets, datasets_dict)
+            del datasets, datasets_dict
+            df = run("add_iso_codes", add_iso_codes, df)
+            if not args.no_compact_dtypes:
+                df = run("compact_dtypes", compact_dtypes, df)
+            if not args.normalized:
+                df = run("update_filler_rows", update_filler_rows, df)
+        countries = None
+        if args.normalized:
+            countries = run("country_attributes", country_attributes, df)
+            # from here on, the static attributes (which haven't been filled in) live in the countries table only
+            df = run("drop_static_columns", drop_static_columns, df)
+        if previous is not None:
+            df = run("restore_static_values", restore_static_values, df, previous, changed_countries)
+        if args.compare_recoding:
+            compare_recoding("recode_oxford_vars", recode_oxford_vars_rowwise, recode_oxford_vars, df)
+        df = run("recode_oxford_vars", recode_oxford_vars, df)
+        if args.compare_recoding:
+            compare_recoding("recode_GT", recode_GT_rowwise, recode_GT, df)
+        df = run("recode_GT", recode_GT, df)
+        df = run("add_derived_columns", add_derived_columns, df, countries)
+
+        df = run("drop_unnecessary_columns", drop_unnecessary_columns, df)
+        df = run("rename_columns", rename_columns, df)
+        if args.compare_recoding:
+            compare_recoding("format_dates", format_dates_rowwise, format_dates, df)
+        df = run("format_dates", format_dates, df)
+        if previous is not None:
+            df = run("splice_incremental", splice_incremental, previous, df, cutoff, changed_countries)
+        aggregates = None
+        if args.aggregates:
+            # after splicing, so that incremental runs cover the whole output
+            aggregates = run("compute_aggregates", compute_aggregates, df, countries)
+
+        #### Export dataset to CSV
+        the_date = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output_file = run("export_outputs", export_outputs, df, the_date, countries, aggregates, 
+                          binary=args.binary, shards=args.shards, cacheable=False)
+
+        _ = run("summarize_dataset", summarize_dataset, df, exact=args.exact_summary, cacheable=False)
+        if args.normalized:
+            _ = run("summarize_countries", summarize_dataset, countries, 
+                    filename=os.path.join(os.getcwd(), "var_summary_countries_" + datetime.now().strftime("%Y%m%d") + ".csv"),
+                    exact=args.exact_summary, cacheable=False)
+        dataset_iso_codes = set((df if countries is None else countries)['iso_code'].dropna())
+        print(f"\nFinal output shape: {df.shape}", flush=True)
+    if args.geometry:
+        topology = run("build_topology", build_topology, args.geometry, dataset_iso_codes)
+        _ = run("write_topojson", write_topojson, topology, the_date, cacheable=False)
+    if args.publish:
+        # every output of this run has its timestamp in its name; each is published under its name without it. 
+        # Directories (the --shards output) aren't published.
+        outputs = {os.path.basename(x).replace(f"_{the_date}", ""): x 
+                   for x in sorted(glob.glob(f"*_{the_date}.*")) if os.path.isfile(x)}
+        if args.shards:
+            print(f"Note: --publish doesn't include covid_shards_{the_date}/; copy the directory as it is if the site "
+                  f"needs it\n", flush=True)
+        if args.normalized:
+            print("Note: the page loads covid_data.csv, which --normalized doesn't write; with this manifest it will "
+                  "show an error instead of the visualizations\n", flush=True)
+        _ = run("publish_outputs", publish_outputs, outputs, args.publish_dir, cacheable=False)
+    profiler.stop()
+
+    profiler.print_report()
+    # the run report goes next to the output, so day-to-day runs can be compared
+    profiler.write_report(os.path.join(os.path.dirname(os.path.abspath(output_file)), f"run_report_{the_date}.json"),
+                          config=vars(args))
+    if args.profile:
+        profiler.dump_slowest_profile(f"profile_{the_date}.prof")
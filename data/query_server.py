@@ -0,0 +1,423 @@
+import os
+import glob
+import gzip
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import numpy as np
+
+from data_downloader import DATA_DICTIONARY_FILE, FILLER_COLS
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+
+# compressed responses are cached until they add up to this many megabytes, least recently used first out
+CACHE_MAX_MB = 64
+
+# how often to check for a newer output
+POLL_SECONDS = 5
+
+# the data dictionary next to this script, which groups the variables into categories
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), DATA_DICTIONARY_FILE)
+
+# columns with one value per country, rather than one per country and date
+STATIC_COLS = ['iso_code', *FILLER_COLS]
+
+
+def find_latest_output(directory):
+    # the latest covid_data_*.csv, or covid_daily_*.csv from a --normalized run; both end in the run's 
+    # timestamp (YYYYMMDD-HHMMSS), so the latest has the largest
+    files = [*glob.glob(os.path.join(directory, "covid_data_*.csv")), 
+             *glob.glob(os.path.join(directory, "covid_daily_*.csv"))]
+    return max(files, key=lambda x: os.path.basename(x).rsplit("_", 1)[-1], default=None)
+
+
+def countries_file(filename):
+    # the countries table written with a --normalized run's covid_daily_*.csv, or None for a covid_data_*.csv
+    directory, name = os.path.split(filename)
+    if not name.startswith("covid_daily_"):
+        return None
+    countries = os.path.join(directory, name.replace("covid_daily_", "covid_countries_", 1))
+    if not os.path.exists(countries):
+        raise FileNotFoundError(f"{name} has no {os.path.basename(countries)} next to it")
+    return countries
+
+
+class QueryError(Exception):
+    # a bad request; the message is sent back to the client
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class DatasetIndex:
+    """The pipeline's output, loaded once and indexed by country and date
+
+    Each daily variable is held as a (dates x countries) array: numeric variables as float64 with NaN
+    for missing values, and the others (the ordinal policy variables and tests_units) as codes into a
+    list of categories, with -1 for missing values. Static attributes (STATIC_COLS) have one value per
+    country, taken from the countries table for --normalized output. For each daily variable, the date of 
+    each country's latest (finite, non-missing) value is also kept.
+
+    Args:
+        filename (str): a covid_data_*.csv file, or a covid_daily_*.csv file with its covid_countries_*.csv
+        dictionary_file (str, optional): data dictionary, for grouping variables by category.
+                                         Defaults to DICTIONARY_PATH.
+    """
+    def __init__(self, filename, dictionary_file=DICTIONARY_PATH):
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        # only empty fields are missing values, as written by to_csv
+        df = pd.read_csv(filename, keep_default_na=False, na_values=[""])
+
+        self.dates = np.sort(df['date'].unique()).astype(str)  # ISO dates sort chronologically
+        self.countries = pd.Index(pd.unique(df['countryname']))
+        date_idx = pd.Index(self.dates).get_indexer(df['date'])
+        country_idx = self.countries.get_indexer(df['countryname'])
+        self.rows = len(df)
+
+        countries = countries_file(filename)
+        if countries is None:
+            first_rows = df.drop_duplicates('countryname').set_index('countryname').reindex(self.countries)
+        else:
+            first_rows = pd.read_csv(countries, keep_default_na=False, na_values=[""])
+            first_rows = first_rows.set_index('countryname').reindex(self.countries)
+        self.static = {col: first_rows[col] for col in STATIC_COLS if col in first_rows.columns}
+        iso_codes = self.static.get('iso_code', pd.Series(dtype=object))
+        self.iso_codes = {iso_code: i for i, iso_code in enumerate(iso_codes) if isinstance(iso_code, str)}
+
+        self.daily = {}
+        self.categories = {}
+        self.latest = {}
+        shape = (len(self.dates), len(self.countries))
+        for col in df.columns:
+            if col in ['countryname', 'date'] or col in self.static:
+                continue
+            if pd.api.types.is_numeric_dtype(df[col]):
+                grid = np.full(shape, np.nan)
+                grid[date_idx, country_idx] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                valid = np.isfinite(grid)
+            else:
+                codes, categories = pd.factorize(df[col])
+                grid = np.full(shape, -1, dtype=np.int32)
+                grid[date_idx, country_idx] = codes
+                self.categories[col] = categories.tolist()
+                valid = grid >= 0
+            self.daily[col] = grid
+            # row of the latest valid value in each column, or -1
+            last = len(self.dates) - 1 - np.argmax(valid[::-1], axis=0)
+            self.latest[col] = np.where(valid.any(axis=0), last, -1)
+
+        dictionary = pd.read_csv(dictionary_file, keep_default_na=False)
+        dictionary = dictionary[dictionary['variable_name'].isin([*self.daily, *self.static])]
+        self.variable_categories = {category: group['variable_name'].tolist()
+                                    for category, group in dictionary.groupby('category', sort=False)}
+
+    def to_json(self, col, values):
+        # a list of a variable's values (numbers, or codes into its categories), with None for missing values. 
+        # Infinite values (e.g. per-capita figures for a population of zero) aren't valid JSON, so are None too.
+        if col in self.categories:
+            categories = self.categories[col]
+            return [categories[x] if x >= 0 else None for x in values.tolist()]
+        return [x if finite else None for x, finite in zip(values.tolist(), np.isfinite(values).tolist())]
+
+    def values(self, col, date_rows, country_cols):
+        # values of a daily variable: one list per country, over the given dates
+        grid = self.daily[col][np.ix_(date_rows, country_cols)].T
+        return [self.to_json(col, row) for row in grid]
+
+    def static_value(self, col, country_col):
+        value = self.static[col].iloc[country_col]
+        if isinstance(value, (float, np.floating)):
+            return float(value) if np.isfinite(value) else None
+        return value
+
+    def find_countries(self, names):
+        # countries by name or ISO code; all of them if none are given
+        if not names:
+            return np.arange(len(self.countries))
+        cols = []
+        for name in names:
+            if name in self.iso_codes:
+                cols.append(self.iso_codes[name])
+            elif name in self.countries:
+                cols.append(self.countries.get_loc(name))
+            else:
+                raise QueryError(f"unknown country: {name}")
+        return np.array(cols)
+
+    def find_variables(self, names, static=False):
+        for name in names:
+            if name not in self.daily and not (static and name in self.static):
+                raise QueryError(f"unknown variable: {name}")
+        return names
+
+    def find_date(self, date):
+        row = np.searchsorted(self.dates, date)
+        if row == len(self.dates) or self.dates[row] != date:
+            raise QueryError(f"no data for date: {date}", status=404)
+        return row
+
+    def meta(self, params):
+        return {"file": os.path.basename(self.filename), "rows": self.rows,
+                "dates": {"first": self.dates[0], "last": self.dates[-1], "count": len(self.dates)},
+                "countries": [{"name": name, "iso_code": self.static_value('iso_code', i) if self.iso_codes else None}
+                              for i, name in enumerate(self.countries)],
+                "variables": self.variable_categories,
+                "categories": self.categories}
+
+    def snapshot(self, params):
+        # one or more variables, for every country (or the given ones), on one date
+        variables = self.find_variables(required(params, 'variable'))
+        date = required(params, 'date')[0]
+        row = self.find_date(date)
+        country_cols = self.find_countries(listed(params, 'countries'))
+        names = self.countries[country_cols]
+        return {"date": date,
+                "values": {col: dict(zip(names, (x[0] for x in self.values(col, [row], country_cols))))
+                           for col in variables}}
+
+    def series(self, params):
+        # one or more variables, for the given countries (default all), over a range of dates (default all)
+        variables = self.find_variables(required(params, 'variable'))
+        country_cols = self.find_countries(listed(params, 'countries'))
+        start = np.searchsorted(self.dates, params.get('start', [self.dates[0]])[0], side="left")
+        stop = np.searchsorted(self.dates, params.get('end', [self.dates[-1]])[0], side="right")
+        date_rows = np.arange(start, stop)
+        series = {col: self.values(col, date_rows, country_cols) for col in variables}
+        return {"dates": self.dates[date_rows].tolist(),
+                "countries": {name: {col: series[col][i] for col in variables}
+                              for i, name in enumerate(self.countries[country_cols])}}
+
+    def latest_values(self, params):
+        # each country's latest non-missing value (and its date) of each variable in a category of the data
+        # dictionary (or of the given variables); static attributes have no date
+        if 'category' in params:
+            category = params['category'][0]
+            if category not in self.variable_categories:
+                raise QueryError(f"unknown category: {category}")
+            variables = self.variable_categories[category]
+        else:
+            variables = self.find_variables(required(params, 'variable'), static=True)
+        country_cols = self.find_countries(listed(params, 'countries'))
+
+        names = self.countries[country_cols]
+        latest = {name: {} for name in names}
+        for variable in variables:
+            if variable in self.static:
+                for name, col in zip(names, country_cols):
+                    latest[name][variable] = {"value": self.static_value(variable, col)}
+                continue
+            rows = self.latest[variable][country_cols]
+            values = self.to_json(variable, self.daily[variable][rows, country_cols])
+            for name, row, value in zip(names, rows, values):
+                # rows of -1 (no valid values) pick up the last date's missing value
+                latest[name][variable] = {"date": self.dates[row] if row >= 0 else None, "value": value}
+        return latest
+
+
+def required(params, name):
+    values = listed(params, name)
+    if not values:
+        raise QueryError(f"missing parameter: {name}")
+    return values
+
+
+def listed(params, name):
+    # a parameter given as a comma-separated list, repeated, or both (e.g. countries=USA,FRA&countries=DEU)
+    return [x for value in params.get(name, []) for x in value.split(",") if x]
+
+
+class ResponseCache:
+    """Bounded LRU cache of compressed responses
+
+    Args:
+        max_bytes (int): total size of the cached responses, beyond which the least recently used are dropped
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            if key in self._entries or len(body) > self.max_bytes:
+                return
+            self._entries[key] = body
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.bytes -= len(dropped)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+class QueryService:
+    """Answers queries from the latest DatasetIndex, caching the compressed responses
+
+    A background thread checks the directory for a newer output (see find_latest_output) every `poll_seconds`. Once it
+    has stopped changing (the same size and modification time on two checks in a row, so a file that is
+    still being written isn't loaded), it is indexed, swapped in for new requests, and the cache is cleared.
+
+    Args:
+        directory (str): where the pipeline writes its output
+        max_bytes (int): size of the response cache
+        poll_seconds (float): how often to check for a newer output
+    """
+    ENDPOINTS = {"/meta": DatasetIndex.meta, "/snapshot": DatasetIndex.snapshot, "/series": DatasetIndex.series,
+                 "/latest": DatasetIndex.latest_values}
+
+    def __init__(self, directory, max_bytes, poll_seconds=POLL_SECONDS):
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self.cache = ResponseCache(max_bytes)
+        filename = find_latest_output(directory)
+        if filename is None:
+            raise FileNotFoundError(f"no covid_data_*.csv or covid_daily_*.csv in {os.path.abspath(directory)}")
+        self.index = self._load(filename)
+        self._candidate = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def _load(self, filename):
+        print(f"Indexing {filename}...", end="", flush=True)
+        started = time.perf_counter()
+        index = DatasetIndex(filename)
+        print(f"Done ({index.rows} rows, {len(index.countries)} countries, {len(index.dates)} dates, "
+              f"{time.perf_counter() - started:.2f} s)", flush=True)
+        return index
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.check_for_update()
+            except Exception as e:  # keep serving the current index
+                print(f"Couldn't load a newer output: {e!r}", flush=True)
+
+    def check_for_update(self):
+        filename = find_latest_output(self.directory)
+        if filename is None:
+            return False
+        stat = os.stat(filename)
+        signature = (filename, stat.st_size, stat.st_mtime_ns)
+        if filename == self.index.filename and stat.st_mtime == self.index.mtime:
+            self._candidate = None
+            return False
+        if signature != self._candidate:
+            # wait for the next check, in case it's still being written
+            self._candidate = signature
+            return False
+        self.index = self._load(filename)
+        self.cache.clear()
+        self._candidate = None
+        return True
+
+    def respond(self, path, params):
+        """Answer a request, from the cache if possible
+
+        Returns:
+            tuple: HTTP status, and the gzip-compressed JSON body
+        """
+        index = self.index
+        if path == "/stats":
+            return 200, gzip.compress(json.dumps({"file": os.path.basename(index.filename),
+                                                  "cache": self.cache.stats()}).encode())
+        endpoint = self.ENDPOINTS.get(path)
+        if endpoint is None:
+            return 404, gzip.compress(json.dumps({"error": f"unknown endpoint: {path}"}).encode())
+
+        # the same query with its parameters in a different order is the same cache entry
+        key = (index.filename, path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+        try:
+            result = endpoint(index, params)
+        except QueryError as e:
+            return e.status, gzip.compress(json.dumps({"error": str(e)}).encode())
+        body = gzip.compress(json.dumps(result, separators=(",", ":")).encode(), compresslevel=6)
+        self.cache.put(key, body)
+        return 200, body
+
+    def stop(self):
+        self._stop.set()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service = None
+    verbose = False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        status, body = self.service.respond(url.path.rstrip("/") or "/", parse_qs(url.query))
+        compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+        if not compressed:
+            body = gzip.decompress(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        # so the D3 page can query it when served from somewhere else
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve slices of the pipeline's latest output over HTTP, as JSON")
+    parser.add_argument("--directory", default=".",
+                        help="directory with the pipeline's output (default: the current directory)")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--cache-mb", type=float, default=CACHE_MAX_MB,
+                        help=f"size of the response cache, in megabytes (default: {CACHE_MAX_MB})")
+    parser.add_argument("--poll-seconds", type=float, default=POLL_SECONDS,
+                        help=f"how often to check for a newer output (default: {POLL_SECONDS})")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    QueryHandler.service = QueryService(args.directory, int(args.cache_mb * 1024 * 1024), args.poll_seconds)
+    QueryHandler.verbose = args.verbose
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    print(f"Serving on http://{args.host}:{args.port}/ (endpoints: {', '.join(['/stats', *QueryService.ENDPOINTS])})",
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        QueryHandler.service.stop()
+        server.server_close()
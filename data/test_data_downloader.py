@@ -0,0 +1,497 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_downloader as dd
+
+
+def static_attributes(**overrides):
+    values = {col: 1.0 for col in dd.FILLER_COLS}
+    values["continent"] = "Europe"
+    values.update(overrides)
+    return values
+
+
+def source_datasets(countries=("France", "Spain"), days=60):
+    # minimal owid, oxford, and oxford_nice datasets after convert_dates
+    dates = pd.date_range("2020-03-01", periods=days)
+    owid = pd.DataFrame([{"location": c, "date": d, **static_attributes()} for c in countries for d in dates])
+    oxford = pd.DataFrame([{"countryname": c, "date": d} for c in countries for d in dates])
+    return {"owid": owid, "oxford": oxford, "oxford_nice": oxford.copy()}
+
+
+def previous_output(countries=("France", "Spain"), days=50):
+    dates = pd.date_range("2020-03-01", periods=days).strftime("%Y-%m-%d")
+    return pd.DataFrame([{"countryname": c, "date": d, "value": 0.0, **static_attributes()}
+                         for c in countries for d in dates])
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = dd.PipelineProfiler(cache=dd.StageCache(str(tmp_path / "stage_cache")))
+    yield profiler
+    profiler.stop()
+
+
+def test_plan_incremental_refresh_returns_filtered_datasets(profiler):
+    datasets, previous = source_datasets(), previous_output()
+    rows = {name: len(x) for name, x in datasets.items()}
+
+    # the second run is loaded from the stage cache, and has to give the same plan
+    for _ in range(2):
+        planned, cutoff, changed = profiler.run("plan_incremental_refresh", dd.plan_incremental_refresh,
+                                                datasets, previous, 28)
+        assert cutoff == pd.Timestamp("2020-03-22")
+        assert changed == set()
+        for name, df in planned.items():
+            assert (df["date"] >= cutoff).all()
+            assert len(df) == 2 * 39
+        assert {name: len(x) for name, x in datasets.items()} == rows
+    assert [x["cached"] for x in profiler.stages] == [False, True]
+
+
+def test_plan_incremental_refresh_reprocesses_new_and_changed_countries():
+    datasets = source_datasets(countries=("France", "Spain", "Italy"))
+    datasets["owid"].loc[datasets["owid"]["location"] == "Spain", "population"] = 2.0
+    planned, cutoff, changed = dd.plan_incremental_refresh(datasets, previous_output(), 28)
+    assert changed == {"Spain", "Italy"}
+    assert (planned["oxford"]["countryname"] == "Spain").sum() == 60
+    assert (planned["oxford"]["countryname"] == "France").sum() == 39
+
+
+def test_incremental_splice_has_no_duplicates(profiler):
+    # a second incremental run over the same sources must give the same output as the first
+    datasets, previous = source_datasets(days=60), previous_output(days=50)
+    for _ in range(2):
+        planned, cutoff, changed = profiler.run("plan_incremental_refresh", dd.plan_incremental_refresh,
+                                                datasets, previous, 28)
+        reprocessed = planned["oxford"].copy()
+        reprocessed["date"] = reprocessed["date"].dt.strftime("%Y-%m-%d")
+        reprocessed["value"] = 1.0
+        for col, value in static_attributes().items():
+            reprocessed[col] = value
+        reprocessed = reprocessed[previous.columns]
+        spliced = dd.splice_incremental(previous, reprocessed, cutoff, changed)
+        assert len(spliced) == 2 * 60
+        assert not spliced.duplicated(["countryname", "date"]).any()
+
+
+def mutating_stage(datasets):
+    datasets["owid"] = datasets["owid"].head(1)
+    return len(datasets)
+
+
+def test_stage_that_modifies_its_arguments_is_not_cached(profiler):
+    for _ in range(2):
+        datasets = source_datasets()
+        assert profiler.run("mutating_stage", mutating_stage, datasets) == 3
+        assert len(datasets["owid"]) == 1
+    assert [x["cached"] for x in profiler.stages] == [False, False]
+
+
+def add_column(df):
+    df["extra"] = 1
+
+
+def test_stage_that_modifies_the_frame_it_returns_is_cached(profiler):
+    for _ in range(2):
+        df = profiler.run("add_column", add_column, pd.DataFrame({"a": np.arange(3)}))
+        assert list(df.columns) == ["a", "extra"]
+    assert [x["cached"] for x in profiler.stages] == [False, True]
+
+
+def test_quantile_sketch_is_exact_when_it_holds_every_value():
+    values = np.random.default_rng(0).lognormal(size=20_000)
+    sketch = dd.QuantileSketch(k=len(values))
+    for i in range(0, len(values), 3_000):
+        sketch.update(values[i:i + 3_000])
+    assert sketch.quantiles([0.25, 0.5, 0.75]) == list(np.percentile(values, [25, 50, 75]))
+
+
+def test_quantile_sketch_rank_error_is_small():
+    values = np.random.default_rng(1).lognormal(size=500_000)
+    sketch = dd.QuantileSketch(k=dd.QUANTILE_SKETCH_SIZE)
+    for i in range(0, len(values), 100_000):
+        sketch.update(values[i:i + 100_000])
+    assert len(sketch.levels) > 1
+    ordered = np.sort(values)
+    for q, estimate in zip([0.25, 0.5, 0.75], sketch.quantiles([0.25, 0.5, 0.75])):
+        assert abs(np.searchsorted(ordered, estimate) / len(values) - q) < 0.001
+
+
+def test_quantile_sketch_empty():
+    assert all(np.isnan(x) for x in dd.QuantileSketch().quantiles([0.5]))
+
+
+def test_distinct_counter_exact_then_approximate():
+    counter = dd.DistinctCounter(exact_limit=1_000)
+    counter.update(np.arange(500).astype(str))
+    counter.update(np.arange(250, 750).astype(str))
+    assert counter.count() == 750 and counter.registers is None
+
+    counter.update(np.arange(200_000).astype(str))
+    assert counter.registers is not None
+    assert abs(counter.count() - 200_000) / 200_000 < 0.03
+
+
+def test_streaming_summary_matches_describe():
+    # more rows than QUANTILE_SKETCH_SIZE, so the sketch has to be sized to the data to stay exact
+    rng = np.random.default_rng(2)
+    n = 3 * dd.QUANTILE_SKETCH_SIZE
+    df = pd.DataFrame({"population": rng.lognormal(size=n),
+                       "cases": np.where(rng.random(n) < 0.3, np.nan, rng.integers(0, 1_000, n).astype(float)),
+                       "continent": pd.Categorical(rng.choice(["Asia", "Europe", None], n)),
+                       "countryname": rng.choice(["France", "Spain", "Chad"], n).astype(object)})
+    streamed = dd.summarize_dataset(df, output_summary=False, chunksize=5_000)
+    exact = dd.summarize_dataset(df, output_summary=False, exact=True)
+    quartiles = ["25%", "50%", "75%"]
+    pd.testing.assert_frame_equal(streamed[quartiles], exact[quartiles])
+    # means and standard deviations are summed a chunk at a time, so may differ in the last digit
+    pd.testing.assert_frame_equal(streamed.drop(columns=quartiles).infer_objects(), 
+                                  exact.drop(columns=quartiles).infer_objects(), check_dtype=False)
+
+
+def read_filtered(path, keys, chunksize, compact):
+    # Oxford's rows that survived filtering, with the given keys standing in for the filtered ones
+    all_keys, sources = dd.read_sources({"oxford": str(path)}, chunksize=chunksize, compact=compact)
+    assert len(all_keys["oxford"]) == len(pd.read_csv(path))
+    return dd.select_filtered_rows(sources, {"oxford": keys})["oxford"]
+
+
+def test_read_sources_reads_compact_types(tmp_path):
+    path = tmp_path / "OxCGRT_latest_combined.csv"
+    pd.DataFrame({"CountryName": ["France", "Spain", "Chad", "France"], "RegionName": [np.nan] * 4,
+                  "Date": [20200301, 20200301, 20200301, 20200302], "C1_combined": ["2G", np.nan, "1T", "3"],
+                  "StringencyIndex": [0.5, 0.25, 11.1, 1.0]}).to_csv(path, index=False)
+    keys = pd.DataFrame({"date": pd.to_datetime(["2020-03-01", "2020-03-01", "2020-03-02"])}, index=[0, 2, 3])
+
+    # two rows at a time, so that the categoricals have to be merged across chunks
+    for compact in [False, True]:
+        df = read_filtered(path, keys, chunksize=2, compact=compact)
+        assert df["countryname"].astype(object).tolist() == ["France", "Chad", "France"]
+        assert df["c1_combined"].astype(object).tolist() == ["2G", "1T", "3"]
+        assert df["stringencyindex"].astype(np.float64).tolist() == [0.5, 11.1, 1.0]
+        if compact:
+            assert isinstance(df["countryname"].dtype, pd.CategoricalDtype)
+            assert isinstance(df["c1_combined"].dtype, pd.CategoricalDtype)
+            # 11.1 isn't exactly representable in float32
+            assert df["stringencyindex"].dtype == np.float64
+        else:
+            assert df["countryname"].dtype == object
+
+
+def test_concat_compact_falls_back_to_values_when_types_differ():
+    chunks = [pd.DataFrame({"c1_combined": [2.0, np.nan]}), pd.DataFrame({"c1_combined": ["2G", "1T"]})]
+    for chunk in chunks:
+        dd.compact_columns(chunk)
+    assert chunks[0]["c1_combined"].dtype == np.float64
+    df = dd.concat_compact(chunks)
+    assert df["c1_combined"].tolist()[2:] == ["2G", "1T"] and df["c1_combined"].iloc[0] == 2.0
+
+
+def test_read_filtered_chunks_skips_chunks_with_no_kept_rows(tmp_path):
+    path = tmp_path / "OxCGRT_latest_combined.csv"
+    pd.DataFrame({"CountryName": ["France", "Spain", "Chad"], "RegionName": [np.nan, "Madrid", np.nan],
+                  "Date": [20200301] * 3, "C1_combined": ["2G", "1T", "3"]}).to_csv(path, index=False)
+    keys = pd.DataFrame({"date": pd.to_datetime(["2020-03-01", "2020-03-01"])}, index=[0, 2])
+    chunks = list(dd.read_filtered_chunks("oxford", str(path), keys, chunksize=1))
+    assert [len(x) for x in chunks] == [1, 0, 1]
+    df = pd.concat(chunks)
+    assert df["countryname"].tolist() == ["France", "Chad"]
+    assert df["date"].tolist() == keys["date"].tolist()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_read_sources_types_code_columns_like_a_whole_file_read(tmp_path, compact):
+    path = tmp_path / "OxCGRT_latest_combined.csv"
+    pd.DataFrame({"CountryName": ["France", "France", "Spain", "Spain"], "RegionName": [np.nan] * 4,
+                  "Date": [20200301, 20200302, 20200301, 20200302],
+                  "H7_combined": ["0", "0", "1T", "0"],         # text, though the first chunk is all numbers
+                  "H2_combined": ["1", "2", "3", np.nan],       # numbers, missing only in a dropped row
+                  "H3_combined": ["1", "2", "3", "0"]}).to_csv(path, index=False)
+    keys = pd.DataFrame({"date": pd.to_datetime(["2020-03-01", "2020-03-02", "2020-03-01"])}, index=[0, 1, 2])
+    whole = pd.read_csv(path).iloc[:3]
+
+    df = read_filtered(path, keys, chunksize=2, compact=compact)
+    for col in ["H7_combined", "H2_combined", "H3_combined"]:
+        assert df[col.lower()].astype(object).tolist() == whole[col].tolist()
+        if not compact or whole[col].dtype != object:
+            assert df[col.lower()].dtype == whole[col].dtype
+
+
+def test_read_sources_holds_only_rows_that_can_survive(tmp_path):
+    oxford = pd.DataFrame({"CountryName": ["France", "France", "Chad", "Chad"], "RegionName": [np.nan, "Paris", np.nan, np.nan],
+                           "Date": [20200301, 20200301, 20200301, 20200302], "C1_combined": ["1G", "2T", "0", "3"]})
+    owid = pd.DataFrame({"iso_code": ["FRA", "ESP", "TCD"], "location": ["France", "Spain", "Chad"],
+                         "date": ["2020-03-01"] * 3, "new_cases": [1.0, 2.0, 3.0]})
+    oxford.to_csv(tmp_path / "oxford.csv", index=False)
+    owid.to_csv(tmp_path / "owid.csv", index=False)
+    paths = {"owid": str(tmp_path / "owid.csv"), "oxford": str(tmp_path / "oxford.csv")}
+
+    keys, sources = dd.read_sources(paths, chunksize=2)
+    # every row's keys, to be filtered as if the whole files had been read, in the order of `paths`
+    assert list(keys) == ["owid", "oxford"]
+    assert list(keys["oxford"].columns) == ["countryname", "regionname", "date"] and len(keys["oxford"]) == 4
+    assert keys["owid"]["location"].tolist() == ["France", "Spain", "Chad"]
+    # Spain isn't in Oxford, and Paris is a region
+    assert sources["rows"]["owid"].index.tolist() == [0, 2]
+    assert sources["rows"]["oxford"].index.tolist() == [0, 2, 3]
+    assert "date" not in sources["rows"]["oxford"].columns
+
+    keys["oxford"] = keys["oxford"].loc[[2, 3]].assign(date=pd.to_datetime(["2020-03-01", "2020-03-02"]))
+    keys["owid"] = keys["owid"].loc[[2]].assign(date=pd.to_datetime(["2020-03-01"]))
+    datasets = dd.select_filtered_rows(sources, keys)
+    assert datasets["oxford"]["countryname"].cat.categories.tolist() == ["Chad"]
+    assert datasets["oxford"]["c1_combined"].tolist() == ["0", "3"]
+    assert datasets["owid"]["new_cases"].tolist() == [3.0] and datasets["owid"]["date"].tolist() == keys["owid"]["date"].tolist()
+
+    keys, sources = dd.read_sources(paths, chunksize=2, keep_regional=True)
+    assert sources["rows"]["oxford"].index.tolist() == [0, 1, 2, 3]
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def decode_rings(output, polygon):
+    # arcs back to coordinates, as topojson-client does
+    arcs = []
+    for arc in output["arcs"]:
+        points = np.cumsum(np.array(arc, dtype=np.float64), axis=0)
+        arcs.append(points * output["transform"]["scale"] + output["transform"]["translate"])
+    rings = []
+    for ring in polygon:
+        points = [arcs[x] if x >= 0 else arcs[~x][::-1] for x in ring]
+        # to well within a grid step
+        rings.append({tuple(np.round(p, 4)) for p in np.concatenate(points)})
+    return rings
+
+
+def test_topology_shares_borders_and_keeps_holes_and_multipolygons(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    features = [("AAA", "Polygon", [square(0, 0, 2), square(0.5, 0.5, 0.5)]),   # with a hole
+                ("BBB", "Polygon", [square(2, 0, 2)]),                          # shares the border x=2 with AAA
+                ("CCC", "MultiPolygon", [[square(5, 0, 1)], [square(7, 0, 1)]]),
+                ("DDD", "Polygon", [square(9, 0, 1)])]                          # not in the dataset
+    with open("countries.json", "w") as f:
+        json.dump({"type": "FeatureCollection",
+                   "features": [{"type": "Feature", "properties": {"ISO_A3": iso},
+                                 "geometry": {"type": kind, "coordinates": coordinates}}
+                                for iso, kind, coordinates in features]}, f)
+    pd.DataFrame({"country": ["A", "B", "C", "D"], "iso_code": ["AAA", "BBB", "CCC", "DDD"]}).to_csv("iso.csv", index=False)
+
+    levels = {"full": (0.0, dd.TOPOLOGY_QUANTIZATION)}
+    topology = dd.build_topology("countries.json", {"AAA", "BBB", "CCC"}, iso_filename="iso.csv", levels=levels)
+    assert dd.write_topojson(topology, "20260101-000000", levels) == ["country_polygons_full_20260101-000000.topojson"]
+    # the page loads the copy without the timestamp
+    with open("country_polygons_full.topojson") as f:
+        output = json.load(f)
+    with open("country_polygons_full_20260101-000000.topojson") as f:
+        assert json.load(f) == output
+
+    geometries = {x["properties"]["ISO_A3"]: x for x in output["objects"]["countries"]["geometries"]}
+    assert sorted(geometries) == ["AAA", "BBB", "CCC"]
+    assert geometries["CCC"]["type"] == "MultiPolygon" and len(geometries["CCC"]["arcs"]) == 2
+
+    # the border is one arc, used forwards by one country and backwards by the other
+    aaa_arcs = {x if x >= 0 else ~x for x in geometries["AAA"]["arcs"][0]}
+    bbb_arcs = {x if x >= 0 else ~x for x in geometries["BBB"]["arcs"][0]}
+    assert len(aaa_arcs & bbb_arcs) == 1
+
+    outer, hole = decode_rings(output, geometries["AAA"]["arcs"])
+    assert outer == {tuple(map(float, p)) for p in square(0, 0, 2)}
+    assert hole == {tuple(map(float, p)) for p in square(0.5, 0.5, 0.5)}
+    for polygon, (x, y) in zip(geometries["CCC"]["arcs"], [(5, 0), (7, 0)]):
+        assert decode_rings(output, polygon) == [{tuple(map(float, p)) for p in square(x, y, 1)}]
+
+
+def publish_day(tmp_path, day):
+    # one day's outputs: a CSV and a web bundle whose JSON names its .bin
+    source = tmp_path / f"run{day}"
+    source.mkdir(exist_ok=True)
+    (source / f"covid_data_{day}.csv").write_text(f"date\n{day}\n")
+    (source / f"covid_web_{day}.bin").write_bytes(bytes([day]) * 8)
+    (source / f"covid_web_{day}.json").write_text(json.dumps({"data_file": f"covid_web_{day}.bin"}))
+    files = {name: str(source / f"{name.split('.')[0]}_{day}.{name.split('.')[1]}")
+             for name in ["covid_data.csv", "covid_web.bin", "covid_web.json"]}
+    return dd.publish_outputs(files, str(tmp_path / "site"))
+
+
+def test_publish_names_the_published_bin_in_the_web_bundle(tmp_path):
+    manifest = publish_day(tmp_path, 1)
+    with open(tmp_path / "site" / manifest["files"]["covid_web.json"]["path"]) as f:
+        bundle = json.load(f)
+    assert bundle["data_file"] == manifest["files"]["covid_web.bin"]["path"]
+    assert (tmp_path / "site" / bundle["data_file"]).read_bytes() == bytes([1]) * 8
+    assert not [x for x in os.listdir(tmp_path / "site") if x.startswith(".publishing-")]
+
+
+def test_publish_keeps_the_previous_files_and_removes_older_ones(tmp_path):
+    manifests = [publish_day(tmp_path, day) for day in [1, 2, 3]]
+    with open(tmp_path / "site" / "manifest.json") as f:
+        assert json.load(f) == manifests[-1]
+    published = set(os.listdir(tmp_path / "site")) - {"manifest.json"}
+    assert published == dd.manifest_paths(manifests[1]) | dd.manifest_paths(manifests[2])
+    assert not published & dd.manifest_paths(manifests[0])
+
+    # publishing the same outputs again changes no names, and removes the second day's files
+    assert publish_day(tmp_path, 3)["files"] == manifests[2]["files"]
+    assert set(os.listdir(tmp_path / "site")) - {"manifest.json"} == dd.manifest_paths(manifests[2])
+
+
+def test_web_bundle_codes_widen_when_the_categories_dont_fit_in_uint8(tmp_path):
+    pd.DataFrame({"variable_name": ["few", "many"], "display_name": ["Few", "Many"], "category": ["Policy"] * 2,
+                  "data_type": ["ordinal"] * 2, "larger_is": ["worse"] * 2, "sort_order": [1, 2],
+                  "numeric_column": ["", ""]}).to_csv(tmp_path / "dictionary.csv", index=False)
+    n = 300
+    df = pd.DataFrame({"countryname": ["France"] * n, "date": pd.date_range("2021-01-01", periods=n),
+                       "iso_code": "FRA", "continent": "Europe",
+                       "few": ["0", np.nan] * (n // 2), "many": [f"{i:03d}" for i in range(n - 1)] + [np.nan]})
+    dd.write_web_bundle(df, str(tmp_path / "bundle"), dictionary_file=str(tmp_path / "dictionary.csv"))
+    with open(tmp_path / "bundle.json") as f:
+        variables = {x["variable_name"]: x for x in json.load(f)["variables"]}
+    data = (tmp_path / "bundle.bin").read_bytes()
+
+    def codes(entry):
+        return np.frombuffer(data, dtype=entry["dtype"], count=entry["length"], offset=entry["offset"])
+    assert variables["few"]["dtype"] == "uint8" and variables["few"]["missing_code"] == 255
+    assert codes(variables["few"])[:2].tolist() == [0, 255]
+    assert variables["many"]["dtype"] == "uint16" and variables["many"]["missing_code"] == 65535
+    assert codes(variables["many"])[[0, 298, 299]].tolist() == [0, 298, 65535]
+
+
+def test_publish_doesnt_precompress_parquet(tmp_path):
+    (tmp_path / "covid_data.parquet").write_bytes(b"PAR1" * 4)
+    (tmp_path / "covid_data.csv").write_text("date\n1\n")
+    manifest = dd.publish_outputs({"covid_data.parquet": str(tmp_path / "covid_data.parquet"), 
+                                   "covid_data.csv": str(tmp_path / "covid_data.csv")}, str(tmp_path / "site"))
+    assert set(manifest["files"]["covid_data.parquet"]) == {"path", "bytes", "sha256"}
+    assert "gzip" in manifest["files"]["covid_data.csv"]
+    assert set(os.listdir(tmp_path / "site")) - {"manifest.json"} == dd.manifest_paths(manifest)
+
+
+def test_summary_of_the_output_file_matches_the_in_memory_summary(tmp_path):
+    # as --partitioned summarizes its output: missing static strings are "" in memory, and a value to the summary
+    df = pd.DataFrame({"countryname": ["France", "Chad", "Chad", "Spain"], "continent": ["Europe", "", "", "Europe"],
+                       "population": [67.0, np.nan, np.nan, 47.0], "value": [1.5, np.nan, 0.010824796236520023, np.nan],
+                       "c1_school_closing": ["1-National", "", np.nan, "NA"]})
+    df.to_csv(tmp_path / "covid_data.csv", index=False)
+    chunks = dd.read_output_chunks(tmp_path / "covid_data.csv", chunksize=3)
+    streamed = dd.summarize_dataset(chunks, output_summary=False, rows=len(df))
+    # other columns' empty fields are missing, whatever they were before
+    expected = dd.summarize_dataset(df.assign(c1_school_closing=["1-National", np.nan, np.nan, "NA"]), 
+                                    output_summary=False)
+    pd.testing.assert_frame_equal(streamed, expected)
+    assert streamed.loc["continent", "count"] == 4 and streamed.loc["continent", "unique"] == 2
+    # read back exactly as written, not to within the last digit
+    assert streamed.loc["value", "min"] == 0.010824796236520023
+    pd.testing.assert_frame_equal(streamed, expected, check_exact=True)
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    # serves `body` with an ETag, answering conditional and range requests as the sources' servers do
+    body = b""
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == self.etag:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.body) - start))
+        self.end_headers()
+        self.wfile.write(self.body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def source_server():
+    SourceHandler.body, SourceHandler.etag, SourceHandler.requests = bytes(range(256)) * 40, '"v1"', []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SourceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/owid-covid-data.csv"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_to_cache_downloads_then_revalidates(source_server, tmp_path):
+    path = str(tmp_path / "owid-covid-data.csv")
+    result = dd.fetch_to_cache(source_server, path, chunk_size=1000)
+    assert result["status"] == "downloaded" and result["bytes"] == len(SourceHandler.body)
+    with open(path, "rb") as f:
+        assert f.read() == SourceHandler.body
+    assert not os.path.exists(path + ".part") and not os.path.exists(path + ".part.meta.json")
+
+    result = dd.fetch_to_cache(source_server, path)
+    assert result["status"] == "not modified" and result["reused_bytes"] == len(SourceHandler.body)
+    assert SourceHandler.requests[-1]["If-None-Match"] == '"v1"'
+
+
+def interrupted_download(url, path, received):
+    # what an interrupted fetch_to_cache leaves behind
+    with open(path + ".part", "wb") as f:
+        f.write(SourceHandler.body[:received])
+    dd.write_cache_metadata(path + ".part", {"url": url, "etag": '"v1"', "last_modified": None})
+
+
+def test_fetch_to_cache_resumes_an_interrupted_download(source_server, tmp_path):
+    path = str(tmp_path / "owid-covid-data.csv")
+    interrupted_download(source_server, path, 3000)
+    result = dd.fetch_to_cache(source_server, path)
+    assert result["status"] == "resumed"
+    assert (result["bytes"], result["reused_bytes"]) == (len(SourceHandler.body) - 3000, 3000)
+    assert SourceHandler.requests[-1]["Range"] == "bytes=3000-"
+    with open(path, "rb") as f:
+        assert f.read() == SourceHandler.body
+    assert dd.read_cache_metadata(path)["etag"] == '"v1"'
+
+
+def test_fetch_to_cache_starts_over_when_the_file_changed(source_server, tmp_path):
+    path = str(tmp_path / "owid-covid-data.csv")
+    interrupted_download(source_server, path, 3000)
+    SourceHandler.body, SourceHandler.etag = b"changed" * 500, '"v2"'
+    result = dd.fetch_to_cache(source_server, path)
+    assert result["status"] == "downloaded" and result["reused_bytes"] == 0
+    with open(path, "rb") as f:
+        assert f.read() == b"changed" * 500
+
+
+def test_stage_cache_evicts_the_least_recently_used(tmp_path):
+    cache = dd.StageCache(str(tmp_path), max_mb=0.0025)
+    cache.put("a", b"a" * 1000)
+    cache.put("b", b"b" * 1000)
+    os.utime(tmp_path / "a.pkl", (100, 100))
+    os.utime(tmp_path / "b.pkl", (200, 200))
+    assert cache.get("a") == (True, b"a" * 1000)  # now the most recently used
+
+    cache.put("c", b"c" * 1000)
+    assert sorted(os.listdir(tmp_path)) == ["a.pkl", "c.pkl"]
+    assert cache.get("b") == (False, None)
+
+    # opened again with a smaller limit
+    os.utime(tmp_path / "a.pkl", (400, 400))
+    os.utime(tmp_path / "c.pkl", (300, 300))
+    dd.StageCache(str(tmp_path), max_mb=0.0015)
+    assert os.listdir(tmp_path) == ["a.pkl"]
+
+
+def test_recode_GT_names_the_column_and_value_it_cannot_recode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df = pd.DataFrame({"c1_combined": ["1G", "2T"], "c2_combined": ["0", "3X"]})
+    with pytest.raises(RuntimeError, match=r"unexpected value '3X' \(str\) in c2_combined"):
+        dd.recode_GT(df)
+    assert len(list(tmp_path.glob("failed_*.csv"))) == 1
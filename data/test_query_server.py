@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import query_server as qs
+
+
+def write_output(directory, timestamp, normalized=False, new_cases=(1.0, 2.0, np.nan, 4.0)):
+    wide = pd.DataFrame({"countryname": ["France", "France", "Chad", "Chad"],
+                         "date": ["2021-03-01", "2021-03-02", "2021-03-01", "2021-03-02"],
+                         "new_cases": list(new_cases), "c1_school_closing": ["1-National", "", "0", "2-Local"],
+                         "iso_code": ["FRA", "FRA", "TCD", "TCD"], "continent": ["Europe", "Europe", "", ""],
+                         "population": [67.0, 67.0, 16.0, 16.0]})
+    if not normalized:
+        wide.to_csv(os.path.join(directory, f"covid_data_{timestamp}.csv"), index=False)
+        return os.path.join(directory, f"covid_data_{timestamp}.csv")
+    countries = wide[["countryname", "iso_code", "continent", "population"]].drop_duplicates("countryname")
+    countries.to_csv(os.path.join(directory, f"covid_countries_{timestamp}.csv"), index=False)
+    wide.drop(columns=["iso_code", "continent", "population"]).to_csv(
+        os.path.join(directory, f"covid_daily_{timestamp}.csv"), index=False)
+    return os.path.join(directory, f"covid_daily_{timestamp}.csv")
+
+
+def respond(service, path, **params):
+    status, body = service.respond(path, {k: [v] for k, v in params.items()})
+    return status, json.loads(gzip.decompress(body))
+
+
+@pytest.fixture
+def service(tmp_path):
+    write_output(str(tmp_path), "20210302-080000")
+    service = qs.QueryService(str(tmp_path), max_bytes=1024 * 1024, poll_seconds=3600)
+    yield service
+    service.stop()
+
+
+def test_normalized_output_is_indexed_like_the_wide_output(tmp_path):
+    wide = qs.DatasetIndex(write_output(str(tmp_path), "20210302-080000"))
+    normalized = qs.DatasetIndex(write_output(str(tmp_path), "20210302-090000", normalized=True))
+    params = {"variable": ["new_cases,c1_school_closing,continent,population"], "countries": ["TCD,France"]}
+    assert normalized.latest_values(params) == wide.latest_values(params)
+    assert normalized.series({"variable": ["new_cases,c1_school_closing"]}) == \
+        wide.series({"variable": ["new_cases,c1_school_closing"]})
+    assert {k: v for k, v in normalized.meta({}).items() if k != "file"} == \
+        {k: v for k, v in wide.meta({}).items() if k != "file"}
+
+
+def test_normalized_output_needs_its_countries_table(tmp_path):
+    filename = write_output(str(tmp_path), "20210302-090000", normalized=True)
+    os.remove(os.path.join(str(tmp_path), "covid_countries_20210302-090000.csv"))
+    with pytest.raises(FileNotFoundError, match="covid_countries_20210302-090000.csv"):
+        qs.DatasetIndex(filename)
+
+
+def test_find_latest_output_compares_timestamps_across_kinds(tmp_path):
+    assert qs.find_latest_output(str(tmp_path)) is None
+    write_output(str(tmp_path), "20210302-090000", normalized=True)
+    write_output(str(tmp_path), "20210302-080000")
+    assert os.path.basename(qs.find_latest_output(str(tmp_path))) == "covid_daily_20210302-090000.csv"
+    write_output(str(tmp_path), "20210303-080000")
+    assert os.path.basename(qs.find_latest_output(str(tmp_path))) == "covid_data_20210303-080000.csv"
+
+
+def test_queries(service):
+    assert respond(service, "/snapshot", variable="new_cases", date="2021-03-02") == \
+        (200, {"date": "2021-03-02", "values": {"new_cases": {"France": 2.0, "Chad": 4.0}}})
+    status, latest = respond(service, "/latest", variable="new_cases,c1_school_closing", countries="FRA")
+    assert latest == {"France": {"new_cases": {"date": "2021-03-02", "value": 2.0},
+                                 "c1_school_closing": {"date": "2021-03-01", "value": "1-National"}}}
+    assert respond(service, "/snapshot", variable="new_cases", date="2021-03-05")[0] == 404
+    assert respond(service, "/series", variable="deaths")[0] == 400
+    assert respond(service, "/nothing")[0] == 404
+
+
+def test_responses_are_cached_until_a_newer_output_is_loaded(service, tmp_path):
+    for _ in range(2):
+        assert respond(service, "/snapshot", variable="new_cases", date="2021-03-01")[1]["values"]["new_cases"] == \
+            {"France": 1.0, "Chad": None}
+    assert service.cache.stats()["hits"] == 1
+
+    write_output(str(tmp_path), "20210303-080000", normalized=True, new_cases=(5.0, 6.0, 7.0, 8.0))
+    # loaded once it's the same on two checks in a row
+    assert not service.check_for_update()
+    assert service.check_for_update()
+    assert service.cache.stats()["entries"] == 0
+    assert respond(service, "/snapshot", variable="new_cases", date="2021-03-01")[1]["values"]["new_cases"] == \
+        {"France": 5.0, "Chad": 7.0}
+    assert respond(service, "/stats")[1]["file"] == "covid_daily_20210303-080000.csv"
+
+
+def test_response_cache_drops_the_least_recently_used():
+    cache = qs.ResponseCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.put("c", b"1234")
+    assert cache.get("b") is None and cache.get("a") == b"1234" and cache.get("c") == b"1234"
+    cache.put("d", b"x" * 11)  # bigger than the whole cache
+    assert cache.get("d") is None
+    assert cache.stats()["bytes"] == 8
@@ -26,6 +26,7 @@ var formatMonthYear = function (d) {
 var covidData;
 var dataDict;
 var geomData;
+var dataManifest;
 var minDate;
 var maxDate;
 
@@ -1000,18 +1001,15 @@ function makeViz1a() {
                     .style("font-size", FONT_SIZES.title + "px")
                     .style("font-weight", "bold");
 
-    // get unique iso_codes
-    let covidISOCodes = Array.from(new Set(covidData.map(d => d.iso_code)));
-    let geomISOCodes = geomData.features.map(d => d.properties.ISO_A3);
-
-    let commonISOCodes = geomISOCodes.filter(d => covidISOCodes.includes(d));
-    //let geomMissingISOCodes = geomISOCodes.filter(d => !covidISOCodes.includes(d));
+    // get unique iso_codes. Each level of detail is styled by these as it's loaded, since the medium and high levels 
+    // can have countries that the low level leaves out.
+    const covidISOCodes = new Set(covidData.map(d => d.iso_code));
 
 
     /***************************
     * Make the map.
     * geojson from https://datahub.io/core/geo-countries
-    * converted to topojson (for compression) using https://mapshaper.org/
+    * converted to quantized topojson by data_downloader.py --geometry (see loadGeometry)
     **************************/
     const northeastCorner = L.latLng(84.4, 181);
     const southwestCorner = L.latLng(-58, -180);
@@ -1041,20 +1039,60 @@ function makeViz1a() {
     // each path will have a classname = their ISO code (e.g., class="USA")
     // only give countries in our dataset a class of shape-[ISO code], and make other countries' polygons gray
     const styleLeafletPaths = function(feature) {
+        const inData = covidISOCodes.has(feature.properties.ISO_A3);
         return {
-            className: commonISOCodes.includes(feature.properties.ISO_A3) ? "shape-" + feature.properties.ISO_A3 : null,
-            fillColor: commonISOCodes.includes(feature.properties.ISO_A3) ? "blue" : "#eee",
-            fillOpacity: commonISOCodes.includes(feature.properties.ISO_A3) ? 1.0 : 0.1
+            className: inData ? "shape-" + feature.properties.ISO_A3 : null,
+            fillColor: inData ? "blue" : "#eee",
+            fillOpacity: inData ? 1.0 : 0.1
         };
     };
 
-    L.geoJson(geomData, { style: styleLeafletPaths })
-        .addTo(map);
+    viz1a.geometryLayer = L.geoJson(geomData, { style: styleLeafletPaths })
+                            .addTo(map);
 
     map.boxZoom.disable();
 
     d3.selectAll("#map path").attr("stroke", null);
 
+    // swap in the polygons with the level of detail for the new zoom, loading each level the first time it's needed. 
+    // The new paths get the old paths' colors right away, then their data and selection.
+    if (geomData.level) {
+        const geometries = { [geomData.level]: Promise.resolve(geomData) };
+        viz1a.geometryLevel = geomData.level;
+
+        map.on("zoomend", function () {
+            const level = geometryLevel(map.getZoom());
+            if (!(level in geometries)) {
+                geometries[level] = loadGeometryLevel(dataManifest, level).catch(() => null);
+            }
+
+            geometries[level].then(function (geometry) {
+                // not there, already shown, or the map has been zoomed again since
+                if (!geometry || level == viz1a.geometryLevel || level != geometryLevel(map.getZoom())) return;
+
+                const isoCode = path => d3.select(path).attr("class").match(/(?<=shape-)[A-Z]{3}/)[0];
+                const fills = {};
+                d3.selectAll("#map path[class^='shape-']").each(function () {
+                    fills[isoCode(this)] = d3.select(this).attr("fill");
+                });
+
+                map.removeLayer(viz1a.geometryLayer);
+                viz1a.geometryLayer = L.geoJson(geometry, { style: styleLeafletPaths })
+                                        .addTo(map);
+                viz1a.geometryLevel = level;
+
+                d3.selectAll("#map path").attr("stroke", null);
+                d3.selectAll("#map path[class^='shape-']").attr("fill", function () {
+                    return fills[isoCode(this)] || d3.select(this).attr("fill");
+                });
+
+                redrawViz1a();
+                d3.selectAll("#map path[class^='shape-']")
+                    .classed("selected-country", d => d !== undefined && viz1.selectedCountries.includes(d.countryname));
+            });
+        });
+    }
+
     /*******************
     * add a transparent rectangle over top of the whole SVG so we can click anywhere
     * to remove items from the selection
@@ -1541,11 +1579,47 @@ function makeViz3() {
     legend.style("display", "none"); // will be displayed when there are data
 }
 
-Promise.all([
-    d3.csv("./data/data_dictionary.csv", dictRowParser),
-    d3.csv("./data/covid_data.csv", dataRowParser),
-    d3.json("./data/country_polygons.json")
-]).then(function (files) {
+// data_downloader.py --publish writes data/manifest.json, which maps each data file's name to a copy 
+// named by a hash of its contents. Those copies never change, so they can be cached indefinitely, 
+// while the manifest itself is always revalidated. Without a manifest, the unversioned files are used; with one, 
+// a file it doesn't list is an error, rather than a fall back to an unversioned copy that may be out of date.
+function dataPath(manifest, name) {
+    if (!manifest) return "./data/" + name;
+    if (!manifest.files[name]) {
+        throw new Error("data/manifest.json doesn't list " + name + " (it isn't published with --normalized)");
+    }
+    return "./data/" + manifest.files[name].path;
+}
+
+// data_downloader.py --geometry writes the countries' polygons at three levels of detail (GEOMETRY_LEVELS 
+// there); each is used from this map zoom up: low for the whole world, medium for a continent, high for a country
+const GEOMETRY_ZOOMS = { low: 0, medium: 4, high: 6 };
+
+function geometryLevel(zoom) {
+    return Object.keys(GEOMETRY_ZOOMS).filter(level => zoom >= GEOMETRY_ZOOMS[level]).pop();
+}
+
+// quantized TopoJSON of the countries in the dataset at one level of detail, converted back to GeoJSON
+function loadGeometryLevel(manifest, level) {
+    return Promise.resolve("country_polygons_" + level + ".topojson")
+        .then(name => d3.json(dataPath(manifest, name)))
+        .then(topology => Object.assign(topojson.feature(topology, topology.objects.countries), { level: level }));
+}
+
+// the page starts zoomed out to the whole world; falls back to the full GeoJSON file if there's no TopoJSON
+function loadGeometry(manifest) {
+    return loadGeometryLevel(manifest, "low")
+        .catch(() => d3.json("./data/country_polygons.json"));
+}
+
+d3.json("./data/manifest.json", { cache: "no-cache" })
+    .catch(() => null)
+    .then(manifest => (dataManifest = manifest))
+    .then(manifest => Promise.all([
+        d3.csv("./data/data_dictionary.csv", dictRowParser),
+        d3.csv(dataPath(manifest, "covid_data.csv"), dataRowParser),
+        loadGeometry(manifest)
+    ])).then(function (files) {
     dataDict = files[0];
     covidData = files[1];
     geomData = files[2];
@@ -1807,4 +1881,11 @@ Promise.all([
     d3.select("#viz1-container").style("margin-left", "0px");
     d3.select("#viz2-container").style("margin-left", "0px");
     d3.select("#viz3-container").style("margin-left", "0px");
+}).catch(function (error) {
+    console.error(error);
+    d3.selectAll(".spinner").remove();
+    d3.select("#introduction").append("p")
+        .classed("load-error", true)
+        .style("color", "red")
+        .text("The data couldn't be loaded: " + error.message);
 });